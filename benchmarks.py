@@ -0,0 +1,838 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+# Micro-benchmarks for individual parts of the bot, each compared with the approach it replaced
+# where there was one. replay.py benchmarks the bot as a whole.
+#
+#   REST:       python benchmarks.py rest [--requests 2000] [--concurrency 10]
+#   Dispatch:   python benchmarks.py dispatch [--messages 1000] [--speed 1] [--handler-delay 0.005]
+#   Images:     python benchmarks.py images [--sizes 1 12] [--downscaling 10]
+#   Executor:   python benchmarks.py executor [--requests 8] [--megapixels 1] [--workers 2]
+#   Gateway:    python benchmarks.py compression [--guilds 100] [--messages 10000] [--frame-size 4096]
+#   Codecs:     python benchmarks.py codecs [--guilds 2000] [--messages 20000]
+#   Matchers:   python benchmarks.py matchers [--commands 500] [--keywords 480] [--patterns 20] [--messages 10000]
+#   Buffers:    python benchmarks.py buffers [--channels 100000] [--per-channel 3]
+#   Guilds:     python benchmarks.py guildcache [--guilds 1000] [--members 250] [--channels 20] [--lookups 2000]
+#   Metrics:    python benchmarks.py instrumentation [--guilds 100] [--messages 20000] [--repeat 5] [--gateway]
+#   Results:    python benchmarks.py resultcache [--images 5] [--commands 200] [--megapixels 0.5] [--max-mb 64]
+#   Commands:   python benchmarks.py commands [--invocations 100000]
+#   Uploads:    python benchmarks.py uploads [--uploads 50] [--mb 10] [--max-uploads 4]
+
+from discordBot import instrumentation as metrics_registry,discord_bot_connection,discord_chat_handler,channel_buffer,guild_cache,result_cache,command_parser,command_error,zlib_stream_decoder,json_codec,orjson_codec,etf_codec,get_codec
+from replay import stand_in_server,synthesize
+import replay
+import asyncio,time,argparse,aiohttp,os,sys,json,tempfile,importlib,re,random,tracemalloc,gc,io,statistics,contextlib,multiprocessing,hashlib,resource
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Run 'count' calls of a coroutine function, at most 'concurrency' at a time, and return the seconds taken.
+async def run_concurrently(func, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    async def one():
+        async with semaphore:
+            await func()
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for i in range(count)])
+    return time.perf_counter() - started
+
+# REST requests per second against the stand-in server, opening a ClientSession for every request
+# as api_get_call() used to, and with the connection's shared keep-alive session.
+async def rest(requests=2000, concurrency=10):
+    server = stand_in_server()
+    await server.start()
+
+    async def session_per_request():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{server.apiUrl}users/@me") as response:
+                await response.json()
+
+    bot = discord_bot_connection("benchmark", apiUrl=server.apiUrl)
+    async def shared_session():
+        await bot.api_get_call("users/@me")
+
+    results = {}
+    for name, func in (("session per request", session_per_request), ("shared session", shared_session)):
+        await func()        # Warm up.
+        seconds = await run_concurrently(func, requests, concurrency)
+        results[name] = requests / seconds
+        print(f"{name + ':':<24}{results[name]:8.0f} requests/sec")
+    print(f"Speedup:                {results['shared session'] / results['session per request']:8.1f}x")
+
+    await bot.close_session()
+    await server.stop()
+    return results
+
+# Run a bot over the stand-in gateway until every recorded event has been handled, and return
+# the seconds and CPU seconds it took (the stand-in server's included).
+async def run_gateway(server, **kwargs):
+    bot = discord_bot_connection("benchmark", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl, **kwargs)
+    started = time.perf_counter()
+    cpu = time.process_time()
+    task = asyncio.ensure_future(bot.start())
+    while not (server.done.is_set() and bot.sequence == server.last_sequence) and not task.done():
+        await asyncio.sleep(0.01)
+    seconds = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    await bot.close()
+    await task
+    return seconds, cpu
+
+# Bytes on the wire and CPU time with and without zlib-stream transport compression over the
+# stand-in gateway, then the frames the compressed run received replayed through the decoder
+# alone, to separate the bot's inflate cost from the server's deflate cost.
+async def compression(guilds=100, messages=10000, frameSize=4096):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.jsonl")
+        synthesize(path, guilds=guilds, messages=messages)
+
+        for compress in (False, True):
+            server = stand_in_server(path, frameSize=frameSize, keepFrames=compress)
+            await server.start()
+            seconds, cpu = await run_gateway(server, compress=compress)
+            await server.stop()
+            print(f"compress={str(compress):<6} {server.bytes_sent/1024/1024:8.2f}MB sent ({server.raw_bytes/1024/1024:.2f}MB of JSON), "
+                  f"{server.events_sent/seconds:6.0f} events/sec, {cpu/server.events_sent*1e6:6.1f}us CPU/event")
+
+    # The bot's side alone: inflate and parse the recorded frames, or just parse the same messages.
+    decoder = zlib_stream_decoder()
+    raw = [m for m in (decoder.feed(data) for data in server.frames) if m is not None]
+    started = time.process_time()
+    decoder = zlib_stream_decoder()
+    for data in server.frames:
+        message = decoder.feed(data)
+        if message is not None:
+            json.loads(message)
+    inflated = time.process_time() - started
+    started = time.process_time()
+    for message in raw:
+        json.loads(message)
+    parsed = time.process_time() - started
+    print(f"Replaying {len(server.frames)} recorded frames ({len(raw)} messages): "
+          f"{inflated/len(raw)*1e6:.1f}us/message inflating and parsing, {parsed/len(raw)*1e6:.1f}us parsing alone, "
+          f"{decoder.decompressedBytes/inflated/1024/1024:.0f}MB/s of JSON out of the decoder")
+    return server
+
+# Gateway payloads from a synthetic recording: a READY carrying every guild in full, as a
+# large bot's first message, and a burst of MESSAGE_CREATEs.
+def codec_corpus(guilds=2000, messages=20000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.jsonl")
+        synthesize(path, guilds=guilds, messages=messages, presences=0)
+        with open(path) as f:
+            frames = [json.loads(line)['frame'] for line in f]
+    ready = next(frame for frame in frames if frame['t'] == 'READY')
+    ready['d']['guilds'] = [frame['d'] for frame in frames if frame['t'] == 'GUILD_CREATE']
+    return { f"READY ({guilds} guilds)": [ready],
+             f"MESSAGE_CREATE x{messages}": [frame for frame in frames if frame['t'] == 'MESSAGE_CREATE'] }
+
+# Decode throughput of each gateway codec over the same payloads, encoded by that codec.
+def codecs(guilds=2000, messages=20000):
+    corpus = codec_corpus(guilds, messages)
+    available = [("json", json_codec()), ("etf", etf_codec())]
+    if isinstance(get_codec("json"), orjson_codec):   # orjson is installed.
+        available.insert(1, ("orjson", orjson_codec()))
+    else:
+        print("orjson is not installed, skipping it.")
+
+    results = {}
+    for corpusName, payloads in corpus.items():
+        print(f"{corpusName}:")
+        for name, codec in available:
+            encoded = [codec.dumps(payload) for payload in payloads]
+            size = sum(len(data) for data in encoded)
+            assert codec.loads(encoded[0]) == payloads[0]
+            started = time.process_time()
+            for data in encoded:
+                codec.loads(data)
+            seconds = time.process_time() - started
+            results[(corpusName, name)] = (size / seconds, len(encoded) / seconds)
+            print(f"    {name:<8}{size/1024/1024:7.2f}MB  {size/seconds/1024/1024:7.1f}MB/s  {len(encoded)/seconds:11.1f} messages/s")
+    return results
+
+# Messages per second through find_matches() with commands and keywords in their registries,
+# against calling a matcher per registered function for every message, as every command and
+# keyword used to be registered (a regular expression for commands, lower() and 'in' for keywords).
+def matchers(commands=500, keywords=480, patterns=20, messages=10000, seed=0):
+    rng = random.Random(seed)
+    ch = discord_chat_handler(discord_bot_connection("benchmark"))
+    old = []    # Matchers in registration order.
+    def handler(message):
+        pass
+
+    kinds = ["command"] * commands + ["keyword"] * keywords + ["pattern"] * patterns
+    rng.shuffle(kinds)
+    names = { "command": [], "keyword": [], "pattern": [] }
+    for i,kind in enumerate(kinds):
+        if kind == "command":
+            name = f"^command{i}"
+            ch.matchCommand(name)(handler)
+            old.append(lambda m, e=re.compile("^" + re.escape(name) + r"(\s|$)"): e.search(m['content']))
+        elif kind == "keyword":
+            name = f"keyword{i}"
+            ch.matchKeyword(name)(handler)
+            old.append(lambda m, k=name: k in m['content'].lower())
+        else:
+            name = f"pattern{i}"
+            ch.matchContent(re.compile(f"{name}=[0-9]+").search)(handler)
+            old.append(lambda m, e=re.compile(f"{name}=[0-9]+"): e.search(m['content']))
+        names[kind].append(name)
+
+    # Every registered matcher's position in registration order, by its index.
+    registered = [m for entries in list(ch.command_registry.values()) + list(ch.keyword_registry.values()) for m,f in entries]
+    registered += ch.match_registry[0]
+    position = { m['index']: i for i,m in enumerate(sorted(registered, key=lambda m: m['index'])) }
+
+    words = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "siege", "tonight"]
+    corpus = []
+    for i in range(messages):
+        r = rng.random()
+        text = " ".join(rng.choice(words) for w in range(rng.randrange(3, 15)))
+        if r < 0.1:
+            text = f"{rng.choice(names['command'])} {text}"
+        elif r < 0.3:
+            text = f"{text} {rng.choice(names['keyword']).upper()} {text}"
+        elif r < 0.35:
+            text = f"{text} {rng.choice(names['pattern'])}=42"
+        corpus.append({ "content": text })
+
+    started = time.process_time()
+    oldMatches = [[i for i,matcher in enumerate(old) if matcher(message)] for message in corpus]
+    oldSeconds = time.process_time() - started
+
+    started = time.process_time()
+    newMatches = [[position[m['index']] for m,f in ch.find_matches(message)] for message in corpus]
+    newSeconds = time.process_time() - started
+
+    print(f"{len(old)} matchers ({commands} commands, {keywords} keywords, {patterns} patterns), {messages} messages:")
+    print(f"    every matcher per message: {messages/oldSeconds:9.0f} messages/s")
+    print(f"    find_matches():            {messages/newSeconds:9.0f} messages/s ({oldSeconds/newSeconds:.0f}x)")
+    print(f"    Same matches:              {oldMatches == newMatches} ({sum(map(len, newMatches))} matched)")
+    return oldSeconds, newSeconds
+
+# A MESSAGE_CREATE as the gateway sends it, one in ten with an image attached.
+def message_create(i, channel_id, rng):
+    author = { "id": str(10000 + rng.randrange(1000)), "username": "someone", "discriminator": "0001", "avatar": "0" * 32 }
+    attachments = []
+    if rng.random() < 0.1:
+        attachments = [{ "id": str(2 * 10**6 + i), "filename": "image.png", "size": 123456, "width": 1024, "height": 768,
+                "url": f"https://cdn.discordapp.com/attachments/{channel_id}/{2 * 10**6 + i}/image.png",
+                "proxy_url": f"https://media.discordapp.net/attachments/{channel_id}/{2 * 10**6 + i}/image.png" }]
+    return { "id": str(10**6 + i), "type": 0, "channel_id": channel_id, "guild_id": "1000", "author": author,
+             "member": { "roles": [], "joined_at": "2018-01-01T00:00:00", "deaf": False, "mute": False },
+             "content": "just a normal message, nothing to see here", "timestamp": "2018-01-01T00:00:00",
+             "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+             "attachments": attachments, "embeds": [], "pinned": False, "nonce": str(i) }
+
+# The dict of lists of whole message objects chat handlers used to keep.
+class old_channel_buffer(dict):
+    def __init__(self, bufferSize=3):
+        self.bufferSize = bufferSize
+
+    def append(self, message):
+        if message['channel_id'] not in self:
+            self[message['channel_id']] = [None for i in range(self.bufferSize)]
+
+        self[message['channel_id']].pop(0)
+        self[message['channel_id']].append(message)
+
+    # As falsebot.py's findRecentImageInChannel() looked for an image.
+    def last_attachment(self, channel_id):
+        for m in reversed(self[channel_id]):
+            if m and m['attachments'] and len(m['attachments']) > 0:
+                return m
+        return None
+
+# Memory held by channel_buffer against the old dict of lists of message dicts, with every
+# message of 'channels' channels decoded fresh as it would be from the gateway, and the time to
+# find the last attachment in every channel.
+def buffers(channels=100000, perChannel=3, seed=0):
+    results = {}
+    for name, factory in (("dict of message lists", lambda: old_channel_buffer(perChannel)),
+                          ("channel_buffer", lambda: channel_buffer(perChannel, maxBytes=2**62))):   # Never evict.
+        rng = random.Random(seed)
+        gc.collect()
+        tracemalloc.start()
+        buf = factory()
+        for i in range(channels * perChannel):
+            channel_id = str(10**9 + i % channels)
+            buf.append(json.loads(json.dumps(message_create(i, channel_id, rng))))
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        channel_ids = [str(10**9 + c) for c in range(channels)]
+        started = time.perf_counter()
+        found = sum(1 for channel_id in channel_ids if buf.last_attachment(channel_id) is not None)
+        seconds = time.perf_counter() - started
+
+        results[name] = (memory, seconds, found)
+        print(f"{name + ':':<24}{memory/1024/1024:8.1f}MB, last_attachment() {seconds/channels*1e9:5.0f}ns/channel "
+              f"({found} channels with an image)")
+        del buf
+    return results
+
+# A GUILD_CREATE as the gateway sends it, with its full member list and presences.
+def guild_create(g, members, channels, rng):
+    guild_id = str(10**12 + g)
+    users = [{ "id": str(10**9 + rng.randrange(10**6)), "username": f"user{rng.randrange(10**6)}",
+               "discriminator": f"{rng.randrange(10000):04}", "avatar": "0" * 32, "bot": False } for m in range(members)]
+    return { "id": guild_id, "name": f"Guild {g}", "icon": "0" * 32, "splash": None, "owner_id": users[0]['id'],
+             "region": "us-east", "afk_channel_id": None, "afk_timeout": 300, "verification_level": 1,
+             "default_message_notifications": 0, "explicit_content_filter": 0, "mfa_level": 0, "features": [],
+             "joined_at": "2018-01-01T00:00:00", "large": members > 250, "unavailable": False, "member_count": members,
+             "emojis": [], "voice_states": [],
+             "roles": [{ "id": guild_id, "name": "@everyone", "permissions": 104324161, "position": 0, "color": 0,
+                         "hoist": False, "managed": False, "mentionable": False }],
+             "channels": [{ "id": str(int(guild_id) * 100 + c), "type": 0, "name": f"channel-{c}", "position": c,
+                            "topic": None, "nsfw": False, "last_message_id": None, "parent_id": None,
+                            "permission_overwrites": [] } for c in range(channels)],
+             "members": [{ "user": user, "nick": None, "roles": [], "joined_at": "2018-01-01T00:00:00",
+                           "deaf": False, "mute": False } for user in users],
+             "presences": [{ "user": { "id": user['id'] }, "status": rng.choice(["online", "idle", "dnd"]),
+                             "game": None, "roles": [] } for user in users] }
+
+# Memory held by guild_cache against keeping every GUILD_CREATE payload whole, as the bot used
+# to, and member and channel lookups against scanning those payloads.
+def guildcache(guilds=1000, members=250, channels=20, lookups=2000, seed=0):
+    results = {}
+    for name in ("GUILD_CREATE payloads", "guild_cache"):
+        rng = random.Random(seed)
+        gc.collect()
+        tracemalloc.start()
+        if name == "guild_cache":
+            cache = guild_cache(cacheMembers='all', cachePresences=True)
+        else:
+            cache = {}
+        for g in range(guilds):
+            event = json.loads(json.dumps(guild_create(g, members, channels, rng)))
+            if name == "guild_cache":
+                cache.handle('GUILD_CREATE', event)
+            else:
+                cache[event['id']] = event
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Look up members and channels which are in the cache.
+        rng = random.Random(seed)
+        if name == "guild_cache":
+            guild_ids = [str(guild.id) for guild in cache]
+            member_ids = { guild_id: [str(user_id) for user_id in cache[guild_id].members] for guild_id in guild_ids }
+            channel_ids = [str(channel_id) for channel_id in cache.channels]
+        else:
+            guild_ids = list(cache)
+            member_ids = { guild_id: [m['user']['id'] for m in cache[guild_id]['members']] for guild_id in guild_ids }
+            channel_ids = [c['id'] for guild in cache.values() for c in guild['channels']]
+        memberLookups = [(guild_id, rng.choice(member_ids[guild_id])) for guild_id in (rng.choice(guild_ids) for i in range(lookups))]
+        channelLookups = [rng.choice(channel_ids) for i in range(lookups)]
+
+        if name == "guild_cache":
+            get_member = cache.get_member
+            get_channel = cache.get_channel
+        else:
+            def get_member(guild_id, user_id):
+                return next(m for m in cache[guild_id]['members'] if m['user']['id'] == user_id)
+            def get_channel(channel_id):
+                return next(c for guild in cache.values() for c in guild['channels'] if c['id'] == channel_id)
+
+        started = time.perf_counter()
+        assert all(get_member(guild_id, user_id) is not None for guild_id, user_id in memberLookups)
+        memberSeconds = time.perf_counter() - started
+        started = time.perf_counter()
+        assert all(get_channel(channel_id) is not None for channel_id in channelLookups)
+        channelSeconds = time.perf_counter() - started
+
+        results[name] = (memory, memberSeconds / lookups, channelSeconds / lookups)
+        print(f"{name + ':':<24}{memory/1024/1024:8.1f}MB, member lookup {memberSeconds/lookups*1e6:8.2f}us, "
+              f"channel lookup {channelSeconds/lookups*1e6:9.2f}us")
+        cache = None
+    print(f"({guilds} guilds, {members} members and {channels} channels each, every member and presence cached)")
+    return results
+
+# Call func(*args) in a forked process and return its result. Handlers are registered on the
+# classes, so runs which attach their own handlers each get a fresh process.
+def in_child(func, *args):
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    def target():
+        try:
+            sender.send((True, func(*args)))
+        except BaseException as e:
+            sender.send((False, e))
+            raise
+    process = context.Process(target=target)
+    process.start()
+    ok, result = receiver.recv()
+    process.join()
+    if not ok:
+        raise result
+    return result
+
+# replay.run() without its report.
+def quiet_replay(path, gateway, instrument):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(replay.run(path, gateway=gateway, instrument=instrument))
+
+# Events/sec and CPU/event of replay.py runs with and without instrumentation, the median of
+# 'repeat' runs each, alternating so both see the same machine conditions.
+def instrumentation(guilds=100, messages=20000, repeat=5, gateway=False):
+    runs = { True: [], False: [] }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.jsonl")
+        synthesize(path, guilds=guilds, messages=messages)
+        for i in range(repeat):
+            for instrument in (True, False):
+                runs[instrument].append(in_child(quiet_replay, path, gateway, instrument))
+
+    results = {}
+    for instrument in (False, True):
+        eventsPerSecond = statistics.median(r['events_per_second'] for r in runs[instrument])
+        cpuPerEvent = statistics.median(r['cpu_seconds'] / r['events'] for r in runs[instrument])
+        results[instrument] = (eventsPerSecond, cpuPerEvent)
+        print(f"instrument={str(instrument):<6} {eventsPerSecond:8.0f} events/sec, {cpuPerEvent*1e6:5.1f}us CPU/event")
+    print(f"Instrumentation costs {(results[True][1] / results[False][1] - 1):.1%} CPU/event "
+          f"(median of {repeat} {'gateway' if gateway else 'direct'} replays of {guilds} guilds and {messages} events)")
+    return results
+
+# One run of the dispatch benchmark, in a process of its own. Every message is handled by a
+# handler which waits handlerDelay like a slow API call. Returns when each handler started
+# relative to when its message was due, when the last one finished, and the connection's
+# heartbeat latencies and reconnects (a heartbeat which isn't acknowledged in time reconnects).
+def dispatch_run(path, concurrent, speed, handlerDelay, heartbeatInterval, messages):
+    async def run():
+        server = stand_in_server(path, speed, heartbeatInterval=heartbeatInterval)
+        await server.start()
+        bot = discord_bot_connection("benchmark", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl, instrument=True)
+        ch = discord_chat_handler(bot, concurrent=concurrent)
+        started = []
+
+        @ch.match(lambda message: True)
+        async def slow(message):
+            started.append((message.get('guild_id'), message['id'], time.monotonic()))
+            await asyncio.sleep(handlerDelay)
+
+        task = asyncio.ensure_future(bot.start())
+        playback = None     # Playback restarts after a RESUME, messages were due from the first start.
+        while (len(started) < messages or ch.pending) and not task.done():
+            await asyncio.sleep(0.001)
+            playback = playback or server.started
+        finished = time.monotonic()
+        await bot.close()
+        await task
+        await server.stop()
+
+        latencies = [l for group in replay.message_latencies(path, started, playback, speed).values() for l in group]
+        lag = bot.metrics.histograms.get('loop_lag', {}).get('')
+        return { "latencies": latencies, "seconds": finished - playback, "handled": len(started),
+                 "heartbeat_p50": bot.latency_p50, "heartbeat_p99": bot.latency_p99,
+                 "reconnects": len(server.identifies) + len(server.resumes) - 1,
+                 "loop_lag_p99": lag.percentile(99) if lag else None }
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(run())
+
+# Gateway read loop latency and handler throughput with chat handlers awaited inline, one after
+# the other, and scheduled as tasks with discord_chat_handler(concurrent=True). Synthetic
+# MESSAGE_CREATEs arrive at 'speed' times 1000 a second over the stand-in gateway.
+def dispatch(messages=1000, speed=1.0, handlerDelay=0.005, heartbeatInterval=1000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.jsonl")
+        synthesize(path, guilds=10, messages=messages, presences=0)
+        print(f"{messages} messages at {1000*speed:.0f}/s, {handlerDelay*1000:g}ms handlers, heartbeats every {heartbeatInterval}ms:")
+        results = {}
+        for name, concurrent in (("inline", False), ("concurrent", True)):
+            r = results[name] = in_child(dispatch_run, path, concurrent, speed, handlerDelay, heartbeatInterval, messages)
+            heartbeat = f"{r['heartbeat_p50']*1000:.1f}ms p50, {r['heartbeat_p99']*1000:.1f}ms p99" if r['heartbeat_p50'] is not None else "none"
+            print(f"    {name + ':':<12} {r['handled']/r['seconds']:6.0f} messages/s handled, handler start "
+                  f"{replay.percentile(r['latencies'], 50)*1000:7.1f}ms p50 {replay.percentile(r['latencies'], 99)*1000:7.1f}ms p99 "
+                  f"after the message was due")
+            print(f"    {'':<12} heartbeat latency {heartbeat}, {r['reconnects']} reconnects, loop lag p99<={r['loop_lag_p99']}s")
+    return results
+
+# falsebot.py reads its settings from a 'tokens' file in the working directory when imported,
+# so give it a throwaway one.
+def import_falsebot():
+    if 'falsebot' in sys.modules:
+        return sys.modules['falsebot']
+    cwd = os.getcwd()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "tokens"), "w") as f:
+            f.write(json.dumps({"botToken": "benchmark"}))
+        os.chdir(directory)
+        try:
+            return importlib.import_module('falsebot')
+        finally:
+            os.chdir(cwd)
+
+# The per-pixel bandw() and ascii() falsebot.py started with, for comparison.
+def old_bandw(img):
+    size = img.size
+    img=img.getdata()
+
+    bandw = list(map(lambda p: 0.2126*p[0] + 0.7152*p[1] + 0.0722*p[2], img))
+    
+    out = Image.new('L', size)
+    out.putdata(bandw)
+
+    return out
+
+def old_ascii(img, brightchars, **kwargs):
+    img = old_bandw(img)
+    size = img.size
+
+    img = img.resize((int(size[0]/kwargs['downscaling']), int(size[1]/kwargs['downscaling'])))
+    size = img.size
+    img = list(img.getdata())
+    
+    characters = list(map(lambda b: brightchars[b], img))
+
+    asciised = Image.new('RGB', (size[0]*10,size[1]*10), color=kwargs['background'])
+    draw = ImageDraw.Draw(asciised)
+    
+    for y in range(size[1]):
+        for x in range(size[0]):
+            index = y*size[0]+x
+            draw.text((x*10 - 2.5, y*10), characters[index], fill=kwargs['foreground'])
+    
+    return asciised
+
+# A 4:3 test image of roughly 'megapixels' million pixels: colour gradients with noise, so
+# every brightness (and so every ascii character) turns up.
+def test_image(megapixels, seed=0):
+    height = int((megapixels * 1e6 * 3/4) ** 0.5)
+    width = int(height * 4/3)
+    y,x = np.mgrid[0:height, 0:width]
+    noise = np.random.default_rng(seed).integers(0, 64, (height, width, 3))
+    pixels = np.stack([x * 192 // width, y * 192 // height, (x + y) * 96 // (width + height)], axis=-1) + noise
+    return Image.fromarray(pixels.astype(np.uint8), mode='RGB')
+
+# How far apart two images are: the fraction of values that differ, and the largest difference.
+def image_difference(a, b):
+    a = np.asarray(a, dtype=np.int16)
+    b = np.asarray(b, dtype=np.int16)
+    if a.shape != b.shape:
+        return None
+    difference = np.abs(a - b)
+    return np.count_nonzero(difference) / difference.size, int(difference.max())
+
+def time_call(func, *args, **kwargs):
+    started = time.perf_counter()
+    out = func(*args, **kwargs)
+    return time.perf_counter() - started, out
+
+# Time the old per-pixel bandw() and ascii() against the vectorised ones in falsebot.py,
+# and check that they still produce the same images.
+def images(sizes=(1, 12), downscaling=10):
+    falsebot = import_falsebot()
+    options = {"foreground": (255,255,255), "background": (0,0,0), "downscaling": downscaling}
+    results = {}
+    for megapixels in sizes:
+        img = test_image(megapixels)
+        print(f"{megapixels:g}MP ({img.size[0]}x{img.size[1]}):")
+        for name, old, new in (("bandw", lambda: old_bandw(img), lambda: falsebot.bandw(img)),
+                               ("ascii", lambda: old_ascii(img, falsebot.brightchars, **options),
+                                         lambda: falsebot.imageFunctions['ascii'](img, **options))):
+            oldSeconds, oldOut = time_call(old)
+            newSeconds, newOut = time_call(new)
+            difference = image_difference(oldOut, newOut)
+            if difference is None:
+                different = f"sizes differ ({oldOut.size} vs {newOut.size})"
+            else:
+                different = f"{difference[0]:.4%} of values differ, by at most {difference[1]}"
+            print(f"    {name}: {oldSeconds*1000:9.0f}ms -> {newSeconds*1000:7.0f}ms ({oldSeconds/newSeconds:5.1f}x), {different}")
+            results[(megapixels, name)] = (oldSeconds, newSeconds, difference)
+    return results
+
+# A stream of image commands where people keep re-running popular commands on the same few
+# pictures, run through processImage() for every command and through a result_cache in front
+# of it as falsebot.py's image commands do.
+def resultcache(images=5, commands=200, megapixels=0.5, maxBytes=64*1024*1024, seed=0):
+    falsebot = import_falsebot()
+    rng = random.Random(seed)
+    pictures = []
+    for i in range(images):
+        data = falsebot.fileFromImage(test_image(megapixels, seed=i), format="png").getvalue()
+        pictures.append((hashlib.sha256(data).hexdigest(), data))
+    variants = [("bandw", {}), ("ascii", { "foreground": (255,255,255), "background": (0,0,0), "downscaling": 3 }),
+                ("ascii", { "foreground": (255,255,255), "background": (0,0,0), "downscaling": 6 }),
+                ("ascii", { "foreground": (0,255,0), "background": (0,0,0), "downscaling": 3 })]
+    # Popular pictures and commands come up far more often than the rest.
+    stream = [(rng.choices(pictures, weights=[1 / (i + 1) for i in range(len(pictures))])[0],
+               rng.choices(variants, weights=[1 / (i + 1) for i in range(len(variants))])[0]) for i in range(commands)]
+
+    started = time.perf_counter()
+    for (digest, data), (name, kwargs) in stream:
+        falsebot.processImage(name, data, kwargs)
+    uncached = time.perf_counter() - started
+
+    results = result_cache(maxBytes=maxBytes)
+    started = time.perf_counter()
+    for (digest, data), (name, kwargs) in stream:
+        key = result_cache.key(digest, name, kwargs)
+        if results.get(key) is None:
+            results.put(key, falsebot.processImage(name, data, kwargs))
+    cached = time.perf_counter() - started
+
+    stats = results.stats()
+    print(f"{commands} commands over {images} {megapixels:g}MP images and {len(variants)} command variants:")
+    print(f"    without the cache:  {uncached:7.2f}s")
+    print(f"    with the cache:     {cached:7.2f}s ({uncached/cached:.1f}x)")
+    print(f"    hit ratio {stats['hit_ratio']:.0%} ({stats['hits']} hits, {stats['misses']} misses), "
+          f"{stats['bytes_saved']/1024/1024:.1f}MB served from the cache, {stats['bytes']/1024/1024:.1f}MB cached")
+    return uncached, cached, stats
+
+# ^ascii's options, as falsebot.py registers them.
+asciiOptions = {
+        "foreground": {"help":"R,G,B value to use as foreground (Default 255,255,255)",
+                       "default":(255,255,255), "type":lambda x: tuple(map(int, x.split(',') ) )},
+        "background": {"help":"R,G,B value to use as background (Default 0,0,0)",
+                       "default":(0,0,0), "type":lambda x: tuple(map(int, x.split(',') ) )},
+        "downscaling": {"help":"Downscaling factor. (Default 3)",
+                        "default":3, "type":float}
+        }
+
+# What the old argparse based commandWithArgs() decorator did for every invocation, returning
+# the parsed arguments, or the text it would have replied with.
+def old_command_parse(parser, content):
+    args = content.split(" ")[1:]
+    with io.StringIO() as buf, contextlib.redirect_stdout(buf):
+        try:
+            return vars(parser.parse_args(args))
+        except SystemExit:
+            return buf.getvalue()
+
+# Argument parsing throughput of command_parser against the old argparse decorator, over a mix
+# of ^ascii invocations with and without options and the occasional request for help.
+def command_parsing(invocations=100000, seed=0):
+    rng = random.Random(seed)
+    contents = ["^ascii", "^ascii --downscaling 4", "^ascii --foreground 255,0,0 --background 0,0,32",
+                "^ascii --downscaling=2.5 --background 10,10,10", "^ascii --help"]
+    stream = rng.choices(contents, weights=[50, 25, 15, 9, 1], k=invocations)
+
+    parser = argparse.ArgumentParser(description="Convert an image to ASCII art.", conflict_handler='resolve', prog="^ascii")
+    for k,v in asciiOptions.items():
+        parser.add_argument('--' + k, **v)
+    started = time.process_time()
+    old = [old_command_parse(parser, content) for content in stream]
+    oldSeconds = time.process_time() - started
+
+    parser = command_parser("^ascii", "Convert an image to ASCII art.", **asciiOptions)
+    def parse(content):
+        try:
+            return parser.parse(content)
+        except command_error as e:
+            return str(e)
+    started = time.process_time()
+    new = [parse(content) for content in stream]
+    newSeconds = time.process_time() - started
+
+    same = all(a == b for a,b in zip(old, new) if isinstance(a, dict))
+    print(f"{invocations} ^ascii invocations:")
+    print(f"    argparse decorator: {invocations/oldSeconds:9.0f} parses/s")
+    print(f"    command_parser:     {invocations/newSeconds:9.0f} parses/s ({oldSeconds/newSeconds:.0f}x)")
+    print(f"    Same arguments:     {same}")
+    return oldSeconds, newSeconds
+
+# Event loop lag while a batch of ^ascii requests render, with the image function called on the
+# event loop as image commands used to, and through the chat handler's process pool as
+# falsebot.py's imageCommand does now. Lag is sampled every 10ms with instrumentation, and the
+# stalled total is the sum of every sample's lag.
+async def executor(requests=8, megapixels=1, workers=2):
+    falsebot = import_falsebot()
+    data = falsebot.fileFromImage(test_image(megapixels), format="png").getvalue()
+    options = { "foreground": (255,255,255), "background": (0,0,0), "downscaling": 3 }
+    ch = discord_chat_handler(discord_bot_connection("benchmark"), executorWorkers=workers, executorQueue=requests)
+
+    async def inline():
+        await asyncio.sleep(0)
+        return falsebot.processImage("ascii", data, options)
+
+    async def pooled():
+        return await ch.run_in_executor(falsebot.processImage, "ascii", data, options)
+
+    await pooled()      # Start the worker processes.
+    results = {}
+    print(f"{requests} concurrent ^ascii requests on a {megapixels:g}MP image:")
+    for name, render in (("on the event loop", inline), (f"{workers} worker processes", pooled)):
+        metrics = metrics_registry(lagInterval=0.01)
+        sampler = asyncio.ensure_future(metrics.sample_loop_lag())
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        await asyncio.gather(*[render() for i in range(requests)])
+        seconds = time.perf_counter() - started
+        await asyncio.sleep(0.05)
+        sampler.cancel()
+        lag = metrics.histograms['loop_lag']['']
+        results[name] = (seconds, lag.sum, lag.percentile(99))
+        print(f"    {name + ':':<22}{seconds:6.2f}s, loop stalled {lag.sum:6.2f}s in total, "
+              f"lag p50<={lag.percentile(50)}s p99<={lag.percentile(99)}s ({lag.count} samples)")
+    ch.shutdown_executor(wait=True)
+    return results
+
+# Uploads of 'size' bytes of output each, produced and sent by one of:
+#   'FormData'      each output in a BytesIO as fileFromImage() returned it, sent as aiohttp.FormData
+#                   with a session per request, as send_file() used to.
+#   'bytes'         each output as bytes, sent with send_file().
+#   'streamed'      each output produced in chunks as the upload reads it, sent with send_file().
+# Runs in a forked process; returns the growth of its peak RSS in bytes and the seconds taken.
+def upload_files(apiUrl, variant, uploads, size, maxUploads, chunkSize=64*1024):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    chunk = os.urandom(chunkSize)
+
+    def output():
+        return chunk * (size // chunkSize)
+
+    async def chunks():
+        for i in range(size // chunkSize):
+            await asyncio.sleep(0)      # An encoder handing over each chunk as it is written.
+            yield chunk
+
+    async def old_send_file(data):
+        form = aiohttp.FormData()
+        form.add_field('payload_json', json.dumps({}))
+        form.add_field('file', data, filename="out.png", content_type='application/octet-stream')
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{apiUrl}channels/1/messages", data=form) as response:
+                assert 200 == response.status, response.reason
+
+    async def send():
+        started = time.perf_counter()
+        bot = discord_bot_connection("benchmark", apiUrl=apiUrl, maxUploads=maxUploads)
+        if variant == "FormData":
+            await asyncio.gather(*[old_send_file(io.BytesIO(output())) for i in range(uploads)])
+        elif variant == "bytes":
+            await asyncio.gather(*[bot.send_file("1", memoryview(output()), filename="out.png") for i in range(uploads)])
+        else:
+            await asyncio.gather(*[bot.send_file("1", chunks, filename="out.png") for i in range(uploads)])
+        await bot.close_session()
+        return time.perf_counter() - started
+
+    seconds = asyncio.run(send())
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline, seconds
+
+# Peak memory of many concurrent large uploads to the stand-in server for each way of sending
+# them, each in a process of its own while this one runs the server.
+async def uploads(count=50, mb=10, maxUploads=4):
+    server = stand_in_server()
+    await server.start()
+    size = mb * 1024 * 1024
+    loop = asyncio.get_event_loop()
+    results = {}
+    print(f"{count} concurrent {mb}MB uploads, maxUploads={maxUploads}:")
+    for variant in ("FormData", "bytes", "streamed"):
+        received = server.rest_bytes
+        growth, seconds = await loop.run_in_executor(None, in_child, upload_files, server.apiUrl, variant, count, size, maxUploads)
+        received = server.rest_bytes - received
+        results[variant] = (growth, seconds)
+        print(f"    {variant + ':':<10} peak RSS +{growth/1024/1024:7.1f}MB, {seconds:5.2f}s, {received/1024/1024:.0f}MB received")
+    await server.stop()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for FalseBot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("rest", help="REST requests/sec with a session per request and a shared session.")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=10)
+
+    p = commands.add_parser("dispatch", help="Read loop latency with chat handlers awaited inline or run concurrently.")
+    p.add_argument("--messages", type=int, default=1000)
+    p.add_argument("--speed", type=float, default=1.0, help="Multiple of 1000 messages a second.")
+    p.add_argument("--handler-delay", type=float, default=0.005, help="Seconds every handler waits, like a slow API call.")
+    p.add_argument("--heartbeat", type=int, default=1000, help="Heartbeat interval in ms.")
+
+    p = commands.add_parser("images", help="Old and new bandw() and ascii() timings and output differences.")
+    p.add_argument("--sizes", type=float, nargs="+", default=[1, 12], help="Image sizes in megapixels.")
+    p.add_argument("--downscaling", type=float, default=10, help="ascii() downscaling factor.")
+
+    p = commands.add_parser("executor", help="Event loop lag while ^ascii renders on the loop or in the process pool.")
+    p.add_argument("--requests", type=int, default=8)
+    p.add_argument("--megapixels", type=float, default=1)
+    p.add_argument("--workers", type=int, default=2, help="executorWorkers of the chat handler.")
+
+    p = commands.add_parser("compression", help="Gateway bandwidth and CPU with and without zlib-stream compression.")
+    p.add_argument("--guilds", type=int, default=100)
+    p.add_argument("--messages", type=int, default=10000)
+    p.add_argument("--frame-size", type=int, default=4096, help="Largest websocket frame the stand-in gateway sends.")
+
+    p = commands.add_parser("codecs", help="Decode throughput of the json, orjson and etf gateway codecs.")
+    p.add_argument("--guilds", type=int, default=2000)
+    p.add_argument("--messages", type=int, default=20000)
+
+    p = commands.add_parser("matchers", help="find_matches() against evaluating every matcher for every message.")
+    p.add_argument("--commands", type=int, default=500)
+    p.add_argument("--keywords", type=int, default=480)
+    p.add_argument("--patterns", type=int, default=20, help="Regular expression matchers, evaluated for every message either way.")
+    p.add_argument("--messages", type=int, default=10000)
+
+    p = commands.add_parser("buffers", help="Memory and last attachment lookups of channel_buffer against the old dict of lists.")
+    p.add_argument("--channels", type=int, default=100000)
+    p.add_argument("--per-channel", type=int, default=3, help="Messages buffered per channel.")
+
+    p = commands.add_parser("guildcache", help="Memory and lookups of guild_cache against whole GUILD_CREATE payloads.")
+    p.add_argument("--guilds", type=int, default=1000)
+    p.add_argument("--members", type=int, default=250, help="Members per guild.")
+    p.add_argument("--channels", type=int, default=20, help="Channels per guild.")
+    p.add_argument("--lookups", type=int, default=2000)
+
+    p = commands.add_parser("instrumentation", help="replay.py throughput with and without instrumentation.")
+    p.add_argument("--guilds", type=int, default=100)
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--gateway", action="store_true", help="Replay over a websocket through the stand-in gateway.")
+
+    p = commands.add_parser("resultcache", help="Hit ratio and time saved by the image result cache under repeated commands.")
+    p.add_argument("--images", type=int, default=5)
+    p.add_argument("--commands", type=int, default=200)
+    p.add_argument("--megapixels", type=float, default=0.5)
+    p.add_argument("--max-mb", type=float, default=64, help="Memory the result cache may use, in MB.")
+
+    p = commands.add_parser("commands", help="command_parser throughput against the old argparse decorator.")
+    p.add_argument("--invocations", type=int, default=100000)
+
+    p = commands.add_parser("uploads", help="Peak RSS of concurrent large uploads, as send_file() used to and does now.")
+    p.add_argument("--uploads", type=int, default=50)
+    p.add_argument("--mb", type=int, default=10, help="Size of each upload in MB.")
+    p.add_argument("--max-uploads", type=int, default=4, help="maxUploads of the bot.")
+
+    args = parser.parse_args()
+    if args.command == "rest":
+        asyncio.run(rest(args.requests, args.concurrency))
+    elif args.command == "dispatch":
+        dispatch(args.messages, args.speed, args.handler_delay, args.heartbeat)
+    elif args.command == "images":
+        images(args.sizes, args.downscaling)
+    elif args.command == "executor":
+        asyncio.run(executor(args.requests, args.megapixels, args.workers))
+    elif args.command == "compression":
+        asyncio.run(compression(args.guilds, args.messages, args.frame_size))
+    elif args.command == "codecs":
+        codecs(args.guilds, args.messages)
+    elif args.command == "matchers":
+        matchers(args.commands, args.keywords, args.patterns, args.messages)
+    elif args.command == "buffers":
+        buffers(args.channels, args.per_channel)
+    elif args.command == "guildcache":
+        guildcache(args.guilds, args.members, args.channels, args.lookups)
+    elif args.command == "instrumentation":
+        instrumentation(args.guilds, args.messages, args.repeat, args.gateway)
+    elif args.command == "resultcache":
+        resultcache(args.images, args.commands, args.megapixels, int(args.max_mb * 1024 * 1024))
+    elif args.command == "commands":
+        command_parsing(args.invocations)
+    elif args.command == "uploads":
+        asyncio.run(uploads(args.uploads, args.mb, args.max_uploads))
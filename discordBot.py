@@ -1,458 +1,3756 @@
-#    This file is part of FalseBot
-#    Project Home: https://github.com/FalseAscension/FalseBot
-#
-#    FalseBot is free software: you can redistribute it and/or modify
-#    it under the terms of the GNU General Public License as published by
-#    the Free Software Foundation, either version 3 of the License, or
-#    (at your option) any later version.
-#
-#    FalseBot is distributed in the hope that it will be useful,
-#    but WITHOUT ANY WARRANTY; without even the implied warranty of
-#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-#    GNU General Public License for more details.
-#
-#    You should have received a copy of the GNU General Public License
-#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
-
-import json,time,asyncio,aiohttp
-
-apiUrl = "https://discordapp.com/api/"
-
-class opcodes:
-    """ 
-        Discord Gateway API Opcodes
-        See https://discordapp.com/developers/docs/topics/opcodes-and-status-codes#gateway-opcodes 
-    """
-    DISPATCH                = 0
-    HEARTBEAT               = 1
-    IDENTIFY                = 2
-    STATUS_UPDATE           = 3
-    VOICE_STATUS_UPDATE     = 4
-    VOICE_SERVER_PING       = 5
-    RESUME                  = 6
-    RECONNECT               = 7
-    REQUEST_GUILD_MEMBERS   = 8
-    INVALID_SESSION         = 9
-    HELLO                   = 10
-    HEARTBEAT_ACK           = 11
-
-class discord_chat_handler:
-    """
-        A class to be used in conjunction with discord_bot_connection allowing for an easy way
-        to bind chat messages to functions.
-    
-            ch = discord_chat_handler(discord_bot_connection instance, 
-                **kwargs { bufferSize : integer,    The size of the buffer to be used for per-channel chat history.
-                            }
-
-        Function Definitions:
-
-            register_match()    params: matcher,    A function which should return 'true' if the 
-                                                    message matches requirements. See "Matchers" 
-                                                    below.
-                                        func,       The function to bind match to.
-                                        no_self_response,
-                                                    Whether or not this function is allowed to 
-                                                    respond to itself. Defaults True.
-
-                                Place a function and it's matcher function into the match_registry 
-                                tuple.
-
-            match()             params: matcher,    "
-                                        kwargs,     keyword args, sometimes containing
-                                                    no_self_response (see above).
-
-                                Function decorator to pass a decorated function to register_match().
-                                Decorated function will be given a discord message object (https://discordapp.com/developers/docs/resources/channel#message-object)
-                                Matcher is given a message object.
-
-            matchContent()
-                                See above.
-
-                                For convenience passes the matcher just the message content.
-
-            handle_message_create()
-                                params: message,    The message object to be passed by
-                                                    discord_bot_connection
-
-                                Bound to discord_bot_connection dispatch registry for event
-                                "MESSAGE_CREATE". Finds any matchers which match message
-                                contents and execute respective function.
-
-        Matchers:
-
-            A matcher can be any function who returns 'True' when it is passed an appropriate message.
-
-                For example:
-                    re.compile('match').match       When this is called with arguments 'match', 
-                                                    this should return a MatchObject, eg not None.
-                    (lambda x: "foobar" in x)       When this is called with args "foobar" or 
-                                                    "barfoobar" (etc) returns True.
-
-                Matchers are passed a discord 'message' object in the form of a dictionary, unless
-                created by 'matchContent' in which they are passed the message's content for
-                simplicity.
-
-    """
-    
-    channelBuffer = {}
-
-    def __init__(self, bot_connection, **kwargs):
-        bot_connection.register_dispatch('MESSAGE_CREATE',self.handle_message_create)
-        self.bot_connection = bot_connection
-
-        if 'bufferSize' in kwargs:
-            self.bufferSize = kwargs['bufferSize']
-        else:
-            self.bufferSize = 3
-    
-    # Expression registry for matching chat messages. ([MATCHERS],[FUNCTIONS])
-    match_registry = ([], [])
-    def register_match(self, matcher, func, no_self_respond=True):
-        matcher = { "matcher":matcher, "no_self_respond":no_self_respond }
-
-        if matcher in self.match_registry[0]:
-            print(f"WARNING: Chat expression {expression} already registered. Re-registering to {func.__name__}")
-
-        self.match_registry[0].append(matcher)
-        self.match_registry[1].append(asyncio.coroutine(func))
-    
-    # Match a message. Will provide a discord message object to decorated functions
-    # which match.
-    # See https://discordapp.com/developers/docs/resources/channel#message-object
-    def match(self, matcher, **kwargs):
-        no_self_respond = True
-        if 'no_self_respond' in kwargs:
-            no_self_respond = kwargs['no_self_respond']
-
-        def decorator(func):
-            self.register_match(matcher, func, no_self_respond=no_self_respond)
-            return func
-
-        return decorator
-    
-    # Same as match, however only provides the message content.
-    def matchContent(self, matcher, **kwargs):
-        return self.match(lambda m: matcher(m['content']), **kwargs)
-
-    async def handle_message_create(self, message):
-        
-        # If buffering is not disabled, append to the correct channel buffer.
-        if self.bufferSize > 0:
-            if message['channel_id'] not in self.channelBuffer:
-                self.channelBuffer[message['channel_id']] = [None for i in range(self.bufferSize)]
-
-            self.channelBuffer[message['channel_id']].pop(0)
-            self.channelBuffer[message['channel_id']].append(message)
-
-        for i,matcher in enumerate(self.match_registry[0]): # Find a matcher whose return value is not 'None' or 'False' and call it's respective function.
-            if message['author']['id'] == self.bot_connection.user['id'] and matcher['no_self_respond']: # Don't reply to self unless explicity defined in matcher.
-                continue
-            if matcher['matcher'](message):
-                await self.match_registry[1][i](message)
-
-class discord_bot_connection:
-    """
-        Main Discord Bot Connection class.
-
-            bot = discord_bot_connection(botToken)
-
-        Function definitions:
-
-            start()             params: None
-
-                                Asyncio start function.
-                                Run with asyncio.run(bot.start()
-    
-            identify()          params: None
-            
-                                Send an 'IDENTIFY' op code to the websocket with a 'connection 
-                                properties' and an 'update status' object, resulting in the
-                                Bot coming online.
-                                https://discordapp.com/developers/docs/topics/gateway#identify
-
-            heartbeat()         params: heartbeat_interval, interval at which to beat,
-
-                                Sends an OPCODE 1 'HEARTBEAT' payload to the server at the correct
-                                interval in order to maintain connection to the websocket.
-                                Will throw warning if HEARTBEAT_ACK was not received since last
-                                heartbeat.
-
-            handle_message()    params: message,    'message' payload.
-
-                                Deal with incoming websocke messages. Handles incoming messages
-                                with opcodes 1-11 and passes opcode 0 'DISPATCH' to function
-                                'handle_dispatch'.
-                                Calls any user 'message' bindings from the message_registry
-                                object,
-                                See comment within function for implemented messages.
-
-            handle_dispatch()   params: message     'message' payload.
-
-                                Deal with incoming events. These are the bits that carry the
-                                important information. See: 
-                                https://discordapp.com/developers/docs/topics/gateway#commands-and-events
-                                Currently implemented:
-                                    'READY'         -   extract the heartbeat_interval and invoke the
-                                                        heartbeat() function
-                                    'GUILD_CREATE'  -   store the guild information.
-                                Calls any 'dispatch' bindings from the dispatch_registry
-                                object,
-
-            api_get_call()      params: path,       relative path for API to be called.
-                                        **kwargs    passed to the aiohttp client session.
-            
-                                Invoke a call to the Discord RESTful API via method GET and return the
-                                JSON object.
-                                See https://discordapp.com/developers/docs/topics/gateway#get-gateway
-
-            api_post_call()     params: path,       "
-                                        **kwargs    passed to the aiohttp client session.
-
-                                Invoke a call to the Discord RESTful API via method POST and return the 
-                                JSON object.
-
-            say_in_channel()    params: channel_id,  The ID of the channel for which to send the message
-                                        message,    The message to be sent.
-
-                                Send a message to a channel through a Discord RESTful API POST call,
-                                Invokes api_post_call().
-                                See https://discordapp.com/developers/docs/resources/channel#create-message
-
-            register_message()  params: opcode,     OPCODE for which this function should be bound to.
-                                        func,       Function to bind this opcode to.
-
-                                Place a function into the message_registry dict.
-
-            message()           params: opcode,     "
-                                
-                                Function decorator to pass a decorated function to register_message()
-
-            register_dispatch() params: event,      OPCODE 0 DISPATCH event for which this function
-                                                    should be bound to.
-                                        func,       Function to bind this event to.
-
-                                Place a function into the dispatch_registry dict.
-            
-            dispatch()          params: event,      "
-                            
-                                Function decorator to pass a decorated function to register_dispatch()
-    """
-
-    # Some information about the current session
-    user = None             # User bot is running under, we will assign this a value later
-    private_channels = []   # Private message channels
-    guilds = {}             # Guilds bot is a member of. Keyed by ID. Type of 'Guild Object' (https://discordapp.com/developers/docs/resources/guild#guild-object)
-    session_id = None       # Current Session ID of the bot. Used for resuming in case of connection loss (not yet implemented).
-
-
-    APIToken = None
-
-    def __init__(self, botToken, clientID=None, clientSecret=None):
-        self.botToken = botToken
-        self.clientID = clientID
-        self.clientSecret = clientSecret
-        self.userAgent = "FalseBot (Python 3.7 AIOHTTP)"
-    
-    # Register functions to Discord API low-level events.
-    dispatch_registry = {}
-    def register_dispatch(self, event, func):
-        if event in self.dispatch_registry:
-            print(f"WARNING: Dispatch event {event} already registered, re-registering to {func.__name__}")
-        self.dispatch_registry[event] = func
-    
-    # @bot.dispatch(event) decorator
-    def dispatch(self, event):
-        def decorator(func):
-            self.register_dispatch(event, func)
-            return func
-        return decorator 
-
-    # Some bots may also need to know about specific opcodes.
-    message_registry = {}
-    def register_message(self, opcode, func):
-        if opcode in self.message_registry:
-            print(f"WARNING: Opcode {opcode} already registered, re-registering to {func.__name__}")
-        self.message_registry[opcode] = asyncio.coroutine(func)
-    
-    # @bot.message(opcode) decorator
-    def message(self, opcode):
-        def decorator(func):
-            self.register_message(opcode, func)
-            return func
-        return decorator
-
-    # Return the JSON body from a Discord RESTful API GET call.
-    async def api_get_call(self, path, url=apiUrl, **kwargs):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{url}{path}", **kwargs) as response:
-                assert 200 == response.status, response.reason
-                return await response.json()
-
-    # Same as above with a JSON POST payload.
-    async def api_post_call(self, path, **kwargs):
-        headers = {
-                'Authorization': 'Bot ' + self.botToken,
-                'User-Agent': self.userAgent
-                }
-
-        if 'json' in kwargs:
-            headers['Content-Type'] = 'application/json'
-
-        kwargs['headers'] = headers
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{apiUrl}{path}", **kwargs) as response:
-                assert 200 == response.status, response.reason
-                return await response.json()
-    
-
-    # Send a create message command via the Discord RESTful API.
-    async def create_message_async(self, channel_id, **kwargs):
-        await self.api_post_call(f"/channels/{channel_id}/messages",
-                **kwargs
-                )
-    
-    # Callable without await-ing
-    def create_message(self, channel_id, **kwargs):
-        asyncio.get_event_loop().create_task(
-                self.create_message_async(channel_id, **kwargs)
-            )
-
-    def say_in_channel(self, channel_id, message):
-        self.create_message(channel_id, data={'content':message})
-
-    def send_file(self, channel_id, filebuf, filename=None, **kwargs):
-        form = aiohttp.FormData()
-        
-        form.add_field('payload_json', json.dumps(kwargs))
-        form.add_field('file', filebuf, filename=filename, content_type='application/octet-stream')
-
-        self.create_message(channel_id, data=form)
-
-
-    # Send a JSON payload to the server.
-    async def send_payload(self, op, d, s=None, t=None):
-        payload = {"op":op, "d":d, "s":s, "t":t}
-        await self.ws.send_json(payload)
-
-
-    # Heartbeat information
-    ack = True
-    sequence = None
-    
-    # Send a heartbeat to the server at the correct interval.
-    async def heartbeat(self, interval):
-        while True:
-            if not self.ack:                # We did not receive a HEARTBEAT_ACK response. Something is wrong!! (Not yet implemented)
-                print("Fatal Error: Did not receive HEARTBEAT_ACK. Connection is dead.")
-            await self.send_payload(opcodes.HEARTBEAT, self.sequence)
-            self.ack = False                # Reset response marker
-            await asyncio.sleep(interval / 1000)
-
-    # Handle a 'DISPATCH' event.
-    async def handle_dispatch(self, message):
-        eventType = message['t']
-        event = message['d']
-
-        if eventType == 'READY':
-            if self.session_id:
-                print("WARNING: Received repeat 'READY' Event although session is already running.")
-
-            self.user = event['user']
-            self.session_id = event['session_id']
-            for g in event['guilds']:
-                self.guilds[g['id']] = g     # Store guild using it's ID as a key.
-            print("My username is %s" % self.user['username'])
-            print("I am in %i guilds" % len(event['guilds']))
-
-        elif eventType == 'GUILD_CREATE': # Server has made a guild available to us. Store it.
-            gid = event['id']
-            if not self.guilds[gid]['unavailable']:
-                print(f"WARNING: Received repeat GUILD_CREATE event for guild id {gid} ({guild['name']})")
-            self.guilds[gid] = event
-        
-        # Pass off to any function registered for this event by registrar.
-        if eventType in self.dispatch_registry:
-            await self.dispatch_registry[eventType](event)
-
-    async def handle_message(self, message):
-        """
-            Called for every message received by websocket connection.
-            Message types are defined by 'https://discordapp.com/developers/docs/topics/opcodes-and-status-codes#gateway-opcodes'
-            We must process these messages and respond appropriately.
-
-            DISPATCH:           These are the messages which hold the "real" data. we'll hand this off to the dispatch_handler function
-                                to keep it clean.
-            HEARTBEAT:          Sent every given interval by the server. API documentation doesn't specify what to do, pass.
-            RECONNECT:          We must disconnect and reconnect to the gateway for a given reason. Not yet implemented.
-            INVALID_SESSION:    Notify us the session ID is invalid. Not yet implemented.
-            HELLO:              Received immediately after connecting. Contains crucial heartbeat_interval information.
-            HEARTBEAT_ACK:      Must be received in between every heartbeat message we send. Some is wrong if we don't.
-        """
-        opcode = message['op']
-
-        if opcode == opcodes.DISPATCH:              # Message was a 'DISPATCH' event. Hand it over to the dispatch_handler...
-            sequence = message['s']                 # Sequence number used for heartbeat message.
-            await self.handle_dispatch(message)
-
-        elif opcode == opcodes.HEARTBEAT:
-            pass
-
-        elif opcode == opcodes.RECONNECT:
-            pass
-
-        elif opcode == opcodes.INVALID_SESSION:
-            pass
-
-        elif opcode == opcodes.HELLO:               # Connection successful. Invoke the heartbeat function
-            interval = message['d']['heartbeat_interval']
-            print(f"HELLO received, heartbeat_interval set to {interval}")
-            asyncio.ensure_future(self.heartbeat(interval))
-
-        elif opcode == opcodes.HEARTBEAT_ACK:       # Mark heartbeat response as received
-            self.ack = True
-
-        else:                                       # Unknown opcode.
-            print(f"WARNING: Unknown op code {op}")
-
-        # Pass off to any function registered for this opcode by registrar.
-        if opcode in self.message_registry:
-            await self.message_registry[opcode](message)
-
-
-    # Send an IDENTIFY payload (https://discordapp.com/developers/docs/topics/gateway#identifying)
-    async def identify(self):
-        payload = { "token":        self.botToken,
-                    "properties":   {
-                        "$os":          "linux",
-                        "$browser":     "aiohttp",
-                        "$device":      "aiohttp"
-                        },
-                    "compress":     False,
-                    "presence":     {
-                        "since":        time.time(),
-                        "status":       "online",
-                        "afk":          False
-                        } }
-        await self.send_payload(opcodes.IDENTIFY, payload)            
-
-    async def start(self):
-        #response = await self.api_post_call("/oauth2/token", params={'grant_type':'client_credentials', 'scope':'identify bot'}, auth=aiohttp.BasicAuth(self.clientID, self.clientSecret))
-        #self.APIToken = response['access_token']
-
-        response = await self.api_get_call("/gateway/bot", headers={"Authorization":"Bot " + self.botToken}, url="https://discordapp.com/api/")
-        gatewayUrl = response['url']
-        async with aiohttp.ClientSession() as session:
-            async with session.ws_connect(f"{gatewayUrl}?v=6&encoding=json") as self.ws:
-                await self.identify()
-                async for msg in self.ws:
-                    await self.handle_message(msg.json())
-
-# Main program
-async def main():
-    bot = discordBot(botToken)
-    ws = await bot.start()
-
-if __name__ == "__main__":
-    asyncio.run(main())
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+import json,time,asyncio,aiohttp,re,zlib,struct,random,multiprocessing,itertools,sys,bisect,hashlib,os,pickle,functools,inspect
+from collections import OrderedDict,deque
+from concurrent.futures import ProcessPoolExecutor
+
+# orjson is optional, we fall back to the standard library json module without it.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+apiUrl = "https://discordapp.com/api/"
+
+# Registered handlers may be plain functions or coroutine functions; make them all awaitable.
+# As asyncio.coroutine() did (it was removed in Python 3.11), whatever a plain function returns
+# is awaited if it is awaitable.
+def as_coroutine(func):
+    if asyncio.iscoroutinefunction(func):
+        return func
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+    return wrapper
+
+class opcodes:
+    """ 
+        Discord Gateway API Opcodes
+        See https://discordapp.com/developers/docs/topics/opcodes-and-status-codes#gateway-opcodes 
+    """
+    DISPATCH                = 0
+    HEARTBEAT               = 1
+    IDENTIFY                = 2
+    STATUS_UPDATE           = 3
+    VOICE_STATUS_UPDATE     = 4
+    VOICE_SERVER_PING       = 5
+    RESUME                  = 6
+    RECONNECT               = 7
+    REQUEST_GUILD_MEMBERS   = 8
+    INVALID_SESSION         = 9
+    HELLO                   = 10
+    HEARTBEAT_ACK           = 11
+
+class intents:
+    """
+        Discord Gateway Intents, sent with IDENTIFY to choose which events the gateway sends.
+        See https://discord.com/developers/docs/topics/gateway#gateway-intents
+
+        GUILD_MEMBERS and GUILD_PRESENCES are privileged and must be enabled for the bot in the
+        developer portal, otherwise the gateway closes the connection with code 4014.
+    """
+    GUILDS                      = 1 << 0
+    GUILD_MEMBERS               = 1 << 1
+    GUILD_BANS                  = 1 << 2
+    GUILD_EMOJIS                = 1 << 3
+    GUILD_INTEGRATIONS          = 1 << 4
+    GUILD_WEBHOOKS              = 1 << 5
+    GUILD_INVITES               = 1 << 6
+    GUILD_VOICE_STATES          = 1 << 7
+    GUILD_PRESENCES             = 1 << 8
+    GUILD_MESSAGES              = 1 << 9
+    GUILD_MESSAGE_REACTIONS     = 1 << 10
+    GUILD_MESSAGE_TYPING        = 1 << 11
+    DIRECT_MESSAGES             = 1 << 12
+    DIRECT_MESSAGE_REACTIONS    = 1 << 13
+    DIRECT_MESSAGE_TYPING       = 1 << 14
+
+    # DISPATCH event: intents which make the gateway send it.
+    events = {
+            'GUILD_CREATE':                 GUILDS,
+            'GUILD_UPDATE':                 GUILDS,
+            'GUILD_DELETE':                 GUILDS,
+            'GUILD_ROLE_CREATE':            GUILDS,
+            'GUILD_ROLE_UPDATE':            GUILDS,
+            'GUILD_ROLE_DELETE':            GUILDS,
+            'CHANNEL_CREATE':               GUILDS,
+            'CHANNEL_UPDATE':               GUILDS,
+            'CHANNEL_DELETE':               GUILDS,
+            'CHANNEL_PINS_UPDATE':          GUILDS | DIRECT_MESSAGES,
+            'GUILD_MEMBER_ADD':             GUILD_MEMBERS,
+            'GUILD_MEMBER_UPDATE':          GUILD_MEMBERS,
+            'GUILD_MEMBER_REMOVE':          GUILD_MEMBERS,
+            'GUILD_BAN_ADD':                GUILD_BANS,
+            'GUILD_BAN_REMOVE':             GUILD_BANS,
+            'GUILD_EMOJIS_UPDATE':          GUILD_EMOJIS,
+            'GUILD_INTEGRATIONS_UPDATE':    GUILD_INTEGRATIONS,
+            'WEBHOOKS_UPDATE':              GUILD_WEBHOOKS,
+            'INVITE_CREATE':                GUILD_INVITES,
+            'INVITE_DELETE':                GUILD_INVITES,
+            'VOICE_STATE_UPDATE':           GUILD_VOICE_STATES,
+            'PRESENCE_UPDATE':              GUILD_PRESENCES,
+            'MESSAGE_CREATE':               GUILD_MESSAGES | DIRECT_MESSAGES,
+            'MESSAGE_UPDATE':               GUILD_MESSAGES | DIRECT_MESSAGES,
+            'MESSAGE_DELETE':               GUILD_MESSAGES | DIRECT_MESSAGES,
+            'MESSAGE_DELETE_BULK':          GUILD_MESSAGES,
+            'MESSAGE_REACTION_ADD':         GUILD_MESSAGE_REACTIONS | DIRECT_MESSAGE_REACTIONS,
+            'MESSAGE_REACTION_REMOVE':      GUILD_MESSAGE_REACTIONS | DIRECT_MESSAGE_REACTIONS,
+            'MESSAGE_REACTION_REMOVE_ALL':  GUILD_MESSAGE_REACTIONS | DIRECT_MESSAGE_REACTIONS,
+            'TYPING_START':                 GUILD_MESSAGE_TYPING | DIRECT_MESSAGE_TYPING
+            }
+
+    # Intents for a collection of DISPATCH event names. GUILDS is always included, as the
+    # connection relies on GUILD_CREATE.
+    @classmethod
+    def for_events(cls, events):
+        value = cls.GUILDS
+        for event in events:
+            value |= cls.events.get(event, 0)
+        return value
+
+class buffered_message:
+    """
+        The parts of a message object kept in a channel_buffer. attachments is a tuple of
+        (attachment id, url) pairs.
+    """
+    __slots__ = ('id', 'channel_id', 'author_id', 'content', 'attachments', 'size')
+
+    overhead = 200          # Rough bytes per record excluding strings, for the memory budget.
+
+    def __init__(self, message):
+        self.id = message['id']
+        self.channel_id = message['channel_id']
+        self.author_id = message['author']['id']
+        self.content = message['content']
+        self.attachments = tuple((a['id'], a['url']) for a in message['attachments']) if message.get('attachments') else ()
+        self.size = self.overhead + len(self.content) + sum(len(url) for i,url in self.attachments)
+
+class channel_buffer:
+    """
+        Recent message history per channel, bounded both per channel and in total.
+
+            buf = channel_buffer(bufferSize=3, maxBytes=64*1024*1024)
+
+        Each channel keeps its last bufferSize messages as buffered_message records in a ring
+        buffer. Once the estimated size of all records passes maxBytes, the channels which have
+        been quiet the longest are forgotten. The most recent message with an attachment is
+        indexed per channel for as long as it is in the channel's buffer.
+
+        Function Definitions:
+
+            append()            params: message,    message object.
+
+                                Add a message to its channel's buffer, returns the record.
+
+            last_attachment()   params: channel_id
+
+                                Return the most recent buffered message with an attachment, or None.
+
+            copy()              params: None
+
+                                Return a copy which later appends don't change, for snapshots.
+
+            stats()             params: None
+
+                                Return a dict of channel, message and byte counts.
+
+        buf[channel_id] returns the channel's records, oldest first.
+    """
+
+    def __init__(self, bufferSize=3, maxBytes=64*1024*1024):
+        self.bufferSize = bufferSize
+        self.maxBytes = maxBytes
+        self.channels = OrderedDict()   # channel_id: deque of buffered_message, least recently active first.
+        self.attachments = {}           # channel_id: most recent buffered_message with an attachment.
+        self.size = 0
+        self.evictions = 0
+
+    def __contains__(self, channel_id):
+        return channel_id in self.channels
+
+    def __getitem__(self, channel_id):
+        return self.channels[channel_id]
+
+    def __len__(self):
+        return len(self.channels)
+
+    def append(self, message):
+        record = buffered_message(message)
+        channel_id = record.channel_id
+
+        if channel_id in self.channels:
+            buf = self.channels[channel_id]
+            self.channels.move_to_end(channel_id)
+        else:
+            buf = self.channels[channel_id] = deque(maxlen=self.bufferSize)
+
+        if len(buf) == buf.maxlen:      # The oldest message is about to fall out of the buffer.
+            old = buf[0]
+            self.size -= old.size
+            if self.attachments.get(channel_id) is old:
+                del self.attachments[channel_id]
+
+        buf.append(record)
+        self.size += record.size
+        if record.attachments:
+            self.attachments[channel_id] = record
+
+        while self.size > self.maxBytes and len(self.channels) > 1:
+            self.evict()
+        return record
+
+    # Forget the least recently active channel.
+    def evict(self):
+        channel_id, buf = self.channels.popitem(last=False)
+        self.size -= sum(record.size for record in buf)
+        self.attachments.pop(channel_id, None)
+        self.evictions += 1
+
+    def last_attachment(self, channel_id):
+        return self.attachments.get(channel_id)
+
+    # A copy for snapshots. Buffered messages are never changed, so they are shared.
+    def copy(self):
+        buf = channel_buffer(self.bufferSize, self.maxBytes)
+        buf.channels = OrderedDict((channel_id, deque(messages, maxlen=messages.maxlen)) for channel_id,messages in self.channels.items())
+        buf.attachments = self.attachments.copy()
+        buf.size = self.size
+        buf.evictions = self.evictions
+        return buf
+
+    def stats(self):
+        return {
+                "channels":     len(self.channels),
+                "messages":     sum(len(buf) for buf in self.channels.values()),
+                "bytes":        self.size,
+                "evictions":    self.evictions
+                }
+
+class command_error(ValueError):
+    """
+        Raised by command_parser.parse() when a command can't be run as given. The message is the
+        text to reply with: usage and the problem, or the full help text when help was asked for.
+    """
+
+class command_parser:
+    """
+        Parses the arguments of a chat command. Everything is worked out once when the command is
+        registered, so parsing a message is a tokenizing pass and a dict lookup per argument.
+
+            parser = command_parser(name, description,
+                **options { option : { help : string,       Help text for the option.
+                                       default : any,       Value when the option is not given. (Default None)
+                                       type : callable,     Converts the option's text to its value. (Default str)
+                                       choices : iterable,  Allowed values, after conversion.
+                                       action : "store_true",
+                                                            Makes the option a flag taking no value.
+                                       } })
+
+        Options are given as '--option value', '--option=value' or, for flags, '--option'. Values
+        may be quoted with single or double quotes to include spaces. '-h' or '--help' asks for
+        the help text.
+
+        Function Definitions:
+
+            tokenize()          params: text
+
+                                Split text into words, honouring quotes.
+
+            parse()             params: content,    The full message content, including the command name.
+
+                                Return a dict of option: value for every option. Raises command_error
+                                with a reply for help requests and bad arguments.
+
+            usage, help
+                                Precomputed usage line and full help text.
+    """
+
+    token_pattern = re.compile(r"""(?:[^\s"']+|"[^"]*"|'[^']*'|["'])+""")
+    quote_pattern = re.compile(r""""([^"]*)"|'([^']*)'""")
+
+    def __init__(self, name, description="", **options):
+        self.name = name
+        self.description = description
+        self.defaults = {}
+        self.converters = {}    # option: (type, choices or None, takes a value)
+        self.choices = {}       # option: choices in the order given, for error messages.
+        for option,spec in options.items():
+            flag = spec.get('action') == "store_true"
+            self.defaults[option] = spec.get('default', False if flag else None)
+            choices = frozenset(spec['choices']) if 'choices' in spec else None
+            if choices is not None:
+                self.choices[option] = list(spec['choices'])
+            self.converters[option] = (spec.get('type', str), choices, not flag)
+
+        words = [f"[--{o}]" if not takes else f"[--{o} {o.upper()}]" for o,(t,c,takes) in self.converters.items()]
+        self.usage = " ".join(["usage:", name] + words)
+
+        lines = [self.usage, ""]
+        if description:
+            lines += [description, ""]
+        lines.append("options:")
+        lines.append(f"  {'-h, --help':<30}show this help message")
+        for option,spec in options.items():
+            flag = f"--{option}" if not self.converters[option][2] else f"--{option} {option.upper()}"
+            lines.append(f"  {flag:<30}{spec.get('help', '')}".rstrip())
+        self.help = "\n".join(lines)
+
+    def tokenize(self, text):
+        return [self.quote_pattern.sub(r"\1\2", t) if '"' in t or "'" in t else t
+                    for t in self.token_pattern.findall(text)]
+
+    def error(self, text):
+        return command_error(f"{self.usage}\n{self.name}: error: {text}")
+
+    def parse(self, content):
+        args = dict(self.defaults)
+        tokens = iter(self.tokenize(content)[1:])   # The first word is the command name.
+        for token in tokens:
+            if token in ("-h", "--help"):
+                raise command_error(self.help)
+            if not token.startswith("--"):
+                raise self.error(f"unrecognized arguments: {token}")
+
+            option, equals, value = token[2:].partition("=")
+            if option not in self.converters:
+                raise self.error(f"unrecognized arguments: {token}")
+            convert, choices, takes = self.converters[option]
+
+            if not takes:
+                if equals:
+                    raise self.error(f"argument --{option}: ignored explicit argument '{value}'")
+                args[option] = True
+                continue
+            if not equals:
+                value = next(tokens, None)
+                if value is None:
+                    raise self.error(f"argument --{option}: expected one argument")
+
+            try:
+                value = convert(value)
+            except (ValueError, TypeError):
+                raise self.error(f"argument --{option}: invalid value: '{value}'")
+            if choices is not None and value not in choices:
+                raise self.error(f"argument --{option}: invalid choice: '{value}' (choose from {', '.join(map(str, self.choices[option]))})")
+            args[option] = value
+        return args
+
+class discord_chat_handler:
+    """
+        A class to be used in conjunction with discord_bot_connection allowing for an easy way
+        to bind chat messages to functions.
+    
+            ch = discord_chat_handler(discord_bot_connection instance, 
+                **kwargs { bufferSize : integer,    The size of the buffer to be used for per-channel chat history.
+                           bufferBytes : integer,   Memory budget for the history of all channels, see
+                                                    channel_buffer. (Default 64MB)
+                           concurrent : boolean,    Schedule matched functions as tasks rather than awaiting
+                                                    them one after the other. Defaults False.
+                           maxConcurrency : integer,
+                                                    Maximum number of functions running at once. (Default 64)
+                           maxChannelConcurrency : integer,
+                                                    Maximum number of functions running at once per channel. (Default 4)
+                           maxPending : integer,    Maximum number of scheduled functions (running or waiting).
+                                                    Matches beyond this are dropped with a warning, so the
+                                                    gateway read loop is never blocked. (Default 1024)
+                           handlerTimeout : float,  Default timeout in seconds for each function, None for no
+                                                    timeout. (Default None)
+                           executorWorkers : integer,
+                                                    Number of worker processes for run_in_executor(). (Default 2)
+                           executorTimeout : float, Timeout in seconds for each executor job. (Default 30)
+                           executorQueue : integer, Maximum number of executor jobs queued or running. (Default 16)
+                            }
+
+        Function Definitions:
+
+            register_match()    params: matcher,    A function which should return 'true' if the 
+                                                    message matches requirements. See "Matchers" 
+                                                    below.
+                                        func,       The function to bind match to.
+                                        no_self_response,
+                                                    Whether or not this function is allowed to 
+                                                    respond to itself. Defaults True.
+                                        timeout,    Timeout in seconds for this function in concurrent
+                                                    mode. Defaults to handlerTimeout.
+
+                                Place a function and it's matcher function into the match_registry 
+                                tuple.
+
+            match()             params: matcher,    "
+                                        kwargs,     keyword args, sometimes containing
+                                                    no_self_response (see above).
+
+                                Function decorator to pass a decorated function to register_match().
+                                Decorated function will be given a discord message object (https://discordapp.com/developers/docs/resources/channel#message-object)
+                                Matcher is given a message object.
+
+            matchContent()
+                                See above.
+
+                                For convenience passes the matcher just the message content.
+
+            register_command()  params: name,       Command name, eg. '^ascii'.
+                                        func,       The function to bind the command to.
+                                        no_self_respond, timeout,
+                                                    See register_match().
+
+                                Bind a function to messages whose first word is exactly 'name'.
+                                Commands are looked up in a dict, so they cost the same however
+                                many are registered.
+
+            matchCommand()      params: name,       "
+                                        kwargs,     See match().
+
+                                Function decorator to pass a decorated function to register_command().
+
+            register_command_with_args()
+                                params: name,       Command name, eg. '^ascii'.
+                                        func,       The function to bind the command to.
+                                        description,
+                                                    Description shown in the command's help.
+                                        options,    Dict of option specifications, see command_parser.
+                                        no_self_respond, timeout,
+                                                    See register_match().
+
+                                Bind a function to a command with options. The function is called as
+                                func(message, **options). Help requests and bad arguments are answered
+                                in the channel with the command's usage instead of calling it.
+
+            commandWithArgs()   params: name, description,
+                                        kwargs,     Options (see command_parser), plus no_self_respond
+                                                    and timeout.
+
+                                Function decorator to pass a decorated function to
+                                register_command_with_args().
+
+            register_keyword()  params: keyword,    Text to look for, case insensitive.
+                                        func,       The function to bind the keyword to.
+                                        no_self_respond, timeout,
+                                                    See register_match().
+
+                                Bind a function to messages containing 'keyword' anywhere. All
+                                keywords are found with a single combined regular expression over
+                                the lowercased message.
+
+            matchKeyword()      params: keyword,    "
+                                        kwargs,     See match().
+
+                                Function decorator to pass a decorated function to register_keyword().
+
+            handle_message_create()
+                                params: message,    The message object to be passed by
+                                                    discord_bot_connection
+
+                                Bound to discord_bot_connection dispatch registry for event
+                                "MESSAGE_CREATE". Finds any commands, keywords and matchers which
+                                match message contents and execute respective functions, in the
+                                order they were registered.
+                                In concurrent mode functions are scheduled with schedule_handler()
+                                and this returns as soon as matching is done.
+
+            schedule_handler()  params: func,       The function to schedule.
+                                        message,    The message object.
+                                        timeout,    Timeout in seconds or None.
+
+                                Start run_handler() as a task. Drops the call with a warning once
+                                maxPending functions are outstanding.
+
+            run_handler()       params: func,       The function to run.
+                                        message,    The message object.
+                                        timeout,    Timeout in seconds or None.
+
+                                Run a matched function within the global and per-channel
+                                concurrency limits. Timeouts and exceptions are logged, not raised.
+
+            run_in_executor()   params: func,       A picklable (module level) function.
+                                        *args       passed to func.
+
+                                Run a CPU bound function in the chat handler's process pool and
+                                return its result, without blocking the event loop. Raises
+                                asyncio.QueueFull if executorQueue jobs are already outstanding and
+                                asyncio.TimeoutError if the job takes longer than executorTimeout.
+
+            shutdown_executor() params: wait = False
+
+                                Shut down the process pool, if one was started. With wait, block
+                                until the worker processes have exited.
+
+            stats()             params: None
+
+                                Return a dict of dispatch counters for concurrent mode.
+
+        Matchers:
+
+            A matcher can be any function who returns 'True' when it is passed an appropriate message.
+
+                For example:
+                    re.compile('match').match       When this is called with arguments 'match', 
+                                                    this should return a MatchObject, eg not None.
+                    (lambda x: "foobar" in x)       When this is called with args "foobar" or 
+                                                    "barfoobar" (etc) returns True.
+
+                Matchers are passed a discord 'message' object in the form of a dictionary, unless
+                created by 'matchContent' in which they are passed the message's content for
+                simplicity.
+
+                Every matcher is called for every message, so prefer matchCommand() and
+                matchKeyword() where they fit.
+
+    """
+    
+    def __init__(self, bot_connection, **kwargs):
+        bot_connection.register_dispatch('MESSAGE_CREATE',self.handle_message_create)
+        self.bot_connection = bot_connection
+
+        if 'bufferSize' in kwargs:
+            self.bufferSize = kwargs['bufferSize']
+        else:
+            self.bufferSize = 3
+
+        # Recent messages per channel. See channel_buffer.
+        self.channelBuffer = channel_buffer(self.bufferSize, kwargs['bufferBytes'] if 'bufferBytes' in kwargs else 64*1024*1024)
+        bot_connection.register_snapshot('channelBuffer', lambda: self.channelBuffer.copy(), self.restore_channel_buffer)
+
+        # Concurrent dispatch settings.
+        self.concurrent = kwargs['concurrent'] if 'concurrent' in kwargs else False
+        self.maxConcurrency = kwargs['maxConcurrency'] if 'maxConcurrency' in kwargs else 64
+        self.maxChannelConcurrency = kwargs['maxChannelConcurrency'] if 'maxChannelConcurrency' in kwargs else 4
+        self.maxPending = kwargs['maxPending'] if 'maxPending' in kwargs else 1024
+        self.handlerTimeout = kwargs['handlerTimeout'] if 'handlerTimeout' in kwargs else None
+
+        self.semaphore = None       # Created lazily so it binds to the running event loop.
+        self.channelSemaphores = {} # channel_id: [semaphore, users]
+        self.pending = 0
+        self.completed = 0
+        self.dropped = 0
+        self.timedOut = 0
+        self.failed = 0
+
+        # Process pool for CPU bound work, eg. image processing.
+        self.executorWorkers = kwargs['executorWorkers'] if 'executorWorkers' in kwargs else 2
+        self.executorTimeout = kwargs['executorTimeout'] if 'executorTimeout' in kwargs else 30
+        self.executorQueue = kwargs['executorQueue'] if 'executorQueue' in kwargs else 16
+        self.executor = None        # Started on first use.
+        self.executorJobs = 0
+    
+    # Take over the channel buffer from a snapshot, keeping the limits this handler was created with.
+    def restore_channel_buffer(self, buf):
+        buf.bufferSize = self.channelBuffer.bufferSize
+        buf.maxBytes = self.channelBuffer.maxBytes
+        self.channelBuffer = buf
+
+    # Registration order of every command, keyword and matcher, so matched functions run in
+    # the order they were registered whichever registry they are in.
+    match_index = itertools.count()
+
+    # Expression registry for matching chat messages. ([MATCHERS],[FUNCTIONS])
+    match_registry = ([], [])
+    def register_match(self, matcher, func, no_self_respond=True, timeout=None):
+        if any(m['matcher'] is matcher for m in self.match_registry[0]):
+            print(f"WARNING: Chat expression {matcher} already registered. Re-registering to {func.__name__}")
+
+        matcher = { "matcher":matcher, "no_self_respond":no_self_respond, "timeout":timeout, "index":next(self.match_index) }
+
+        self.match_registry[0].append(matcher)
+        self.match_registry[1].append(as_coroutine(func))
+
+    # Command registry. { name: [(MATCHER, FUNCTION)] }
+    command_registry = {}
+    def register_command(self, name, func, no_self_respond=True, timeout=None):
+        matcher = { "matcher":name, "no_self_respond":no_self_respond, "timeout":timeout, "index":next(self.match_index) }
+        self.command_registry.setdefault(name, []).append((matcher, as_coroutine(func)))
+
+    def matchCommand(self, name, **kwargs):
+        def decorator(func):
+            self.register_command(name, func, **kwargs)
+            return func
+        return decorator
+
+    # Parsers of commands registered with options. { name: command_parser }
+    command_parsers = {}
+    def register_command_with_args(self, name, func, description="", options={}, no_self_respond=True, timeout=None):
+        parser = command_parser(name, description, **options)
+        self.command_parsers[name] = parser
+        func = as_coroutine(func)
+
+        async def command(message):
+            try:
+                args = parser.parse(message['content'])
+            except command_error as e:
+                return self.bot_connection.say_in_channel(message['channel_id'], f"```{e}```")
+            return await func(message, **args)
+        command.__name__ = func.__name__
+
+        self.register_command(name, command, no_self_respond=no_self_respond, timeout=timeout)
+
+    def commandWithArgs(self, name, description="", **kwargs):
+        settings = { k: kwargs.pop(k) for k in ('no_self_respond', 'timeout') if k in kwargs }
+        def decorator(func):
+            self.register_command_with_args(name, func, description, kwargs, **settings)
+            return func
+        return decorator
+
+    # Keyword registry. { keyword: [(MATCHER, FUNCTION)] }
+    keyword_registry = {}
+    keyword_pattern = None  # Combined expression for every keyword, see compile_keywords().
+    keyword_contains = {}   # keyword: every registered keyword it contains, including itself.
+    def register_keyword(self, keyword, func, no_self_respond=True, timeout=None):
+        keyword = keyword.lower()
+        matcher = { "matcher":keyword, "no_self_respond":no_self_respond, "timeout":timeout, "index":next(self.match_index) }
+        self.keyword_registry.setdefault(keyword, []).append((matcher, as_coroutine(func)))
+        self.compile_keywords()
+
+    def matchKeyword(self, keyword, **kwargs):
+        def decorator(func):
+            self.register_keyword(keyword, func, **kwargs)
+            return func
+        return decorator
+
+    # Build one expression which finds every keyword in a single pass. The zero-width lookahead
+    # tries every position in the message and the longest keyword there is captured; shorter
+    # keywords it contains are found through keyword_contains.
+    @classmethod
+    def compile_keywords(cls):
+        keywords = sorted(cls.keyword_registry, key=len, reverse=True)
+        cls.keyword_pattern = re.compile("(?=(" + "|".join(map(re.escape, keywords)) + "))")
+        cls.keyword_contains = { k: [other for other in keywords if other in k] for k in keywords }
+
+    # Find every registered function matching a message, in registration order.
+    def find_matches(self, message):
+        matches = []
+        content = message['content']
+
+        if self.command_registry and content:
+            words = content.split(None, 1)
+            if words and words[0] in self.command_registry:
+                matches.extend(self.command_registry[words[0]])
+
+        if self.keyword_pattern is not None and content:
+            found = set()
+            for m in self.keyword_pattern.finditer(content.lower()):  # Case folding is done once per message.
+                found.update(self.keyword_contains[m.group(1)])
+            for keyword in found:
+                matches.extend(self.keyword_registry[keyword])
+
+        for i,matcher in enumerate(self.match_registry[0]): # Find a matcher whose return value is not 'None' or 'False'.
+            if matcher['matcher'](message):
+                matches.append((matcher, self.match_registry[1][i]))
+
+        if len(matches) > 1:
+            matches.sort(key=lambda m: m[0]['index'])
+        return matches
+    
+    # Match a message. Will provide a discord message object to decorated functions
+    # which match.
+    # See https://discordapp.com/developers/docs/resources/channel#message-object
+    def match(self, matcher, **kwargs):
+        no_self_respond = True
+        if 'no_self_respond' in kwargs:
+            no_self_respond = kwargs['no_self_respond']
+        timeout = kwargs['timeout'] if 'timeout' in kwargs else None
+
+        def decorator(func):
+            self.register_match(matcher, func, no_self_respond=no_self_respond, timeout=timeout)
+            return func
+
+        return decorator
+    
+    # Same as match, however only provides the message content.
+    def matchContent(self, matcher, **kwargs):
+        return self.match(lambda m: matcher(m['content']), **kwargs)
+
+    async def handle_message_create(self, message):
+        
+        # If buffering is not disabled, append to the correct channel buffer.
+        if self.bufferSize > 0:
+            self.channelBuffer.append(message)
+
+        from_self = message['author']['id'] == self.bot_connection.user['id']
+        for matcher,func in self.find_matches(message):
+            if from_self and matcher['no_self_respond']: # Don't reply to self unless explicity defined in matcher.
+                continue
+            if self.concurrent:
+                self.schedule_handler(func, message, matcher['timeout'])
+            elif self.bot_connection.metrics is not None:
+                await self.bot_connection.metrics.timed('handler', func.__name__, func(message))
+            else:
+                await func(message)
+
+    # Schedule a matched function as a task. Never blocks; once maxPending functions are
+    # outstanding further matches are dropped instead of holding up the gateway read loop.
+    def schedule_handler(self, func, message, timeout=None):
+        if self.pending >= self.maxPending:
+            self.dropped += 1
+            print(f"WARNING: {self.pending} chat handlers pending, dropping {func.__name__} for message {message['id']}")
+            return None
+
+        self.pending += 1
+        return asyncio.ensure_future(self.run_handler(func, message, timeout))
+
+    async def run_handler(self, func, message, timeout=None):
+        if timeout is None:
+            timeout = self.handlerTimeout
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+
+        channel_id = message['channel_id']
+        if channel_id not in self.channelSemaphores:
+            self.channelSemaphores[channel_id] = [asyncio.Semaphore(self.maxChannelConcurrency), 0]
+        channel = self.channelSemaphores[channel_id]
+        channel[1] += 1
+
+        try:
+            async with channel[0], self.semaphore:
+                call = func(message)
+                if self.bot_connection.metrics is not None:
+                    call = self.bot_connection.metrics.timed('handler', func.__name__, call)
+                if timeout:
+                    await asyncio.wait_for(call, timeout)
+                else:
+                    await call
+            self.completed += 1
+        except asyncio.TimeoutError:
+            self.timedOut += 1
+            print(f"WARNING: Chat handler {func.__name__} timed out after {timeout}s")
+        except Exception as e:
+            self.failed += 1
+            print(f"WARNING: Chat handler {func.__name__} raised {e!r}")
+        finally:
+            self.pending -= 1
+            channel[1] -= 1
+            if channel[1] == 0:         # Forget idle channels so this doesn't grow forever.
+                del self.channelSemaphores[channel_id]
+
+    async def run_in_executor(self, func, *args):
+        if self.executorJobs >= self.executorQueue:
+            raise asyncio.QueueFull(f"{self.executorJobs} executor jobs already outstanding")
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.executorWorkers)
+
+        self.executorJobs += 1
+        try:
+            # Note a timed out job keeps its worker busy until it finishes, the result is just discarded.
+            return await asyncio.wait_for(
+                    asyncio.get_event_loop().run_in_executor(self.executor, func, *args),
+                    self.executorTimeout)
+        finally:
+            self.executorJobs -= 1
+
+    def shutdown_executor(self, wait=False):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def stats(self):
+        return {
+                "executor_jobs": self.executorJobs,
+                "pending":      self.pending,
+                "completed":    self.completed,
+                "dropped":      self.dropped,
+                "timed_out":    self.timedOut,
+                "failed":       self.failed,
+                "channels":     len(self.channelSemaphores)
+                }
+
+class zlib_stream_decoder:
+    """
+        Decoder for the gateway's zlib-stream transport compression.
+        See https://discordapp.com/developers/docs/topics/gateway#transport-compression
+
+        The whole connection shares one zlib context. A message may arrive split over several
+        websocket frames and is only complete once the buffered data ends with the
+        Z_SYNC_FLUSH suffix 00 00 ff ff.
+
+        Function Definitions:
+
+            feed()              params: data,       bytes of a binary websocket frame.
+
+                                Buffer the frame. Returns the decompressed message as bytes
+                                once it is complete, otherwise None.
+
+            reset()             params: None
+
+                                Start a fresh zlib context. Must be called for every new connection.
+    """
+
+    ZLIB_SUFFIX = b'\x00\x00\xff\xff'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.inflator = zlib.decompressobj()
+        self.buffer = bytearray()
+        self.compressedBytes = 0
+        self.decompressedBytes = 0
+
+    def feed(self, data):
+        self.buffer += data
+        if self.buffer[-4:] != self.ZLIB_SUFFIX:
+            return None
+
+        message = self.inflator.decompress(self.buffer)
+        self.compressedBytes += len(self.buffer)
+        self.decompressedBytes += len(message)
+        self.buffer = bytearray()
+        return message
+
+class json_codec:
+    """
+        Gateway payload codec for 'encoding=json' using the standard library.
+
+        Every codec provides:
+            encoding            Value of the gateway 'encoding' query parameter.
+            loads()             params: data,   str or bytes of a complete gateway message.
+                                Decode a message into a payload dict.
+            dumps()             params: payload,    payload dict.
+                                Encode a payload. Returns str to be sent as a text frame or bytes
+                                to be sent as a binary frame.
+            peek()              params: data,   str or bytes of a complete gateway message.
+                                Cheaply read (op, s, t) without decoding the payload, or return
+                                None if that isn't possible for this message.
+
+        Discord sends JSON payloads with their keys in the order t, s, op, d, so peek() reads the
+        head of the message with one anchored regular expression and never looks at 'd'.
+    """
+    encoding = "json"
+
+    peek_pattern = re.compile(r'\{\s*"t"\s*:\s*(?:null|"([A-Z_]+)")\s*,\s*"s"\s*:\s*(null|[0-9]+)\s*,\s*"op"\s*:\s*([0-9]+)\s*,')
+    peek_pattern_bytes = re.compile(peek_pattern.pattern.encode())
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def peek(self, data):
+        m = (self.peek_pattern if isinstance(data, str) else self.peek_pattern_bytes).match(data)
+        if m is None:
+            return None
+        t, s, op = m.groups()
+        if isinstance(t, bytes):
+            t = t.decode()
+        return int(op), None if s in ("null", b"null") else int(s), t
+
+    def dumps(self, payload):
+        return json.dumps(payload, separators=(',', ':'))
+
+class orjson_codec(json_codec):
+    """
+        Gateway payload codec for 'encoding=json' using orjson, if it is installed.
+    """
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, payload):
+        return orjson.dumps(payload).decode('utf-8')    # JSON must be sent as a text frame.
+
+class etf_codec:
+    """
+        Gateway payload codec for 'encoding=etf', the Erlang External Term Format.
+        See https://discordapp.com/developers/docs/topics/gateway#etfjson
+        and http://erlang.org/doc/apps/erts/erl_ext_dist.html
+
+        Binaries are decoded to str and the atoms nil, true and false to None, True and False.
+        Strings are encoded as binaries and dict keys as binaries, as Discord expects.
+        Note that with ETF, Discord sends snowflake IDs as integers rather than strings.
+    """
+    encoding = "etf"
+
+    # Not implemented for ETF, messages are always decoded in full.
+    def peek(self, data):
+        return None
+
+    VERSION                 = 131
+    NEW_FLOAT_EXT           = 70
+    COMPRESSED              = 80
+    SMALL_INTEGER_EXT       = 97
+    INTEGER_EXT             = 98
+    FLOAT_EXT               = 99
+    ATOM_EXT                = 100
+    SMALL_TUPLE_EXT         = 104
+    LARGE_TUPLE_EXT         = 105
+    NIL_EXT                 = 106
+    STRING_EXT              = 107
+    LIST_EXT                = 108
+    BINARY_EXT              = 109
+    SMALL_BIG_EXT           = 110
+    LARGE_BIG_EXT           = 111
+    SMALL_ATOM_EXT          = 115
+    MAP_EXT                 = 116
+    ATOM_UTF8_EXT           = 118
+    SMALL_ATOM_UTF8_EXT     = 119
+
+    atoms = { "nil": None, "true": True, "false": False }
+
+    def loads(self, data):
+        data = bytes(data)
+        if data[0] != self.VERSION:
+            raise ValueError(f"Unknown ETF version {data[0]}")
+        term, offset = self.decode(data, 1)
+        return term
+
+    # Decode the term at offset, returning (term, offset of the next term).
+    def decode(self, data, offset):
+        tag = data[offset]
+        offset += 1
+
+        if tag == self.SMALL_INTEGER_EXT:
+            return data[offset], offset + 1
+        elif tag == self.INTEGER_EXT:
+            return struct.unpack_from('>i', data, offset)[0], offset + 4
+        elif tag == self.NEW_FLOAT_EXT:
+            return struct.unpack_from('>d', data, offset)[0], offset + 8
+        elif tag == self.FLOAT_EXT:
+            return float(data[offset:offset + 31].rstrip(b'\x00')), offset + 31
+        elif tag in (self.ATOM_EXT, self.ATOM_UTF8_EXT):
+            length = struct.unpack_from('>H', data, offset)[0]
+            offset += 2
+            return self.atom(data[offset:offset + length]), offset + length
+        elif tag in (self.SMALL_ATOM_EXT, self.SMALL_ATOM_UTF8_EXT):
+            length = data[offset]
+            offset += 1
+            return self.atom(data[offset:offset + length]), offset + length
+        elif tag == self.BINARY_EXT:
+            length = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+            return data[offset:offset + length].decode('utf-8'), offset + length
+        elif tag == self.STRING_EXT:        # A list of bytes, used by Erlang for short integer lists.
+            length = struct.unpack_from('>H', data, offset)[0]
+            offset += 2
+            return list(data[offset:offset + length]), offset + length
+        elif tag == self.NIL_EXT:
+            return [], offset
+        elif tag == self.LIST_EXT:
+            length = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+            items = []
+            for i in range(length):
+                item, offset = self.decode(data, offset)
+                items.append(item)
+            tail, offset = self.decode(data, offset) # Proper lists end with NIL_EXT.
+            return items, offset
+        elif tag == self.MAP_EXT:
+            arity = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+            items = {}
+            for i in range(arity):
+                key, offset = self.decode(data, offset)
+                value, offset = self.decode(data, offset)
+                items[key] = value
+            return items, offset
+        elif tag in (self.SMALL_TUPLE_EXT, self.LARGE_TUPLE_EXT):
+            if tag == self.SMALL_TUPLE_EXT:
+                arity = data[offset]
+                offset += 1
+            else:
+                arity = struct.unpack_from('>I', data, offset)[0]
+                offset += 4
+            items = []
+            for i in range(arity):
+                item, offset = self.decode(data, offset)
+                items.append(item)
+            return tuple(items), offset
+        elif tag in (self.SMALL_BIG_EXT, self.LARGE_BIG_EXT):
+            if tag == self.SMALL_BIG_EXT:
+                length = data[offset]
+                offset += 1
+            else:
+                length = struct.unpack_from('>I', data, offset)[0]
+                offset += 4
+            sign = data[offset]
+            value = int.from_bytes(data[offset + 1:offset + 1 + length], 'little')
+            return -value if sign else value, offset + 1 + length
+        elif tag == self.COMPRESSED:
+            size = struct.unpack_from('>I', data, offset)[0]
+            inflated = zlib.decompress(data[offset + 4:])
+            assert size == len(inflated), "Compressed ETF term has the wrong size"
+            term, end = self.decode(inflated, 0)
+            return term, len(data)
+        else:
+            raise ValueError(f"Unknown ETF tag {tag}")
+
+    def atom(self, name):
+        name = name.decode('utf-8')
+        return self.atoms[name] if name in self.atoms else name
+
+    def dumps(self, payload):
+        out = bytearray([self.VERSION])
+        self.encode(payload, out)
+        return bytes(out)
+
+    def encode(self, term, out):
+        if term is None:
+            self.encode_atom("nil", out)
+        elif term is True:
+            self.encode_atom("true", out)
+        elif term is False:
+            self.encode_atom("false", out)
+        elif isinstance(term, int):
+            if 0 <= term <= 255:
+                out += struct.pack('>BB', self.SMALL_INTEGER_EXT, term)
+            elif -2**31 <= term < 2**31:
+                out += struct.pack('>Bi', self.INTEGER_EXT, term)
+            else:
+                value = abs(term).to_bytes((abs(term).bit_length() + 7) // 8, 'little')
+                out += struct.pack('>BBB', self.SMALL_BIG_EXT, len(value), 1 if term < 0 else 0)
+                out += value
+        elif isinstance(term, float):
+            out += struct.pack('>Bd', self.NEW_FLOAT_EXT, term)
+        elif isinstance(term, (str, bytes)):
+            value = term.encode('utf-8') if isinstance(term, str) else term
+            out += struct.pack('>BI', self.BINARY_EXT, len(value))
+            out += value
+        elif isinstance(term, (list, tuple)):
+            if term:
+                out += struct.pack('>BI', self.LIST_EXT, len(term))
+                for item in term:
+                    self.encode(item, out)
+            out.append(self.NIL_EXT)
+        elif isinstance(term, dict):
+            out += struct.pack('>BI', self.MAP_EXT, len(term))
+            for key, value in term.items():
+                self.encode(key, out)
+                self.encode(value, out)
+        else:
+            raise TypeError(f"Can't encode {type(term).__name__} as ETF")
+
+    def encode_atom(self, name, out):
+        name = name.encode('utf-8')
+        out += struct.pack('>BB', self.SMALL_ATOM_UTF8_EXT, len(name))
+        out += name
+
+# Pick a codec for a gateway 'encoding'. JSON uses orjson when it is available.
+def get_codec(encoding="json"):
+    if encoding == "etf":
+        return etf_codec()
+    elif encoding == "json":
+        return orjson_codec() if orjson else json_codec()
+    raise ValueError(f"Unknown gateway encoding {encoding}")
+
+class bounded_cache:
+    """
+        A least-recently-used cache bounded by total size in bytes, with an optional time to live.
+
+            cache = bounded_cache(maxBytes=64*1024*1024, ttl=600, onEvict=None)
+
+        onEvict, if given, is called as onEvict(key, value) for each entry evicted to make room.
+
+        Function Definitions:
+
+            get()               params: key,        Key to look up.
+
+                                Return the cached value, or None if it is missing or expired.
+                                Counts a hit or a miss.
+
+            put()               params: key,        Key to store under.
+                                        value,      Value to cache.
+                                        size,       Size of the value in bytes.
+
+                                Store a value, evicting least recently used entries until the cache
+                                fits in maxBytes. Values larger than maxBytes are not cached.
+
+            stats()             params: None
+
+                                Return a dict of hit/miss/eviction counters and current size.
+    """
+
+    def __init__(self, maxBytes=64*1024*1024, ttl=None, onEvict=None):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.onEvict = onEvict
+        self.entries = OrderedDict()    # key: (value, size, expires)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key in self.entries:
+            value, size, expires = self.entries[key]
+            if expires is None or expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.remove(key)
+        if size > self.maxBytes:
+            return
+
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.entries[key] = (value, size, expires)
+        self.size += size
+
+        while self.size > self.maxBytes:
+            oldest = next(iter(self.entries))
+            evicted = self.entries[oldest][0]
+            self.remove(oldest)
+            self.evictions += 1
+            if self.onEvict:
+                self.onEvict(oldest, evicted)
+
+    def remove(self, key):
+        value, size, expires = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+                "hits":         self.hits,
+                "misses":       self.misses,
+                "hit_ratio":    self.hits / lookups if lookups else 0.0,
+                "evictions":    self.evictions,
+                "entries":      len(self.entries),
+                "bytes":        self.size
+                }
+
+class result_cache:
+    """
+        A content addressed cache of rendered command output (bytes), such as encoded images.
+        Entries live in a bounded_cache in memory and, if spillDir is given, entries evicted from
+        memory are written to files there instead of being dropped. The spill directory is itself
+        bounded to maxSpillBytes (oldest files are deleted first) and is reused across restarts.
+
+            results = result_cache(maxBytes=64*1024*1024, spillDir=None, maxSpillBytes=1024*1024*1024)
+
+        Function Definitions:
+
+            key()               params: digest,     Hash of the input, e.g. hashlib.sha256(data).hexdigest()
+                                        command,    Name of the command.
+                                        args,       Dict of parsed arguments.
+
+                                Return the cache key for a command run on an input with some arguments.
+
+            get()               params: key
+
+                                Return the cached bytes, or None. Entries found on disk are moved back
+                                into memory.
+
+            put()               params: key, data
+
+                                Store the output for a key.
+
+            stats()             params: None
+
+                                Return a dict of hits, misses, hit ratio, bytes served from the cache
+                                (bytes_saved) and memory/disk usage.
+    """
+
+    def __init__(self, maxBytes=64*1024*1024, spillDir=None, maxSpillBytes=1024*1024*1024):
+        self.memory = bounded_cache(maxBytes=maxBytes, onEvict=self.spill if spillDir else None)
+        self.spillDir = spillDir
+        self.maxSpillBytes = maxSpillBytes
+        self.spilled = OrderedDict()    # key: size, oldest first.
+        self.spillSize = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytesSaved = 0
+
+        if spillDir:
+            os.makedirs(spillDir, exist_ok=True)
+            files = [f for f in os.scandir(spillDir) if f.is_file()]
+            for f in sorted(files, key=lambda f: f.stat().st_mtime):
+                self.spilled[f.name] = f.stat().st_size
+                self.spillSize += f.stat().st_size
+
+    @staticmethod
+    def key(digest, command, args):
+        return hashlib.sha256(repr((digest, command, sorted(args.items()))).encode()).hexdigest()
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is None and key in self.spilled:
+            try:
+                with open(os.path.join(self.spillDir, key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            self.unspill(key)
+            if data is not None:
+                self.memory.put(key, data, len(data))
+
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytesSaved += len(data)
+        return data
+
+    def put(self, key, data):
+        self.memory.put(key, data, len(data))
+
+    def spill(self, key, data):
+        if len(data) > self.maxSpillBytes:
+            return
+        try:
+            with open(os.path.join(self.spillDir, key), 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            print(f"WARNING: Could not spill cached result to disk: {e}")
+            return
+        self.spilled[key] = len(data)
+        self.spillSize += len(data)
+
+        while self.spillSize > self.maxSpillBytes:
+            self.unspill(next(iter(self.spilled)))
+
+    def unspill(self, key):
+        self.spillSize -= self.spilled.pop(key)
+        try:
+            os.remove(os.path.join(self.spillDir, key))
+        except OSError:
+            pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+                "hits":         self.hits,
+                "misses":       self.misses,
+                "hit_ratio":    self.hits / lookups if lookups else 0.0,
+                "bytes_saved":  self.bytesSaved,
+                "entries":      len(self.memory),
+                "bytes":        self.memory.size,
+                "spilled":      len(self.spilled),
+                "spill_bytes":  self.spillSize
+                }
+
+class latency_histogram:
+    """
+        A Prometheus style cumulative histogram of durations in seconds.
+    """
+
+    buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)   # Last slot is +Inf.
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Upper bound of the bucket containing the given percentile (0-100), or None if empty.
+    def percentile(self, percentile):
+        if not self.count:
+            return None
+        target = self.count * percentile / 100
+        for bound, count in zip(self.buckets + (float('inf'),), itertools.accumulate(self.counts)):
+            if count >= target:
+                return bound
+
+    def to_dict(self):
+        cumulative = list(itertools.accumulate(self.counts))
+        return {
+                "count":    self.count,
+                "sum":      self.sum,
+                "buckets":  dict(zip([str(b) for b in self.buckets] + ["+Inf"], cumulative))
+                }
+
+class instrumentation:
+    """
+        Counts and latency histograms for a bot, enabled with discord_bot_connection(instrument=True).
+        When it is not enabled connection.metrics is None and nothing is timed at all.
+
+            metrics = bot.metrics
+
+        Recorded histograms, each labelled:
+            gateway_opcode      Time spent handling each gateway message, by opcode.
+            dispatch_event      Time spent handling each DISPATCH event, by event type.
+            handler             Time spent in each registered function (dispatch, message and chat
+                                handlers), by function name.
+            rest_request        Duration of each RESTful API call, by route.
+            loop_lag            How late the event loop wakes up a sleeping task, sampled every
+                                lagInterval seconds.
+
+        Function Definitions:
+
+            observe()           params: name, label, seconds
+
+                                Record a duration.
+
+            timed()             params: name, label, awaitable
+
+                                Await something and record how long it took.
+
+            sample_loop_lag()   params: None
+
+                                Coroutine sampling event loop lag forever. Started by the connection.
+
+            to_json()           params: None
+
+                                Return every histogram as a JSON string.
+
+            prometheus_text()   params: None
+
+                                Return every histogram in the Prometheus text exposition format.
+
+            serve()             params: host, port
+
+                                Serve prometheus_text() at /metrics and to_json() at /metrics.json
+                                from a small aiohttp web server. Returns the aiohttp AppRunner.
+    """
+
+    def __init__(self, prefix="falsebot", lagInterval=0.5):
+        self.prefix = prefix
+        self.lagInterval = lagInterval
+        self.histograms = {}    # name: { label: latency_histogram }
+
+    def observe(self, name, label, seconds):
+        labels = self.histograms.setdefault(name, {})
+        if label not in labels:
+            labels[label] = latency_histogram()
+        labels[label].observe(seconds)
+
+    async def timed(self, name, label, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.observe(name, label, time.perf_counter() - started)
+
+    async def sample_loop_lag(self):
+        while True:
+            expected = time.monotonic() + self.lagInterval
+            await asyncio.sleep(self.lagInterval)
+            self.observe('loop_lag', '', max(0, time.monotonic() - expected))
+
+    def to_dict(self):
+        return { name: { str(label): h.to_dict() for label, h in labels.items() } for name, labels in self.histograms.items() }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def prometheus_text(self):
+        lines = []
+        for name, labels in self.histograms.items():
+            metric = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for label, h in labels.items():
+                tag = f'label="{str(label)}",' if label != '' else ''
+                cumulative = list(itertools.accumulate(h.counts))
+                for bound, count in zip([str(b) for b in h.buckets] + ["+Inf"], cumulative):
+                    lines.append(f'{metric}_bucket{{{tag}le="{bound}"}} {count}')
+                tag = "{" + tag.rstrip(',') + "}" if tag else ""
+                lines.append(f"{metric}_sum{tag} {h.sum}")
+                lines.append(f"{metric}_count{tag} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host="127.0.0.1", port=9090):
+        from aiohttp import web
+
+        async def metrics(request):
+            return web.Response(text=self.prometheus_text(), content_type="text/plain")
+
+        async def metrics_json(request):
+            return web.Response(text=self.to_json(), content_type="application/json")
+
+        app = web.Application()
+        app.router.add_get("/metrics", metrics)
+        app.router.add_get("/metrics.json", metrics_json)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+class rate_limit_bucket:
+    """
+        State for a single Discord RESTful API rate limit bucket.
+        See https://discordapp.com/developers/docs/topics/rate-limits
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.bucket = None          # Bucket hash from X-RateLimit-Bucket, if the server sent one.
+        self.known = False          # Whether a response has told us the bucket's limits yet. Until then
+                                    # only one request is in flight at a time.
+        self.unlimited = False      # The route's responses carry no rate limit headers.
+        self.limit = 1
+        self.remaining = 0          # Requests which may still be sent before the bucket resets, after
+                                    # subtracting those in flight.
+        self.reset_at = 0           # time.monotonic() at which the bucket refills.
+        self.inflight = 0           # Requests sent which haven't had a response yet.
+        self.updated = asyncio.Event()  # Set whenever a request finishes.
+        self.lock = asyncio.Lock()  # asyncio.Lock is FIFO, so this doubles as the bucket's queue.
+        self.waiting = 0            # Requests currently queued on this bucket.
+        self.requests = 0
+        self.wait_time = 0.0        # Total seconds requests have spent queued on this bucket.
+        self.max_wait = 0.0
+
+class rate_limiter:
+    """
+        Per-route rate limit scheduler for the Discord RESTful API.
+
+            rl = rate_limiter()
+
+        Requests are queued per bucket (keyed by route and major parameter, eg. channel_id)
+        and released the moment the bucket has remaining capacity or resets. The
+        X-RateLimit-* headers of every response keep the bucket state up to date, and a
+        429 response (per-route or global) pauses the relevant queue for exactly the
+        'retry after' period before the request is sent again.
+
+        A new bucket sends one request and holds the rest of its queue until that response
+        says what the limit is. Requests in flight count against the bucket's remaining
+        capacity until their responses arrive. Routes whose responses carry no rate limit
+        headers are not limited at all.
+
+        Function Definitions:
+
+            route_key()         params: method,     HTTP method.
+                                        path,       relative API path.
+
+                                Return the bucket key for a request. Major parameters
+                                (channel, guild and webhook IDs) are kept, any other IDs
+                                are collapsed so eg. every message in a channel shares a bucket.
+
+            request()           params: session,    aiohttp ClientSession to use.
+                                        method,     HTTP method.
+                                        url,        base url.
+                                        path,       relative API path.
+                                        **kwargs    passed to the aiohttp client session.
+
+                                Wait for the bucket, perform the request and return the JSON body.
+                                If 'data' is callable it is called to build a fresh body for
+                                every attempt.
+
+            stats()             params: None
+
+                                Return a dict of queue depth and wait time metrics, globally and
+                                per bucket.
+    """
+
+    major_parameters = re.compile(r"/(channels|guilds|webhooks)/(\d+)")
+    minor_parameters = re.compile(r"/\d+")
+
+    def __init__(self):
+        self.buckets = {}
+        self.global_reset_at = 0    # time.monotonic() at which a global rate limit expires.
+        self.rate_limited = 0       # Number of 429 responses received.
+        self.metrics = None         # instrumentation, if enabled on the connection.
+
+    def route_key(self, method, path):
+        majors = self.major_parameters.findall(path)
+        route = self.minor_parameters.sub("/:id", path)
+        return (method, route, tuple(majors))
+
+    def get_bucket(self, key):
+        if key not in self.buckets:
+            self.buckets[key] = rate_limit_bucket(key)
+        return self.buckets[key]
+
+    # Block until the bucket (and the global limit) allows another request, then claim it.
+    # Every successful acquire() must be followed by release() once the response has arrived.
+    async def acquire(self, bucket):
+        queued = time.monotonic()
+        bucket.waiting += 1
+        try:
+            async with bucket.lock:
+                while True:
+                    now = time.monotonic()
+                    if self.global_reset_at > now:
+                        await asyncio.sleep(self.global_reset_at - now)
+                        continue
+                    if bucket.unlimited:
+                        break
+                    if not bucket.known:
+                        if bucket.inflight:         # Wait for the first response to learn the limits.
+                            await self.wait_for_response(bucket)
+                            continue
+                        break
+                    if bucket.remaining <= 0:
+                        if bucket.reset_at > now:
+                            await asyncio.sleep(bucket.reset_at - now)
+                            continue
+                        bucket.remaining = bucket.limit - bucket.inflight   # Bucket has reset.
+                        if bucket.remaining <= 0:
+                            await self.wait_for_response(bucket)
+                            continue
+                    bucket.remaining -= 1
+                    break
+                bucket.inflight += 1
+        finally:
+            bucket.waiting -= 1
+
+        waited = time.monotonic() - queued
+        bucket.requests += 1
+        bucket.wait_time += waited
+        bucket.max_wait = max(bucket.max_wait, waited)
+
+    async def wait_for_response(self, bucket):
+        bucket.updated.clear()
+        await bucket.updated.wait()
+
+    def release(self, bucket):
+        bucket.inflight -= 1
+        bucket.updated.set()
+
+    # Update bucket state from the X-RateLimit-* response headers of a request still counted in flight.
+    def update(self, bucket, headers):
+        if 'X-RateLimit-Bucket' in headers:
+            bucket.bucket = headers['X-RateLimit-Bucket']
+        if 'X-RateLimit-Limit' not in headers and 'X-RateLimit-Remaining' not in headers:
+            if not bucket.known:            # Routes without rate limits never send the headers.
+                bucket.unlimited = True
+                bucket.known = True
+            return
+
+        bucket.known = True
+        bucket.unlimited = False
+        if 'X-RateLimit-Limit' in headers:
+            bucket.limit = int(headers['X-RateLimit-Limit'])
+        if 'X-RateLimit-Remaining' in headers:
+            # The server hasn't counted requests sent after this one yet.
+            bucket.remaining = int(headers['X-RateLimit-Remaining']) - (bucket.inflight - 1)
+        if 'X-RateLimit-Reset-After' in headers:
+            bucket.reset_at = time.monotonic() + float(headers['X-RateLimit-Reset-After'])
+        elif 'X-RateLimit-Reset' in headers:
+            bucket.reset_at = time.monotonic() + float(headers['X-RateLimit-Reset']) - time.time()
+
+    # Seconds to wait after a 429. The header is in seconds, the v6 JSON body is in milliseconds.
+    def retry_after(self, headers, body):
+        if 'Retry-After' in headers:
+            return float(headers['Retry-After'])
+        if body and 'retry_after' in body:
+            return body['retry_after'] / 1000
+        return 1.0
+
+    async def request(self, session, method, url, path, **kwargs):
+        bucket = self.get_bucket(self.route_key(method, path))
+
+        while True:
+            await self.acquire(bucket)
+            try:
+                body = kwargs
+                if callable(kwargs.get('data')):        # Request bodies which can't be re-sent are passed as a factory.
+                    body = dict(kwargs, data=kwargs['data']())
+                started = time.perf_counter()
+                async with session.request(method, f"{url}{path}", **body) as response:
+                    self.update(bucket, response.headers)
+
+                    if response.status == 429:
+                        self.rate_limited += 1
+                        body = await response.json(content_type=None)
+                        delay = self.retry_after(response.headers, body)
+                        if 'X-RateLimit-Global' in response.headers or (body and body.get('global')):
+                            self.global_reset_at = time.monotonic() + delay
+                            print(f"WARNING: Hit global rate limit, pausing all requests for {delay}s")
+                        else:
+                            bucket.known = True
+                            bucket.unlimited = False
+                            bucket.remaining = 0
+                            bucket.reset_at = time.monotonic() + delay
+                        continue                # Queue the request again, it will be sent as soon as the limit resets.
+
+                    assert 200 == response.status, response.reason
+                    data = await response.json()
+            finally:
+                self.release(bucket)
+
+            if self.metrics is not None:
+                self.metrics.observe('rest_request', f"{method} {bucket.route[1]}", time.perf_counter() - started)
+            return data
+
+    def stats(self):
+        buckets = {}
+        for key, bucket in self.buckets.items():
+            buckets[key] = {
+                    "queued":       bucket.waiting,
+                    "inflight":     bucket.inflight,
+                    "requests":     bucket.requests,
+                    "remaining":    bucket.remaining,
+                    "limit":        bucket.limit,
+                    "wait_time":    bucket.wait_time,
+                    "max_wait":     bucket.max_wait,
+                    "avg_wait":     bucket.wait_time / bucket.requests if bucket.requests else 0.0
+                    }
+
+        return {
+                "queued":       sum(b.waiting for b in self.buckets.values()),
+                "requests":     sum(b.requests for b in self.buckets.values()),
+                "wait_time":    sum(b.wait_time for b in self.buckets.values()),
+                "rate_limited": self.rate_limited,
+                "global_limited": self.global_reset_at > time.monotonic(),
+                "buckets":      buckets
+                }
+
+class cached_user:
+    """ A user as stored by guild_cache. Shared by every guild the user is a member of. """
+    __slots__ = ('id', 'username', 'discriminator', 'bot')
+
+    def __init__(self, user):
+        self.id = int(user['id'])
+        self.update(user)
+
+    def update(self, user):
+        self.username = sys.intern(user['username']) if 'username' in user else None
+        self.discriminator = sys.intern(user['discriminator']) if 'discriminator' in user else None
+        self.bot = user['bot'] if 'bot' in user else False
+
+class cached_member:
+    """ A guild member as stored by guild_cache. roles is a tuple of role IDs. """
+    __slots__ = ('user', 'nick', 'roles', 'joined_at')
+
+    def __init__(self, user, member):
+        self.user = user
+        self.update(member)
+
+    def update(self, member):
+        self.nick = member['nick'] if 'nick' in member else None
+        self.roles = tuple(int(r) for r in member['roles']) if 'roles' in member else ()
+        self.joined_at = member['joined_at'] if 'joined_at' in member else None
+
+class cached_channel:
+    """ A guild channel as stored by guild_cache. """
+    __slots__ = ('id', 'guild_id', 'type', 'name', 'position', 'parent_id')
+
+    def __init__(self, guild_id, channel):
+        self.id = int(channel['id'])
+        self.guild_id = guild_id
+        self.update(channel)
+
+    def update(self, channel):
+        self.type = channel['type']
+        self.name = sys.intern(channel['name']) if channel.get('name') else None
+        self.position = channel['position'] if 'position' in channel else 0
+        self.parent_id = int(channel['parent_id']) if channel.get('parent_id') else None
+
+class cached_role:
+    """ A guild role as stored by guild_cache. """
+    __slots__ = ('id', 'name', 'color', 'position', 'permissions')
+
+    def __init__(self, role):
+        self.id = int(role['id'])
+        self.name = sys.intern(role['name'])
+        self.color = role['color'] if 'color' in role else 0
+        self.position = role['position'] if 'position' in role else 0
+        self.permissions = int(role['permissions']) if 'permissions' in role else 0
+
+class cached_guild:
+    """
+        A guild as stored by guild_cache. channels, roles and members are dicts keyed by integer
+        ID, presences maps user ID to status and is only filled if presences are cached.
+    """
+    __slots__ = ('id', 'name', 'owner_id', 'unavailable', 'member_count', 'channels', 'roles', 'members', 'presences')
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = None
+        self.owner_id = None
+        self.unavailable = True
+        self.member_count = 0
+        self.channels = {}
+        self.roles = {}
+        self.members = {}
+        self.presences = {}
+
+    def update(self, guild):
+        if 'name' in guild:
+            self.name = sys.intern(guild['name'])
+        if 'owner_id' in guild:
+            self.owner_id = int(guild['owner_id'])
+        if 'member_count' in guild:
+            self.member_count = guild['member_count']
+        if 'roles' in guild:
+            self.roles = { role.id: role for role in map(cached_role, guild['roles']) }
+        self.unavailable = guild['unavailable'] if 'unavailable' in guild else False
+
+class guild_cache:
+    """
+        Structured cache of the guilds a bot is in, kept up to date from gateway events.
+
+            cache = guild_cache(
+                **kwargs { cacheMembers : string,   'all'       cache the member list sent with
+                                                                GUILD_CREATE and every member event.
+                                                    'on_demand' only cache members as they are seen in
+                                                                member events, member chunks and
+                                                                messages. (Default)
+                                                    'none'      never cache members.
+                           cachePresences : boolean,
+                                                    Cache each member's status from GUILD_CREATE and
+                                                    PRESENCE_UPDATE. Defaults False.
+                            }
+
+        Rather than whole payloads only the fields below are kept, in __slots__ objects with
+        integer IDs and interned names: cached_guild, cached_channel, cached_role,
+        cached_member and cached_user. Guilds can be looked up with either an integer or a
+        string ID, eg. cache['1234'].
+
+        Function Definitions:
+
+            handle()            params: eventType,  DISPATCH event name.
+                                        event,      event data.
+
+                                Apply a DISPATCH event to the cache. Events the cache doesn't
+                                track are ignored.
+
+            snapshot()          params: shard = None,
+                                                    [shard_id, num_shards] to only include that
+                                                    shard's guilds and their channels.
+
+                                Return the cached guilds, users and channels as a picklable dict.
+
+            restore()           params: state,      dict returned by snapshot().
+
+                                Add a snapshot's guilds, users and channels to the cache, so the
+                                snapshots of several shards sharing a cache can all be restored.
+                                Users already cached are kept, and restored members refer to them.
+
+            wants()             params: eventType
+
+                                Whether handle() does anything with an event, under the cache policies.
+
+            intents()           params: None
+
+                                Return the gateway intents needed to keep the cache complete.
+
+            get_member()        params: guild_id, user_id
+
+                                Return a cached_member, or None.
+
+            get_channel()       params: channel_id
+
+                                Return a cached_channel from any guild, or None.
+    """
+
+    def __init__(self, **kwargs):
+        self.cacheMembers = kwargs['cacheMembers'] if 'cacheMembers' in kwargs else 'on_demand'
+        self.cachePresences = kwargs['cachePresences'] if 'cachePresences' in kwargs else False
+        self.guilds = {}        # guild_id: cached_guild
+        self.users = {}         # user_id: cached_user
+        self.channels = {}      # channel_id: cached_channel, for every guild.
+
+        # DISPATCH event: handler
+        self.handlers = {
+                'READY':                self.ready,
+                'GUILD_CREATE':         self.guild_create,
+                'GUILD_UPDATE':         self.guild_update,
+                'GUILD_DELETE':         self.guild_delete,
+                'CHANNEL_CREATE':       self.channel_update,
+                'CHANNEL_UPDATE':       self.channel_update,
+                'CHANNEL_DELETE':       self.channel_delete,
+                'GUILD_ROLE_CREATE':    self.role_update,
+                'GUILD_ROLE_UPDATE':    self.role_update,
+                'GUILD_ROLE_DELETE':    self.role_delete,
+                'GUILD_MEMBER_ADD':     self.member_add,
+                'GUILD_MEMBER_UPDATE':  self.member_update,
+                'GUILD_MEMBER_REMOVE':  self.member_remove,
+                'GUILD_MEMBERS_CHUNK':  self.members_chunk,
+                'PRESENCE_UPDATE':      self.presence_update,
+                'MESSAGE_CREATE':       self.message_create
+                }
+
+    def __contains__(self, guild_id):
+        return int(guild_id) in self.guilds
+
+    def __getitem__(self, guild_id):
+        return self.guilds[int(guild_id)]
+
+    def __len__(self):
+        return len(self.guilds)
+
+    def __iter__(self):
+        return iter(self.guilds.values())
+
+    def get(self, guild_id):
+        return self.guilds.get(int(guild_id))
+
+    def get_member(self, guild_id, user_id):
+        guild = self.guilds.get(int(guild_id))
+        return guild.members.get(int(user_id)) if guild else None
+
+    def get_channel(self, channel_id):
+        return self.channels.get(int(channel_id))
+
+    def handle(self, eventType, event):
+        if eventType in self.handlers:
+            self.handlers[eventType](event)
+
+    # Everything cached, for discord_bot_connection snapshots. The dicts are copied so the snapshot
+    # can be pickled from another thread while events keep updating the cache; the cached objects
+    # themselves are shared, they are only ever updated an attribute at a time.
+    def snapshot(self, shard=None):
+        guilds = {}
+        for guild_id, guild in self.guilds.items():
+            if shard is not None and (guild_id >> 22) % shard[1] != shard[0]:
+                continue
+            copy = guilds[guild_id] = cached_guild(guild_id)
+            for name in cached_guild.__slots__:
+                value = getattr(guild, name)
+                setattr(copy, name, value.copy() if isinstance(value, dict) else value)
+        channels = self.channels.copy() if shard is None else \
+                { channel_id: channel for channel_id, channel in self.channels.items() if channel.guild_id in guilds }
+        return { "guilds": guilds, "users": self.users.copy(), "channels": channels }
+
+    def restore(self, state):
+        for user_id, user in state['users'].items():
+            self.users.setdefault(user_id, user)
+        for guild in state['guilds'].values():
+            for member in guild.members.values():
+                member.user = self.users.get(member.user.id, member.user)
+        self.guilds.update(state['guilds'])
+        self.channels.update(state['channels'])
+
+    # Whether the cache does anything with an event under its policies.
+    def wants(self, eventType):
+        if eventType == 'PRESENCE_UPDATE':
+            return self.cachePresences
+        return eventType in self.handlers
+
+    # Gateway intents the cache needs to be complete under its policies, see intents.
+    def intents(self):
+        value = intents.GUILDS
+        if self.cacheMembers == 'all':
+            value |= intents.GUILD_MEMBERS
+        if self.cachePresences:
+            value |= intents.GUILD_PRESENCES
+        return value
+
+    def get_guild(self, guild_id):
+        guild_id = int(guild_id)
+        if guild_id not in self.guilds:
+            self.guilds[guild_id] = cached_guild(guild_id)
+        return self.guilds[guild_id]
+
+    def get_user(self, user):
+        user_id = int(user['id'])
+        if user_id in self.users:
+            cached = self.users[user_id]
+            if 'username' in user:
+                cached.update(user)
+        else:
+            cached = self.users[user_id] = cached_user(user)
+        return cached
+
+    def add_member(self, guild, member):
+        user = self.get_user(member['user'])
+        if user.id in guild.members:
+            guild.members[user.id].update(member)
+        else:
+            guild.members[user.id] = cached_member(user, member)
+
+    def add_channel(self, guild, channel):
+        channel_id = int(channel['id'])
+        if channel_id in guild.channels:
+            guild.channels[channel_id].update(channel)
+        else:
+            guild.channels[channel_id] = self.channels[channel_id] = cached_channel(guild.id, channel)
+
+    def ready(self, event):
+        for g in event['guilds']:
+            self.get_guild(g['id']).unavailable = True
+
+    def guild_create(self, event):
+        guild = self.get_guild(event['id'])
+        guild.update(event)
+        for channel in event['channels'] if 'channels' in event else ():
+            self.add_channel(guild, channel)
+        if self.cacheMembers == 'all':
+            for member in event['members'] if 'members' in event else ():
+                self.add_member(guild, member)
+        if self.cachePresences:
+            for presence in event['presences'] if 'presences' in event else ():
+                guild.presences[int(presence['user']['id'])] = sys.intern(presence['status'])
+
+    def guild_update(self, event):
+        self.get_guild(event['id']).update(event)
+
+    def guild_delete(self, event):
+        guild_id = int(event['id'])
+        if event.get('unavailable'):        # Outage, the guild will come back with GUILD_CREATE.
+            self.get_guild(guild_id).unavailable = True
+        elif guild_id in self.guilds:       # We left or were removed.
+            for channel_id in self.guilds.pop(guild_id).channels:
+                self.channels.pop(channel_id, None)
+
+    def channel_update(self, event):
+        if event.get('guild_id'):           # DM channels aren't cached here.
+            self.add_channel(self.get_guild(event['guild_id']), event)
+
+    def channel_delete(self, event):
+        channel_id = int(event['id'])
+        self.channels.pop(channel_id, None)
+        if event.get('guild_id') and int(event['guild_id']) in self.guilds:
+            self.guilds[int(event['guild_id'])].channels.pop(channel_id, None)
+
+    def role_update(self, event):
+        role = cached_role(event['role'])
+        self.get_guild(event['guild_id']).roles[role.id] = role
+
+    def role_delete(self, event):
+        self.get_guild(event['guild_id']).roles.pop(int(event['role_id']), None)
+
+    def member_add(self, event):
+        guild = self.get_guild(event['guild_id'])
+        guild.member_count += 1
+        if self.cacheMembers != 'none':
+            self.add_member(guild, event)
+
+    def member_update(self, event):
+        if self.cacheMembers != 'none':
+            self.add_member(self.get_guild(event['guild_id']), event)
+
+    def member_remove(self, event):
+        guild = self.get_guild(event['guild_id'])
+        guild.member_count -= 1
+        guild.members.pop(int(event['user']['id']), None)
+        guild.presences.pop(int(event['user']['id']), None)
+
+    def members_chunk(self, event):
+        if self.cacheMembers != 'none':
+            guild = self.get_guild(event['guild_id'])
+            for member in event['members']:
+                self.add_member(guild, member)
+
+    def presence_update(self, event):
+        if self.cachePresences and event.get('guild_id'):
+            self.get_guild(event['guild_id']).presences[int(event['user']['id'])] = sys.intern(event['status'])
+
+    def message_create(self, event):
+        if self.cacheMembers != 'none' and event.get('guild_id') and 'member' in event:
+            member = dict(event['member'], user=event['author'])
+            self.add_member(self.get_guild(event['guild_id']), member)
+
+class discord_bot_connection:
+    """
+        Main Discord Bot Connection class.
+
+            bot = discord_bot_connection(botToken,
+                **kwargs { compress : boolean,      Use zlib-stream transport compression for the
+                                                    gateway connection. Defaults False.
+                           shard : [id, count],     Shard to IDENTIFY as. See shard_manager.
+                           gatewayUrl : string,     Gateway url, skips the /gateway/bot lookup.
+                           identifyLimiter :        Object with an async acquire(shard_id) method
+                                                    awaited before every IDENTIFY.
+                           mainConnection :         discord_bot_connection whose user is kept up to
+                                                    date with this one's, eg. shard_manager.connection.
+                           instrument : boolean,    Record latency histograms in self.metrics, see
+                                                    instrumentation. Defaults False.
+                           apiUrl : string,         RESTful API base url. (Default https://discordapp.com/api/)
+                           maxUploads : integer,    Maximum number of send_file() uploads at once. (Default 4)
+                           snapshotFile : string,   Save the session and caches to this file every
+                                                    snapshotInterval seconds and on exit, and load it
+                                                    in start() to RESUME the session. See save_snapshot().
+                           snapshotInterval : float,
+                                                    Seconds between snapshots. (Default 60)
+                           workers : integer,       Run dispatch handlers on this many worker tasks, with
+                                                    events kept in order per guild (or channel), see
+                                                    event_scheduler. Defaults None, handlers run one
+                                                    at a time in the gateway read loop.
+                           processes : integer,     Fan dispatch handlers out to this many forked worker
+                                                    processes, each with 'workers' tasks. Handlers
+                                                    see a per-process copy of self.guilds, see
+                                                    process_scheduler. Defaults None.
+                           maxPending : integer,    Events the workers (or processes) may have waiting
+                                                    before the gateway read loop waits for room. (Default 10000)
+                           partition : string,      'guild' (Default) keeps events in order per guild,
+                                                    'channel' per channel, allowing more parallelism.
+                           coalesceWindow : float,  Seconds to collect say_in_channel() messages per channel
+                                                    and send them as one, see reply_coalescer. Defaults
+                                                    None, every message is sent on its own.
+                           recordFile : string,     Append every gateway message received to this file
+                                                    as JSON lines, for replay().
+                           cacheMembers, cachePresences,
+                                                    Guild cache policies, see guild_cache.
+                           guildCache :             guild_cache to use instead of creating one.
+                           encoding : string,       Gateway payload encoding, 'json' (Default) or 'etf'.
+                                                    JSON is handled by orjson if it is installed.
+                           lazyDecode : boolean,    Read only the head of each JSON gateway message first
+                                                    and skip DISPATCH events nothing subscribes to without
+                                                    decoding them. Off while recording. Defaults True.
+                           intents : integer or True,
+                                                    Gateway intents to IDENTIFY with, see intents. True
+                                                    derives them from subscribed_intents(). Defaults None,
+                                                    no intents are sent and the gateway sends everything.
+                           connectionLimit, connectionLimitPerHost, keepaliveTimeout, dnsCacheTTL,
+                                                    Connection pool settings, see open_session().
+                            }
+
+        Function definitions:
+
+            start()             params: None
+
+                                Asyncio start function.
+                                Run with asyncio.run(bot.start()
+    
+                                Connects to the gateway and keeps reconnecting with exponential
+                                backoff whenever the connection drops, resuming the session where
+                                possible. Returns once close() is called.
+
+            close()             params: keepSession,
+                                                    Close with a code which leaves the session
+                                                    resumable, eg. for a warm restart from a
+                                                    snapshot. Defaults False.
+
+                                Close the gateway connection and stop reconnecting.
+
+            save_snapshot()     params: None
+
+                                Write the session (session_id, sequence, gateway url, user), the
+                                guild_cache (only this shard's guilds when sharded) and everything
+                                in the snapshot_registry (such as a discord_chat_handler's channel
+                                buffer) to snapshotFile with pickle. The session and guilds are
+                                only loaded back by a connection for the same shard.
+                                The file is replaced atomically. It is only ever loaded by this
+                                library, so keep it somewhere only the bot can write to.
+
+            save_snapshot_async()
+                                params: None
+
+                                Same as above, copying the state on the event loop and pickling
+                                and writing it in an executor. Used for the periodic snapshots.
+
+            load_snapshot()     params: None
+
+                                Restore the state written by save_snapshot(). Returns True if a
+                                snapshot was loaded. The session is only restored for the same
+                                shard; if it has expired the gateway answers the RESUME with
+                                INVALID_SESSION and the bot IDENTIFYs as usual, keeping the caches.
+
+            register_snapshot() params: name,       Name to save the object under.
+                                        get,        Function returning the object to save.
+                                        set,        Function given the saved object on load.
+
+                                Place an object to include in snapshots in the snapshot_registry.
+
+            replay()            params: path,       JSON lines file written by recordFile.
+                                        speed,      Multiple of the recorded pace, None for as fast
+                                                    as possible.
+
+                                Feed recorded gateway messages through handle_message() without
+                                a connection and return a dict of throughput figures. See replay.py.
+
+            reconnect()         params: code,       websocket close code. (Default 4000)
+
+                                Close the websocket so start() reconnects and resumes the session.
+    
+            identify()          params: None
+            
+                                Send an 'IDENTIFY' op code to the websocket with a 'connection 
+                                properties' and an 'update status' object, resulting in the
+                                Bot coming online.
+                                https://discordapp.com/developers/docs/topics/gateway#identify
+
+            resume()            params: None
+
+                                Send a 'RESUME' op code with the stored session_id and sequence so
+                                the server replays any events missed while disconnected.
+                                https://discordapp.com/developers/docs/topics/gateway#resume
+
+            heartbeat()         params: heartbeat_interval, interval at which to beat,
+
+                                Sends an OPCODE 1 'HEARTBEAT' payload to the server at the correct
+                                interval in order to maintain connection to the websocket.
+                                If HEARTBEAT_ACK was not received since last heartbeat the
+                                connection is considered dead and reconnect() is called.
+                                Beats fire at fixed deadlines on the monotonic clock, the first
+                                after a random fraction of the interval.
+
+            latency             Property. Round trip time in seconds of the last heartbeat.
+                                latency_p50 and latency_p99 give percentiles over the last
+                                latencyWindow heartbeats, see also latency_percentile().
+
+            handle_message()    params: message,    'message' payload.
+
+                                Deal with incoming websocke messages. Handles incoming messages
+                                with opcodes 1-11 and passes opcode 0 'DISPATCH' to function
+                                'handle_dispatch'.
+                                Calls any user 'message' bindings from the message_registry
+                                object,
+                                See comment within function for implemented messages.
+
+            subscribed()        params: eventType,  DISPATCH event name.
+
+                                Whether anything handles an event: the connection itself, the guild
+                                cache under its policies, or a function in the dispatch_registry.
+                                With lazyDecode, events which aren't are counted in
+                                self.skippedEvents and dropped before being decoded.
+
+            subscribed_intents()
+                                params: None
+
+                                Return the gateway intents covering every subscribed event, used
+                                for IDENTIFY with intents=True.
+
+            handle_dispatch()   params: message     'message' payload.
+
+                                Deal with incoming events. These are the bits that carry the
+                                important information. See: 
+                                https://discordapp.com/developers/docs/topics/gateway#commands-and-events
+                                Currently implemented:
+                                    'READY'         -   store the user and session_id.
+                                    'RESUMED'       -   reset the reconnect backoff.
+                                    Guild, channel, role and member events update the
+                                    guild_cache in self.guilds.
+                                Calls any 'dispatch' bindings from the dispatch_registry
+                                object,
+                                directly, or through self.scheduler with workers or processes set.
+
+            open_session()      params: None
+
+                                Create (or return) the shared aiohttp ClientSession used for all
+                                REST and websocket traffic. The connector pool is configured by
+                                the constructor kwargs connectionLimit, connectionLimitPerHost,
+                                keepaliveTimeout and dnsCacheTTL.
+
+            close_session()     params: None
+
+                                Close the shared session. Called automatically when start() exits.
+
+            api_get_call()      params: path,       relative path for API to be called.
+                                        **kwargs    passed to the aiohttp client session.
+            
+                                Invoke a call to the Discord RESTful API via method GET and return the
+                                JSON object. Calls are queued per route by the rate_limiter in
+                                self.ratelimiter, see rate_limiter.stats() for queue metrics.
+                                See https://discordapp.com/developers/docs/topics/gateway#get-gateway
+
+            api_post_call()     params: path,       "
+                                        **kwargs    passed to the aiohttp client session.
+
+                                Invoke a call to the Discord RESTful API via method POST and return the 
+                                JSON object.
+
+            fetch_attachment()  params: url,        URL of the attachment.
+                                        maxSize,    Maximum size in bytes. (Default 8MB)
+
+                                Stream an attachment into memory through the shared session and
+                                return its bytes. Raises ValueError if it is larger than maxSize.
+
+            say_in_channel()    params: channel_id,  The ID of the channel for which to send the message
+                                        message,    The message to be sent.
+
+                                Send a message to a channel through a Discord RESTful API POST call,
+                                Invokes api_post_call().
+                                With coalesceWindow set, messages are batched per channel by
+                                self.coalescer first.
+                                See https://discordapp.com/developers/docs/resources/channel#create-message
+
+            send_file()         params: channel_id, The ID of the channel to upload to.
+                                        file,       File-like object, bytes-like object, async iterator
+                                                    of bytes, or a function returning an async iterator.
+                                        filename,   Name of the uploaded file.
+                                        **kwargs    Other create message fields, eg. content.
+
+                                Upload a file with a message. The multipart body is streamed from
+                                'file' rather than built in memory, and at most maxUploads uploads
+                                run at once; the rest wait their turn. Pass a function returning an
+                                async iterator to defer producing the data until the upload starts
+                                and to allow it to be re-sent if the request is rate limited.
+
+            send_payload()      params: op, d, s, t,    payload fields.
+
+                                Send a payload to the gateway through the connection's
+                                gateway_send_queue (self.sendQueue), which keeps within the gateway
+                                rate limit and always sends heartbeats first.
+
+            update_status()     params: status,     'online', 'dnd', 'idle' or 'invisible'.
+                                        game,       Activity object or None.
+                                        afk,        Whether the bot is AFK.
+                                        since,      Unix time in milliseconds the bot went idle, or None.
+
+                                Send a STATUS_UPDATE. Repeated updates waiting in the outbound
+                                queue are coalesced into the latest one.
+
+            request_guild_members()
+                                params: guild_ids,  Guild ID or list of guild IDs.
+                                        query,      Only members whose username starts with this. (Default "", all)
+                                        limit,      Maximum members per guild, 0 for no limit.
+                                        presences,  Whether to include presences.
+                                        user_ids,   Request these users rather than a query.
+                                        batchSize,  Guilds per REQUEST_GUILD_MEMBERS payload. (Default 50)
+                                        timeout,    Seconds to wait for each chunk. (Default 30)
+
+                                Async generator. Sends REQUEST_GUILD_MEMBERS payloads in batches
+                                through the rate limited outbound queue, and yields each
+                                GUILD_MEMBERS_CHUNK event as it arrives, matched by nonce.
+                                Finishes once every chunk of every guild has been received.
+
+                                    async for chunk in bot.request_guild_members(guild_ids):
+                                        ...
+
+            register_message()  params: opcode,     OPCODE for which this function should be bound to.
+                                        func,       Function to bind this opcode to.
+
+                                Place a function into the message_registry dict.
+
+            message()           params: opcode,     "
+                                
+                                Function decorator to pass a decorated function to register_message()
+
+            register_dispatch() params: event,      OPCODE 0 DISPATCH event for which this function
+                                                    should be bound to.
+                                        func,       Function to bind this event to.
+
+                                Place a function into the dispatch_registry dict.
+            
+            dispatch()          params: event,      "
+                            
+                                Function decorator to pass a decorated function to register_dispatch()
+    """
+
+    # Some information about the current session
+    user = None             # User bot is running under, we will assign this a value later
+    private_channels = []   # Private message channels
+    guilds = None           # Guilds bot is a member of, a guild_cache created in __init__. Keyed by ID.
+    session_id = None       # Current Session ID of the bot. Used for resuming in case of connection loss.
+    ws = None               # Current gateway websocket.
+
+
+    APIToken = None
+
+    session = None          # Shared aiohttp ClientSession, created in start() and used for every REST call.
+
+    def __init__(self, botToken, clientID=None, clientSecret=None, **kwargs):
+        self.botToken = botToken
+        self.clientID = clientID
+        self.clientSecret = clientSecret
+        self.userAgent = "FalseBot (Python 3.7 AIOHTTP)"
+
+        # Connection pool settings for the shared HTTP session.
+        self.connectionLimit = kwargs['connectionLimit'] if 'connectionLimit' in kwargs else 100
+        self.connectionLimitPerHost = kwargs['connectionLimitPerHost'] if 'connectionLimitPerHost' in kwargs else 10
+        self.keepaliveTimeout = kwargs['keepaliveTimeout'] if 'keepaliveTimeout' in kwargs else 30
+        self.dnsCacheTTL = kwargs['dnsCacheTTL'] if 'dnsCacheTTL' in kwargs else 300
+
+        # RESTful API base url, may point at a local stand-in server for testing.
+        self.apiUrl = kwargs['apiUrl'] if 'apiUrl' in kwargs else apiUrl
+
+        # Merge say_in_channel() messages per channel over this many seconds, see reply_coalescer.
+        self.coalescer = None
+        if 'coalesceWindow' in kwargs and kwargs['coalesceWindow']:
+            self.coalescer = reply_coalescer(lambda channel_id, content: self.create_message(channel_id, data={'content':content}),
+                    window=kwargs['coalesceWindow'])
+
+        # Snapshot of the session and caches for warm restarts, see save_snapshot().
+        self.snapshotFile = kwargs['snapshotFile'] if 'snapshotFile' in kwargs else None
+        self.snapshotInterval = kwargs['snapshotInterval'] if 'snapshotInterval' in kwargs else 60
+
+        # Maximum number of send_file() uploads in flight at once.
+        self.maxUploads = kwargs['maxUploads'] if 'maxUploads' in kwargs else 4
+
+        # Record every gateway message received to this file as JSON lines, for replay().
+        self.recordFile = kwargs['recordFile'] if 'recordFile' in kwargs else None
+
+        # Instrumentation, see the instrumentation class. None when disabled.
+        self.metrics = instrumentation() if 'instrument' in kwargs and kwargs['instrument'] else None
+
+        # Run dispatch handlers on worker tasks (and processes) with events queued per guild or
+        # channel, see event_scheduler. None runs them inline in the read loop.
+        self.partition = kwargs['partition'] if 'partition' in kwargs else 'guild'
+        self.scheduler = None
+        maxPending = kwargs['maxPending'] if 'maxPending' in kwargs else 10000
+        if 'processes' in kwargs and kwargs['processes']:
+            self.scheduler = process_scheduler(self, kwargs['processes'],
+                    kwargs['workers'] if 'workers' in kwargs and kwargs['workers'] else 8, maxPending)
+        elif 'workers' in kwargs and kwargs['workers']:
+            self.scheduler = event_scheduler(self.run_dispatch_handler, kwargs['workers'], maxPending, metrics=self.metrics)
+
+        # All REST calls are scheduled through the rate limiter.
+        self.ratelimiter = rate_limiter()
+        self.ratelimiter.metrics = self.metrics
+
+        # Gateway transport compression (zlib-stream).
+        self.compress = kwargs['compress'] if 'compress' in kwargs else False
+        self.decoder = zlib_stream_decoder() if self.compress else None
+
+        # Gateway payload encoding, 'json' or 'etf'.
+        self.codec = get_codec(kwargs['encoding'] if 'encoding' in kwargs else "json")
+
+        # Skip decoding DISPATCH events nothing subscribes to, see subscribed().
+        self.lazyDecode = kwargs['lazyDecode'] if 'lazyDecode' in kwargs else True
+        self.skippedEvents = 0
+
+        # Gateway intents to IDENTIFY with. None sends none, True derives them from subscriptions.
+        self.intents = kwargs['intents'] if 'intents' in kwargs else None
+
+        # Sharding. shard is [shard_id, num_shards] and sent with IDENTIFY. A shard_manager passes
+        # the gateway url it already looked up and an identify limiter shared by every shard.
+        self.shard = list(kwargs['shard']) if 'shard' in kwargs else None
+        self.gatewayUrl = kwargs['gatewayUrl'] if 'gatewayUrl' in kwargs else None
+        self.identifyLimiter = kwargs['identifyLimiter'] if 'identifyLimiter' in kwargs else None
+        self.identifyPermit = False     # Whether connect() already waited for our turn to IDENTIFY.
+        self.mainConnection = kwargs['mainConnection'] if 'mainConnection' in kwargs else None
+
+        # Guild state. Shards share one guild_cache passed as guildCache.
+        if 'guildCache' in kwargs:
+            self.guilds = kwargs['guildCache']
+        else:
+            self.guilds = guild_cache(
+                    cacheMembers=kwargs['cacheMembers'] if 'cacheMembers' in kwargs else 'on_demand',
+                    cachePresences=kwargs['cachePresences'] if 'cachePresences' in kwargs else False)
+    
+    # Register functions to Discord API low-level events.
+    dispatch_registry = {}
+    def register_dispatch(self, event, func):
+        if event in self.dispatch_registry:
+            print(f"WARNING: Dispatch event {event} already registered, re-registering to {func.__name__}")
+        self.dispatch_registry[event] = func
+    
+    # @bot.dispatch(event) decorator
+    def dispatch(self, event):
+        def decorator(func):
+            self.register_dispatch(event, func)
+            return func
+        return decorator 
+
+    # Some bots may also need to know about specific opcodes.
+    message_registry = {}
+    def register_message(self, opcode, func):
+        if opcode in self.message_registry:
+            print(f"WARNING: Opcode {opcode} already registered, re-registering to {func.__name__}")
+        self.message_registry[opcode] = as_coroutine(func)
+    
+    # @bot.message(opcode) decorator
+    def message(self, opcode):
+        def decorator(func):
+            self.register_message(opcode, func)
+            return func
+        return decorator
+
+    # Create the long-lived HTTP session. Connections are pooled and kept alive between calls
+    # so we don't pay for a new TCP+TLS handshake on every message we send.
+    def open_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                    limit=self.connectionLimit,
+                    limit_per_host=self.connectionLimitPerHost,
+                    keepalive_timeout=self.keepaliveTimeout,
+                    ttl_dns_cache=self.dnsCacheTTL
+                    )
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close_session(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    # Return the JSON body from a Discord RESTful API GET call.
+    async def api_get_call(self, path, url=None, **kwargs):
+        url = url or self.apiUrl
+        return await self.ratelimiter.request(self.open_session(), 'GET', url, path, **kwargs)
+
+    # Same as above with a JSON POST payload.
+    async def api_post_call(self, path, **kwargs):
+        headers = {
+                'Authorization': 'Bot ' + self.botToken,
+                'User-Agent': self.userAgent
+                }
+
+        if 'json' in kwargs:
+            headers['Content-Type'] = 'application/json'
+
+        kwargs['headers'] = headers
+
+        return await self.ratelimiter.request(self.open_session(), 'POST', self.apiUrl, path, **kwargs)
+    
+
+    # Download an attachment (or any other URL) with the shared session, streaming it so we can
+    # give up as soon as it grows past maxSize bytes. Attachments are served by the CDN so
+    # they don't count against the API rate limits.
+    async def fetch_attachment(self, url, maxSize=8*1024*1024):
+        session = self.open_session()
+        async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
+            assert 200 == response.status, response.reason
+            if response.content_length and response.content_length > maxSize:
+                raise ValueError(f"Attachment is {response.content_length} bytes, larger than {maxSize}")
+
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64*1024):
+                data += chunk
+                if len(data) > maxSize:
+                    raise ValueError(f"Attachment is larger than {maxSize} bytes")
+            return bytes(data)
+
+    # Send a create message command via the Discord RESTful API.
+    async def create_message_async(self, channel_id, **kwargs):
+        await self.api_post_call(f"/channels/{channel_id}/messages",
+                **kwargs
+                )
+    
+    # Callable without await-ing
+    def create_message(self, channel_id, **kwargs):
+        return self.message_task(self.create_message_async(channel_id, **kwargs))
+
+    # Run a coroutine sending a message as a task.
+    messageTasks = None     # Outstanding message tasks, finished before the session is closed.
+    def message_task(self, coro):
+        task = asyncio.get_event_loop().create_task(coro)
+        if self.messageTasks is None:
+            self.messageTasks = set()
+        self.messageTasks.add(task)
+        task.add_done_callback(self.messageTasks.discard)
+        return task
+
+    def say_in_channel(self, channel_id, message):
+        if self.coalescer is not None:
+            self.coalescer.add(channel_id, message)
+        else:
+            self.create_message(channel_id, data={'content':message})
+
+    # Upload a file with a message. 'file' may be a file-like object, bytes-like (bytes, bytearray or a
+    # memoryview, which is sent without being copied), an async iterator of bytes, or a function
+    # returning an async iterator so the data is only produced once the upload starts. The multipart
+    # body is streamed, never assembled in memory.
+    def send_file(self, channel_id, file, filename=None, **kwargs):
+        return self.message_task(self.send_file_async(channel_id, file, filename, **kwargs))
+
+    uploadSemaphore = None  # At most maxUploads uploads at once, created on first use.
+    async def send_file_async(self, channel_id, file, filename=None, **kwargs):
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            content = lambda: aiohttp.payload.BytesPayload(file)
+        elif hasattr(file, 'read'):
+            def content():
+                file.seek(0)
+                return file
+        elif callable(file):
+            content = lambda: aiohttp.payload.AsyncIterablePayload(file())
+        else:
+            iterator = [file]
+            def content():
+                if not iterator:
+                    raise RuntimeError("An async iterator can only be uploaded once, pass a function returning one so it can be re-sent")
+                return aiohttp.payload.AsyncIterablePayload(iterator.pop())
+
+        # A multipart body can only be sent once, so build a fresh one whenever the rate limiter
+        # needs to (re)send the request.
+        def form():
+            writer = aiohttp.MultipartWriter('form-data')
+            part = writer.append(json.dumps(kwargs), {'Content-Type': 'application/json'})
+            part.set_content_disposition('form-data', name='payload_json')
+            part = writer.append(content(), {'Content-Type': 'application/octet-stream'})
+            part.set_content_disposition('form-data', name='file', filename=filename or 'file')
+            return writer
+
+        if self.uploadSemaphore is None:
+            self.uploadSemaphore = asyncio.Semaphore(self.maxUploads)
+        async with self.uploadSemaphore:
+            await self.create_message_async(channel_id, data=form)
+
+
+    # Send a payload to the server. Goes through the outbound queue while connected, see gateway_send_queue.
+    sendQueue = None
+    async def send_payload(self, op, d, s=None, t=None):
+        payload = {"op":op, "d":d, "s":s, "t":t}
+        if self.sendQueue is not None:
+            await self.sendQueue.put(payload)
+        else:
+            await self.send_raw(payload)
+
+    # Write a payload straight to the websocket.
+    async def send_raw(self, payload):
+        data = self.codec.dumps(payload)
+        if isinstance(data, bytes):
+            await self.ws.send_bytes(data)
+        else:
+            await self.ws.send_str(data)
+
+
+    # Update the bot's presence (https://discordapp.com/developers/docs/topics/gateway#update-status)
+    async def update_status(self, status="online", game=None, afk=False, since=None):
+        payload = { "since":    since,
+                    "game":     game,
+                    "status":   status,
+                    "afk":      afk }
+        await self.send_payload(opcodes.STATUS_UPDATE, payload)
+
+    # Request guild members and yield GUILD_MEMBERS_CHUNK events as they arrive.
+    # See https://discordapp.com/developers/docs/topics/gateway#request-guild-members
+    member_requests = None  # nonce: asyncio.Queue of chunks for the request_guild_members() call.
+    member_nonce = itertools.count()
+
+    async def request_guild_members(self, guild_ids, query="", limit=0, presences=False, user_ids=None, batchSize=50, timeout=30):
+        if isinstance(guild_ids, (str, int)):
+            guild_ids = [guild_ids]
+        guild_ids = list(dict.fromkeys(str(g) for g in guild_ids))
+        if self.member_requests is None:
+            self.member_requests = {}
+
+        # Every batch shares one queue, so chunks are yielded in the order they arrive and
+        # nothing piles up waiting for an earlier batch to finish.
+        queue = asyncio.Queue()
+        remaining = { g: None for g in guild_ids }  # guild_id: chunks still expected, None until the first arrives.
+        batches = [guild_ids[i:i + batchSize] for i in range(0, len(guild_ids), batchSize)]
+        nonces = [f"{next(self.member_nonce)}-{int(time.time() * 1000)}" for batch in batches]
+        for nonce in nonces:    # Register every batch before sending anything so no chunk can arrive unclaimed.
+            self.member_requests[nonce] = queue
+
+        sender = asyncio.ensure_future(self.send_member_requests(batches, nonces, query, limit, presences, user_ids))
+        try:
+            while remaining:
+                chunk = await asyncio.wait_for(queue.get(), timeout)
+                gid = str(chunk['guild_id'])
+                if gid not in remaining:
+                    continue
+                if remaining[gid] is None:
+                    remaining[gid] = chunk['chunk_count'] if 'chunk_count' in chunk else 1
+                remaining[gid] -= 1
+                if remaining[gid] <= 0:
+                    del remaining[gid]
+                yield chunk
+        finally:
+            sender.cancel()
+            for nonce in nonces:
+                self.member_requests.pop(nonce, None)
+
+    async def send_member_requests(self, batches, nonces, query, limit, presences, user_ids):
+        for batch, nonce in zip(batches, nonces):
+            payload = { "guild_id":     batch if len(batch) > 1 else batch[0],
+                        "limit":        limit,
+                        "presences":    presences,
+                        "nonce":        nonce }
+            if user_ids:
+                payload["user_ids"] = user_ids
+            else:
+                payload["query"] = query
+            await self.send_payload(opcodes.REQUEST_GUILD_MEMBERS, payload)    # Paced by the outbound queue.
+
+    # Hand a GUILD_MEMBERS_CHUNK to the request_guild_members() call waiting for it.
+    def handle_members_chunk(self, event):
+        nonce = event['nonce'] if 'nonce' in event else None
+        if self.member_requests and nonce in self.member_requests:
+            self.member_requests[nonce].put_nowait(event)
+
+    # Heartbeat information
+    ack = True
+    sequence = None
+    heartbeat_task = None
+    heartbeat_sent = None   # time.monotonic() the last heartbeat was sent.
+    latencies = None        # Recent heartbeat round trip times in seconds, see latency.
+    latencyWindow = 100     # Number of heartbeats latency statistics are kept for.
+    
+    # Send a heartbeat to the server at the correct interval.
+    # Beats are scheduled against fixed monotonic deadlines so send time and loop lag don't
+    # accumulate as drift, and the first beat is jittered as the documentation asks.
+    async def heartbeat(self, interval):
+        interval = interval / 1000
+        deadline = time.monotonic() + interval * random.random()
+        while True:
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+            if not self.ack:                # We did not receive a HEARTBEAT_ACK response. The connection is a zombie.
+                print("WARNING: Did not receive HEARTBEAT_ACK. Connection is dead, reconnecting.")
+                await self.reconnect()
+                return
+            await self.send_heartbeat()
+
+            deadline += interval
+            if deadline < time.monotonic():  # The loop stalled for longer than a whole interval, don't burst to catch up.
+                deadline = time.monotonic() + interval
+
+    async def send_heartbeat(self):
+        self.ack = False                    # Reset response marker
+        self.heartbeat_sent = time.monotonic()
+        await self.send_payload(opcodes.HEARTBEAT, self.sequence)
+
+    # Record the round trip time of the last heartbeat.
+    def heartbeat_ack(self):
+        self.ack = True
+        if self.heartbeat_sent is not None:
+            if self.latencies is None:
+                self.latencies = deque(maxlen=self.latencyWindow)
+            self.latencies.append(time.monotonic() - self.heartbeat_sent)
+            self.heartbeat_sent = None
+
+    # Round trip time in seconds of the last acknowledged heartbeat, or None.
+    @property
+    def latency(self):
+        return self.latencies[-1] if self.latencies else None
+
+    # Percentile (0-100) of recent heartbeat round trip times, or None.
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    @property
+    def latency_p50(self):
+        return self.latency_percentile(50)
+
+    @property
+    def latency_p99(self):
+        return self.latency_percentile(99)
+
+    def stop_heartbeat(self):
+        if self.heartbeat_task is not None:
+            if self.heartbeat_task is not asyncio.current_task():   # The heartbeat may be stopping itself.
+                self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    # Reconnect state
+    closed = False          # Set by close(), stops start() from reconnecting.
+    reconnects = 0          # Consecutive reconnect attempts, reset once READY or RESUMED is received.
+    maxBackoff = 60         # Maximum seconds to wait between reconnect attempts.
+
+    # Gateway close codes after which we must not reconnect at all, and after which we may
+    # reconnect but can't resume. See https://discordapp.com/developers/docs/topics/opcodes-and-status-codes#gateway-close-event-codes
+    fatal_close_codes = (4004, 4010, 4011, 4012, 4013, 4014)
+    session_close_codes = (4007, 4009)
+
+    # Close the websocket so start() reconnects. A close code other than 1000 or 1001
+    # keeps the session alive on Discord's side so we can resume it.
+    async def reconnect(self, code=4000):
+        self.stop_heartbeat()
+        if self.ws is not None and not self.ws.closed:
+            await self.ws.close(code=code)
+
+    # Close the connection for good. Closing with code 1000 ends the session on Discord's side.
+    keepSession = False
+    async def close(self, keepSession=False):
+        self.closed = True
+        self.keepSession = keepSession
+        self.stop_heartbeat()
+        if self.ws is not None and not self.ws.closed:
+            await self.ws.close(code=4000 if keepSession else 1000)
+
+    # Objects saved with every snapshot. { name: (GET, SET) }. GET is called on the event loop and
+    # must return a copy, which is pickled in another thread while events keep arriving.
+    snapshot_registry = {}
+    def register_snapshot(self, name, get, set):
+        self.snapshot_registry[name] = (get, set)
+
+    snapshotVersion = 1
+    def save_snapshot(self):
+        self.write_snapshot(self.snapshot_state())
+
+    # Same as above, pickling and writing the file in an executor so the event loop keeps running.
+    # Writes happen one at a time, in order.
+    snapshotWrite = None
+    async def save_snapshot_async(self):
+        if self.snapshotWrite is not None:
+            await asyncio.wait([self.snapshotWrite])
+        state = self.snapshot_state()
+        self.snapshotWrite = asyncio.get_event_loop().run_in_executor(None, self.write_snapshot, state)
+        await asyncio.shield(self.snapshotWrite)   # Finish the write even if we are cancelled.
+
+    # Everything a snapshot holds, taken on the event loop. The guild cache and registry entries
+    # are copies, see register_snapshot().
+    def snapshot_state(self):
+        return {
+                "version":      self.snapshotVersion,
+                "saved":        time.time(),
+                "shard":        self.shard,
+                "session_id":   self.session_id,
+                "sequence":     self.sequence,
+                "gatewayUrl":   self.gatewayUrl,
+                "user":         self.user,
+                "guilds":       self.guilds.snapshot(self.shard),
+                "registry":     { name: get() for name,(get,set) in self.snapshot_registry.items() }
+                }
+
+    def write_snapshot(self, state):
+        temporary = self.snapshotFile + ".tmp"
+        with open(temporary, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.snapshotFile)
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshotFile, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"WARNING: Could not load snapshot {self.snapshotFile}: {e!r}")
+            return False
+        if not isinstance(state, dict) or state.get('version') != self.snapshotVersion:
+            print(f"WARNING: Ignoring snapshot {self.snapshotFile} from a different version")
+            return False
+
+        if state['shard'] != self.shard:
+            print(f"WARNING: Ignoring the session and guilds in snapshot {self.snapshotFile} from shard {state['shard']}")
+        else:
+            if state['session_id']:
+                self.session_id = state['session_id']
+                self.sequence = state['sequence']
+                self.set_user(state['user'])
+            self.guilds.restore(state['guilds'])
+        self.gatewayUrl = self.gatewayUrl or state['gatewayUrl']
+        for name,value in state['registry'].items():
+            if name in self.snapshot_registry:
+                self.snapshot_registry[name][1](value)
+
+        print(f"Loaded snapshot from {time.time() - state['saved']:.0f}s ago with {len(self.guilds)} guilds")
+        return True
+
+    # Save a snapshot every snapshotInterval seconds.
+    async def snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshotInterval)
+            try:
+                await self.save_snapshot_async()
+            except Exception as e:
+                print(f"WARNING: Could not save snapshot {self.snapshotFile}: {e!r}")
+
+    # Forget the current session so the next connection sends IDENTIFY rather than RESUME.
+    def invalidate_session(self):
+        self.session_id = None
+        self.sequence = None
+
+    # DISPATCH events the connection handles itself, see handle_dispatch().
+    connection_events = ('READY', 'RESUMED', 'GUILD_CREATE', 'GUILD_MEMBERS_CHUNK')
+
+    def subscribed(self, eventType):
+        return (eventType in self.dispatch_registry or eventType in self.connection_events
+                or self.guilds.wants(eventType) or opcodes.DISPATCH in self.message_registry)
+
+    def subscribed_intents(self):
+        return intents.for_events(self.dispatch_registry) | self.guilds.intents()
+
+    # Handlers attached to a shard_manager's connection need the bot's user whichever shard is ready first.
+    def set_user(self, user):
+        self.user = user
+        if self.mainConnection is not None:
+            self.mainConnection.user = user
+
+    # Handle a 'DISPATCH' event.
+    async def handle_dispatch(self, message):
+        eventType = message['t']
+        event = message['d']
+
+        if eventType == 'READY':
+            if self.session_id:
+                print("WARNING: Received repeat 'READY' Event although session is already running.")
+
+            self.set_user(event['user'])
+            self.session_id = event['session_id']
+            print("My username is %s" % self.user['username'])
+            print("I am in %i guilds" % len(event['guilds']))
+
+            self.reconnects = 0
+
+        elif eventType == 'RESUMED':    # Missed events have been replayed, we are fully caught up.
+            print(f"Session {self.session_id} resumed")
+            self.reconnects = 0
+
+        elif eventType == 'GUILD_CREATE': # Server has made a guild available to us.
+            gid = event['id']
+            if gid in self.guilds and not self.guilds[gid].unavailable:
+                print(f"WARNING: Received repeat GUILD_CREATE event for guild id {gid} ({event['name']})")
+
+        elif eventType == 'GUILD_MEMBERS_CHUNK':
+            self.handle_members_chunk(event)
+
+        # Keep the guild cache up to date, and the copies in any worker processes.
+        self.guilds.handle(eventType, event)
+        if isinstance(self.scheduler, process_scheduler) and self.guilds.wants(eventType):
+            self.scheduler.update_cache(eventType, event)
+
+        # Pass off to any function registered for this event by registrar.
+        if eventType in self.dispatch_registry:
+            if self.scheduler is not None:
+                await self.scheduler.submit(self.event_key(event), eventType, event)
+            else:
+                await self.run_dispatch_handler(eventType, event)
+
+    # Call the function registered for an event.
+    async def run_dispatch_handler(self, eventType, event):
+        func = self.dispatch_registry[eventType]
+        if self.metrics is not None:
+            await self.metrics.timed('handler', func.__name__, func(event))
+        else:
+            await func(event)
+
+    # Queue key for an event under the partition setting. Events without a guild or channel share one queue.
+    def event_key(self, event):
+        if not isinstance(event, dict):
+            return None
+        if self.partition == 'channel':
+            return event.get('channel_id') or event.get('guild_id')
+        return event.get('guild_id') or event.get('channel_id')
+
+    async def handle_message(self, message):
+        """
+            Called for every message received by websocket connection.
+            Message types are defined by 'https://discordapp.com/developers/docs/topics/opcodes-and-status-codes#gateway-opcodes'
+            We must process these messages and respond appropriately.
+
+            DISPATCH:           These are the messages which hold the "real" data. we'll hand this off to the dispatch_handler function
+                                to keep it clean.
+            HEARTBEAT:          The server asks for a heartbeat immediately. Send one.
+            RECONNECT:          We must disconnect and reconnect to the gateway for a given reason. Close the
+                                connection, start() will reconnect and resume.
+            INVALID_SESSION:    Notify us the session ID is invalid. Wait 1-5 seconds as the documentation asks,
+                                then RESUME if the server says the session is resumable or IDENTIFY if not.
+            HELLO:              Received immediately after connecting. Contains crucial heartbeat_interval information.
+                                Start heartbeating and either RESUME the previous session or IDENTIFY.
+            HEARTBEAT_ACK:      Must be received in between every heartbeat message we send. Some is wrong if we don't.
+        """
+        opcode = message['op']
+
+        if opcode == opcodes.DISPATCH:              # Message was a 'DISPATCH' event. Hand it over to the dispatch_handler...
+            self.sequence = message['s']            # Sequence number used for heartbeat and resume messages.
+            if self.metrics is not None:
+                await self.metrics.timed('dispatch_event', message['t'], self.handle_dispatch(message))
+            else:
+                await self.handle_dispatch(message)
+
+        elif opcode == opcodes.HEARTBEAT:           # Server wants a heartbeat right away.
+            await self.send_heartbeat()
+
+        elif opcode == opcodes.RECONNECT:
+            print("RECONNECT received, reconnecting")
+            await self.reconnect()
+
+        elif opcode == opcodes.INVALID_SESSION:
+            await asyncio.sleep(random.uniform(1, 5))
+            if message['d'] and self.session_id:
+                await self.resume()
+            else:
+                print("WARNING: Session is invalid, re-identifying")
+                self.invalidate_session()
+                await self.identify()
+
+        elif opcode == opcodes.HELLO:               # Connection successful. Invoke the heartbeat function
+            interval = message['d']['heartbeat_interval']
+            print(f"HELLO received, heartbeat_interval set to {interval}")
+            self.stop_heartbeat()
+            self.ack = True
+            self.heartbeat_sent = None
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat(interval))
+
+            if self.session_id and self.sequence is not None:
+                await self.resume()
+            else:
+                await self.identify()
+
+        elif opcode == opcodes.HEARTBEAT_ACK:       # Mark heartbeat response as received
+            self.heartbeat_ack()
+
+        else:                                       # Unknown opcode.
+            print(f"WARNING: Unknown op code {opcode}")
+
+        # Pass off to any function registered for this opcode by registrar.
+        if opcode in self.message_registry:
+            func = self.message_registry[opcode]
+            if self.metrics is not None:
+                await self.metrics.timed('handler', func.__name__, func(message))
+            else:
+                await func(message)
+
+
+    # Send an IDENTIFY payload (https://discordapp.com/developers/docs/topics/gateway#identifying)
+    async def identify(self):
+        payload = { "token":        self.botToken,
+                    "properties":   {
+                        "$os":          "linux",
+                        "$browser":     "aiohttp",
+                        "$device":      "aiohttp"
+                        },
+                    "compress":     False,
+                    "presence":     {
+                        "since":        time.time(),
+                        "status":       "online",
+                        "afk":          False
+                        } }
+        if self.shard:
+            payload["shard"] = self.shard
+        if self.intents is True:
+            payload["intents"] = self.subscribed_intents()
+        elif self.intents is not None:
+            payload["intents"] = self.intents
+        if self.identifyLimiter and not self.identifyPermit:
+            await self.identifyLimiter.acquire(self.shard[0] if self.shard else 0)
+        self.identifyPermit = False     # One IDENTIFY per turn.
+        await self.send_payload(opcodes.IDENTIFY, payload)            
+
+    # Send a RESUME payload (https://discordapp.com/developers/docs/topics/gateway#resuming)
+    # The server will replay every event we missed since self.sequence, then send 'RESUMED'.
+    async def resume(self):
+        print(f"Resuming session {self.session_id} from sequence {self.sequence}")
+        payload = { "token":        self.botToken,
+                    "session_id":   self.session_id,
+                    "seq":          self.sequence }
+        await self.send_payload(opcodes.RESUME, payload)
+
+    # Connect to the gateway and process messages until the websocket closes.
+    # Returns the close code.
+    async def connect(self, session, gatewayUrl):
+        query = f"?v=6&encoding={self.codec.encoding}"
+        if self.compress:
+            query += "&compress=zlib-stream"
+            self.decoder.reset()        # Every connection has a new zlib context.
+
+        # Shards must take turns to IDENTIFY, wait for ours before connecting so the
+        # read loop is never held up. identify() waits itself if it has to IDENTIFY on a
+        # connection which meant to RESUME.
+        self.identifyPermit = False
+        if self.identifyLimiter and not self.session_id:
+            await self.identifyLimiter.acquire(self.shard[0] if self.shard else 0)
+            self.identifyPermit = True
+
+        record = open(self.recordFile, 'a') if self.recordFile else None
+        connected = time.monotonic()
+        try:
+            async with session.ws_connect(f"{gatewayUrl}{query}") as self.ws:
+                self.sendQueue = gateway_send_queue(self.send_raw)   # The rate limit is per connection.
+                self.sendQueue.start()
+                async for msg in self.ws:
+                    if msg.type in (aiohttp.WSMsgType.ERROR, aiohttp.WSMsgType.CLOSED):
+                        break
+                    data = msg.data
+                    if self.compress and msg.type == aiohttp.WSMsgType.BINARY: # Compressed, possibly only part of a message.
+                        data = self.decoder.feed(data)
+                        if data is None:
+                            continue
+                    if self.lazyDecode and record is None:
+                        head = self.codec.peek(data)    # (op, s, t) or None
+                        if head is not None and head[0] == opcodes.DISPATCH and not self.subscribed(head[2]):
+                            self.sequence = head[1]
+                            self.skippedEvents += 1
+                            continue
+                    message = self.codec.loads(data)
+                    if record:
+                        record.write(json.dumps({"time": time.monotonic() - connected, "frame": message}) + "\n")
+                    await self.process_message(message)
+                return self.ws.close_code
+        finally:
+            self.stop_heartbeat()
+            if self.sendQueue is not None:
+                self.sendQueue.stop()
+                self.sendQueue = None
+            if record:
+                record.close()
+
+    async def process_message(self, message):
+        if self.metrics is not None:
+            await self.metrics.timed('gateway_opcode', message['op'], self.handle_message(message))
+        else:
+            await self.handle_message(message)
+
+    # Feed recorded gateway messages (see recordFile) through the bot without connecting to
+    # Discord. With speed=None messages are replayed as fast as possible, otherwise at
+    # 'speed' times the recorded pace. Payloads the bot sends are counted, not sent.
+    async def replay(self, path, speed=None):
+        ws = self.ws
+        self.ws = replay_websocket()
+        events = 0
+        started = time.monotonic()
+        try:
+            with open(path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if speed:
+                        delay = started + record['time'] / speed - time.monotonic()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    await self.process_message(record['frame'])
+                    events += 1
+            if self.scheduler is not None:
+                await self.scheduler.drain()
+            elapsed = time.monotonic() - started
+            return {
+                    "events":               events,
+                    "seconds":              elapsed,
+                    "events_per_second":    events / elapsed if elapsed else 0.0,
+                    "payloads_sent":        self.ws.sent
+                    }
+        finally:
+            self.stop_heartbeat()
+            self.ws = ws
+
+    async def start(self):
+        #response = await self.api_post_call("/oauth2/token", params={'grant_type':'client_credentials', 'scope':'identify bot'}, auth=aiohttp.BasicAuth(self.clientID, self.clientSecret))
+        #self.APIToken = response['access_token']
+
+        session = self.open_session()
+        self.closed = False
+        lag = asyncio.ensure_future(self.metrics.sample_loop_lag()) if self.metrics is not None else None
+        snapshots = None
+        if self.snapshotFile:
+            self.load_snapshot()
+            snapshots = asyncio.ensure_future(self.snapshot_periodically())
+        try:
+            if not self.gatewayUrl:
+                response = await self.api_get_call("/gateway/bot", headers={"Authorization":"Bot " + self.botToken})
+                self.gatewayUrl = response['url']
+            gatewayUrl = self.gatewayUrl
+
+            while not self.closed:
+                if self.reconnects:     # Exponential backoff with jitter between reconnect attempts.
+                    delay = min(self.maxBackoff, 2 ** (self.reconnects - 1)) * random.uniform(0.5, 1)
+                    print(f"Reconnecting in {delay:.1f}s (attempt {self.reconnects})")
+                    await asyncio.sleep(delay)
+                self.reconnects += 1
+
+                try:
+                    code = await self.connect(session, gatewayUrl)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f"WARNING: Gateway connection failed: {e!r}")
+                    continue
+
+                if self.closed:
+                    break
+                print(f"WARNING: Gateway connection closed with code {code}")
+                if code in self.fatal_close_codes:
+                    raise ConnectionError(f"Gateway closed the connection with code {code}, not reconnecting")
+                if code in self.session_close_codes:
+                    self.invalidate_session()
+        finally:
+            if lag is not None:
+                lag.cancel()
+            if self.scheduler is not None:
+                await self.scheduler.close()
+            if snapshots is not None:
+                snapshots.cancel()
+                if self.closed and not self.keepSession:    # Closed with 1000, the session is over.
+                    self.invalidate_session()
+                try:
+                    await self.save_snapshot_async()
+                except Exception as e:
+                    print(f"WARNING: Could not save snapshot {self.snapshotFile}: {e!r}")
+            if self.coalescer is not None:
+                self.coalescer.flush_all()
+            if self.messageTasks:       # Let messages already on their way be sent.
+                await asyncio.wait(self.messageTasks, timeout=10)
+            await self.close_session()
+
+class gateway_send_queue:
+    """
+        Outbound queue for a gateway connection, keeping sends within the gateway's limit of
+        120 commands per 60 seconds.
+        See https://discordapp.com/developers/docs/topics/gateway#rate-limiting
+
+            queue = gateway_send_queue(send, rate=120, per=60, reserved=5)
+
+        Sends are counted over a sliding window of 'per' seconds, so no window ever holds more
+        than 'rate' of them; the tokens left are 'rate' minus the sends in the last 'per' seconds.
+        HEARTBEAT, RESUME and IDENTIFY payloads go in a priority lane which is always drained
+        first, and the last 'reserved' tokens can only be spent by the priority lane, so a burst
+        of other commands can never hold up a heartbeat. A STATUS_UPDATE replaces any STATUS_UPDATE still waiting to be
+        sent rather than queueing behind it.
+
+        Function Definitions:
+
+            start()             params: None
+
+                                Start the sender task.
+
+            stop()              params: None
+
+                                Stop the sender task, failing anything still queued with
+                                ConnectionResetError.
+
+            put()               params: payload,    gateway payload dict.
+
+                                Queue a payload and return a future resolved once it has been sent.
+
+            stats()             params: None
+
+                                Return a dict of queue lengths, tokens and counters.
+    """
+
+    priority_opcodes = (opcodes.HEARTBEAT, opcodes.RESUME, opcodes.IDENTIFY)
+
+    def __init__(self, send, rate=120, per=60, reserved=5):
+        self.send = send            # Coroutine function which writes a payload to the websocket.
+        self.rate = rate
+        self.per = per
+        self.reserved = reserved
+        self.tokens = rate
+        self.history = deque()      # time.monotonic() of every send in the last 'per' seconds.
+
+        self.priority = deque()     # [payload, future, time queued]
+        self.normal = deque()
+        self.wakeup = None
+        self.task = None
+
+        self.sent = 0
+        self.coalesced = 0
+        self.max_wait = 0.0
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for lane in (self.priority, self.normal):
+            while lane:
+                payload, future, queued = lane.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionResetError("Gateway connection closed before payload was sent"))
+
+    def put(self, payload):
+        if payload['op'] == opcodes.STATUS_UPDATE:
+            for entry in self.normal:
+                if entry[0]['op'] == opcodes.STATUS_UPDATE:  # Only the latest status matters.
+                    entry[0] = payload
+                    self.coalesced += 1
+                    return entry[1]
+
+        future = asyncio.get_event_loop().create_future()
+        lane = self.priority if payload['op'] in self.priority_opcodes else self.normal
+        lane.append([payload, future, time.monotonic()])
+        self.wakeup.set()
+        return future
+
+    def refill(self):
+        expired = time.monotonic() - self.per
+        while self.history and self.history[0] <= expired:
+            self.history.popleft()
+        self.tokens = self.rate - len(self.history)
+
+    async def run(self):
+        while True:
+            if not self.priority and not self.normal:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            self.refill()
+            lane = self.priority if self.priority else self.normal
+            needed = 1 if lane is self.priority else 1 + self.reserved
+            if self.tokens < needed:
+                # Wait until enough sends leave the window, but wake early if a priority payload arrives.
+                self.wakeup.clear()
+                try:
+                    expires = self.history[min(needed - self.tokens, len(self.history)) - 1] + self.per
+                    await asyncio.wait_for(self.wakeup.wait(), expires - time.monotonic())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            payload, future, queued = lane.popleft()
+            self.tokens -= 1
+            self.history.append(time.monotonic())
+            self.max_wait = max(self.max_wait, time.monotonic() - queued)
+            try:
+                await self.send(payload)
+                self.sent += 1
+                if not future.done():
+                    future.set_result(None)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self):
+        self.refill()
+        return {
+                "priority_queued":  len(self.priority),
+                "normal_queued":    len(self.normal),
+                "tokens":           self.tokens,
+                "sent":             self.sent,
+                "coalesced":        self.coalesced,
+                "max_wait":         self.max_wait
+                }
+
+class reply_coalescer:
+    """
+        Merges messages sent to the same channel in quick succession into one create message
+        call, enabled with discord_bot_connection(coalesceWindow=seconds).
+
+            coalescer = reply_coalescer(send, window=0.5, limit=2000)
+
+        The first message for a channel starts a timer of 'window' seconds. Messages for that
+        channel arriving before it fires are joined with newlines and sent together when it does,
+        or straight away once the next message would take the batch over 'limit' characters (the
+        Discord message length limit). A message identical to the one before it in the batch is
+        dropped. send is called as send(channel_id, content).
+
+        Function Definitions:
+
+            add()               params: channel_id, message
+
+                                Queue a message for a channel.
+
+            flush()             params: channel_id
+
+                                Send whatever is queued for a channel now.
+
+            flush_all()         params: None
+
+                                Send everything queued. Called when the connection shuts down.
+
+            stats()             params: None
+
+                                Return a dict of messages queued, sent, deduplicated and the number
+                                of create message calls saved.
+    """
+
+    def __init__(self, send, window=0.5, limit=2000):
+        self.send = send
+        self.window = window
+        self.limit = limit
+        self.batches = {}   # channel_id: [messages, length, timer handle]
+        self.messages = 0
+        self.deduplicated = 0
+        self.sent = 0
+
+    def add(self, channel_id, message):
+        self.messages += 1
+        batch = self.batches.get(channel_id)
+        if batch is not None:
+            if batch[0][-1] == message:
+                self.deduplicated += 1
+                return
+            if batch[1] + 1 + len(message) > self.limit:
+                self.flush(channel_id)
+                batch = None
+
+        if batch is None:
+            handle = asyncio.get_event_loop().call_later(self.window, self.flush, channel_id)
+            self.batches[channel_id] = [[message], len(message), handle]
+        else:
+            batch[0].append(message)
+            batch[1] += 1 + len(message)
+
+    def flush(self, channel_id):
+        batch = self.batches.pop(channel_id, None)
+        if batch is None:
+            return
+        batch[2].cancel()
+        self.sent += 1
+        self.send(channel_id, "\n".join(batch[0]))
+
+    def flush_all(self):
+        for channel_id in list(self.batches):
+            self.flush(channel_id)
+
+    def stats(self):
+        return {
+                "messages":         self.messages,
+                "deduplicated":     self.deduplicated,
+                "sent":             self.sent,
+                "calls_saved":      self.messages - self.sent - sum(len(b[0]) for b in self.batches.values()),
+                "pending_channels": len(self.batches)
+                }
+
+class event_scheduler:
+    """
+        Runs DISPATCH handlers on a pool of worker tasks, enabled with
+        discord_bot_connection(workers=N).
+
+            scheduler = event_scheduler(handler, workers=8, maxPending=10000, metrics=None)
+
+        handler is a coroutine function called as handler(eventType, event). Events are queued by
+        a key, normally their guild or channel ID. Events with the same key are handled one at a
+        time in the order they were submitted, events with different keys are handled in parallel.
+        Keys with events waiting take turns one event at a time, so a busy guild can't hold up the
+        others. Once maxPending events are waiting submit() waits for room, which holds up the
+        gateway read loop rather than letting the queues grow without bound.
+
+        Function Definitions:
+
+            submit()            params: key, eventType, event
+
+                                Queue an event. Starts the worker tasks on first use.
+
+            drain()             params: None
+
+                                Wait until every queued event has been handled.
+
+            close()             params: None
+
+                                Drain, then stop the worker tasks.
+
+            stats()             params: None
+
+                                Return a dict of queued, handled and failed counts and queue sizes.
+    """
+
+    def __init__(self, handler, workers=8, maxPending=10000, metrics=None):
+        self.handler = handler
+        self.workers = workers
+        self.maxPending = maxPending
+        self.metrics = metrics
+        self.queues = {}        # key: deque of (eventType, event, time queued). A key with a queue is in
+                                # self.ready or being handled by a worker.
+        self.ready = None       # asyncio.Queue of keys with events waiting, created on first use.
+        self.slots = None       # Semaphore of maxPending.
+        self.idle = None        # Set whenever nothing is pending.
+        self.tasks = []
+        self.pending = 0
+        self.handled = 0
+        self.failed = 0
+        self.maxQueue = 0
+
+    def start(self):
+        self.ready = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.maxPending)
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.tasks = [asyncio.ensure_future(self.worker()) for i in range(self.workers)]
+
+    async def submit(self, key, eventType, event):
+        if self.ready is None:
+            self.start()
+        await self.slots.acquire()
+        self.pending += 1
+        self.idle.clear()
+
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.ready.put_nowait(key)
+        queue.append((eventType, event, time.monotonic()))
+        self.maxQueue = max(self.maxQueue, len(queue))
+
+    async def worker(self):
+        while True:
+            key = await self.ready.get()
+            queue = self.queues[key]
+            eventType, event, queued = queue.popleft()
+            if self.metrics is not None:
+                self.metrics.observe('queue_wait', '', time.monotonic() - queued)
+            try:
+                await self.handler(eventType, event)
+                self.handled += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"WARNING: Handler for {eventType} raised {e!r}")
+            finally:
+                self.slots.release()
+                self.pending -= 1
+                if self.pending == 0:
+                    self.idle.set()
+
+            if queue:
+                self.ready.put_nowait(key)  # To the back of the line, behind every other waiting key.
+            else:
+                del self.queues[key]
+
+    async def drain(self):
+        if self.idle is not None:
+            await self.idle.wait()
+
+    async def close(self):
+        await self.drain()
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.ready = None
+
+    def stats(self):
+        return {
+                "pending":      self.pending,
+                "handled":      self.handled,
+                "failed":       self.failed,
+                "keys":         len(self.queues),
+                "max_queue":    self.maxQueue
+                }
+
+# Entry point for event worker processes started by process_scheduler. The bot is the parent's
+# connection, inherited through fork along with every registered handler.
+def run_event_worker(bot, conn, workers):
+    # Nothing the parent had open belongs to this process.
+    bot.session = None
+    bot.ws = None
+    bot.sendQueue = None
+    bot.messageTasks = None
+    bot.scheduler = None
+
+    async def work():
+        scheduler = event_scheduler(bot.run_dispatch_handler, workers=workers, metrics=bot.metrics)
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                item = await loop.run_in_executor(None, conn.recv)
+            except EOFError:
+                item = None
+            if item is None:
+                break
+            if item[0] == "drain":
+                await scheduler.drain()
+                conn.send(("drained", item[1]))
+                continue
+            if item[0] == "cache":
+                if item[1] == 'READY':
+                    bot.set_user(item[2]['user'])
+                bot.guilds.handle(item[1], item[2])
+                continue
+            if item[1] in process_scheduler.localCacheEvents:
+                bot.guilds.handle(item[1], item[2])
+            await scheduler.submit(*item)
+
+        await scheduler.close()
+        if bot.coalescer is not None:
+            bot.coalescer.flush_all()
+        if bot.messageTasks:
+            await asyncio.wait(bot.messageTasks, timeout=10)
+        await bot.close_session()
+
+    asyncio.run(work())
+
+class process_scheduler:
+    """
+        event_scheduler which fans events out to worker processes, enabled with
+        discord_bot_connection(processes=N). Each key always goes to the same process, so events
+        with the same key are still handled in order.
+
+            scheduler = process_scheduler(bot, processes=4, workers=8, maxPending=10000)
+
+        Processes are forked on first use and inherit the handlers registered by then. Each runs
+        an event_scheduler with 'workers' worker tasks and its own HTTP session, so handlers can
+        use the RESTful API (say_in_channel() etc.) but not the gateway. Events are sent to the
+        processes over multiprocessing pipes by one writer task per pipe, which does the blocking
+        send in an executor so a busy worker process never stalls the event loop. Once maxPending
+        events are waiting to be sent submit() waits for room, as for event_scheduler.
+
+        Each process has its own copy of the bot's guild_cache and user, forked from the parent.
+        update_cache(eventType, event), called by the bot for every event its cache tracks, keeps
+        the copies current: READY and the guild, channel, role, member and presence events are
+        sent to every process, ahead of any event submitted after them. MESSAGE_CREATE is not, as
+        that would send every message to every process; the members it caches are only added to
+        the copy of the process which handles the message. So, with partition='guild', a process
+        has every member seen in the guilds it handles, but may be missing members other processes
+        saw in messages.
+
+        submit(), drain(), close() and stats() are as for event_scheduler.
+    """
+
+    # Cache events applied only by the process which the event is submitted to.
+    localCacheEvents = ('MESSAGE_CREATE',)
+
+    def __init__(self, bot, processes=4, workers=8, maxPending=10000):
+        self.bot = bot
+        self.processes = processes
+        self.workers = workers
+        self.maxPending = maxPending
+        self.pipes = []
+        self.children = []
+        self.outboxes = []      # asyncio.Queue per pipe of messages for its writer task.
+        self.writers = []
+        self.slots = None       # Semaphore of maxPending.
+        self.pending = 0        # Events submitted but not yet sent to a process.
+        self.submitted = 0
+
+    def start(self):
+        context = multiprocessing.get_context("fork")   # Handlers are inherited, not pickled.
+        for i in range(self.processes):
+            parent, child = context.Pipe()
+            process = context.Process(target=run_event_worker, args=(self.bot, child, self.workers), daemon=True)
+            process.start()
+            child.close()               # So recv() raises EOFError if the worker exits.
+            self.children.append(process)
+            self.pipes.append(parent)
+        self.slots = asyncio.Semaphore(self.maxPending)
+        self.outboxes = [asyncio.Queue() for pipe in self.pipes]
+        self.writers = [asyncio.ensure_future(self.writer(pipe, outbox)) for pipe,outbox in zip(self.pipes, self.outboxes)]
+
+    # Send everything queued for a pipe, as many messages per executor call as are waiting.
+    # A None message is sent last and stops the writer.
+    async def writer(self, pipe, outbox):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await outbox.get()]
+            while not outbox.empty():
+                batch.append(outbox.get_nowait())
+            await loop.run_in_executor(None, self.send_all, pipe, batch)
+            for message in batch:
+                if message is not None and message[0] not in ("drain", "cache"):
+                    self.slots.release()
+                    self.pending -= 1
+            if batch[-1] is None:
+                return
+
+    @staticmethod
+    def send_all(pipe, batch):
+        for message in batch:
+            pipe.send(message)
+
+    async def submit(self, key, eventType, event):
+        if not self.pipes:
+            self.start()
+        await self.slots.acquire()
+        self.pending += 1
+        self.outboxes[hash(key) % self.processes].put_nowait((key, eventType, event))
+        self.submitted += 1
+
+    # Send a guild cache update to every process. Before the processes are started there is
+    # nothing to do, they fork with the parent's cache.
+    def update_cache(self, eventType, event):
+        if not self.pipes or eventType in self.localCacheEvents:
+            return
+        for outbox in self.outboxes:
+            outbox.put_nowait(("cache", eventType, event))
+
+    async def drain(self):
+        loop = asyncio.get_event_loop()
+        for i,(pipe,outbox) in enumerate(zip(self.pipes, self.outboxes)):
+            outbox.put_nowait(("drain", i))     # Behind every event already submitted.
+            await loop.run_in_executor(None, pipe.recv)
+
+    async def close(self):
+        loop = asyncio.get_event_loop()
+        for outbox in self.outboxes:
+            outbox.put_nowait(None)
+        await asyncio.gather(*self.writers)
+        for process in self.children:
+            await loop.run_in_executor(None, process.join)
+        for pipe in self.pipes:
+            pipe.close()
+        self.pipes = []
+        self.children = []
+        self.outboxes = []
+        self.writers = []
+
+    def stats(self):
+        return {
+                "submitted":    self.submitted,
+                "pending":      self.pending,
+                "processes":    len(self.children)
+                }
+
+class replay_websocket:
+    """
+        Stands in for the gateway websocket during discord_bot_connection.replay(), counting
+        the payloads the bot tries to send.
+    """
+
+    def __init__(self):
+        self.closed = False
+        self.sent = 0
+
+    async def send_str(self, data):
+        self.sent += 1
+
+    async def send_bytes(self, data):
+        self.sent += 1
+
+    async def close(self, code=1000):
+        self.closed = True
+
+class identify_limiter:
+    """
+        Enforce the gateway's IDENTIFY rate limit for a group of shards: one IDENTIFY per
+        5 seconds for each of max_concurrency buckets, where shard_id % max_concurrency
+        picks the bucket.
+        See https://discordapp.com/developers/docs/topics/gateway#sharding-max-concurrency
+
+            limiter = identify_limiter(max_concurrency)
+            await limiter.acquire(shard_id)
+    """
+
+    interval = 5
+
+    def __init__(self, max_concurrency=1):
+        self.max_concurrency = max_concurrency
+        self.buckets = {}       # bucket: [lock, time.monotonic() of the last IDENTIFY]
+
+    async def acquire(self, shard_id):
+        key = shard_id % self.max_concurrency
+        if key not in self.buckets:
+            self.buckets[key] = [asyncio.Lock(), 0]
+        bucket = self.buckets[key]
+
+        async with bucket[0]:
+            delay = bucket[1] + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            bucket[1] = time.monotonic()
+
+class pipe_identify_limiter:
+    """
+        identify_limiter for a shard worker process, which asks the parent shard_manager for
+        permission to IDENTIFY over a multiprocessing pipe so the limit holds across processes.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = None
+
+    async def acquire(self, shard_id):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        loop = asyncio.get_event_loop()
+        async with self.lock:           # One request in flight per pipe.
+            self.conn.send(("identify", shard_id))
+            await loop.run_in_executor(None, self.conn.recv)
+
+# Entry point for shard worker processes started by shard_manager.start_processes(). The
+# parent's connection is reused so handlers attached to it work in the worker too.
+def run_shard_worker(botToken, shard_ids, shard_count, gatewayUrl, conn, connection, kwargs):
+    # Nothing the parent had open belongs to this process.
+    connection.session = None
+    connection.messageTasks = None
+    connection.ratelimiter = rate_limiter()
+
+    manager = shard_manager(botToken, shardCount=shard_count, shardIds=shard_ids, gatewayUrl=gatewayUrl,
+            identifyLimiter=pipe_identify_limiter(conn), connection=connection, **kwargs)
+    asyncio.run(manager.start())
+
+class shard_manager:
+    """
+        Run several gateway connections (shards) for one bot.
+        See https://discordapp.com/developers/docs/topics/gateway#sharding
+
+            manager = shard_manager(botToken,
+                **kwargs { shardCount : integer,    Total number of shards. Defaults to the number
+                                                    recommended by /gateway/bot.
+                           shardIds : list,         Shards to run in this process. Defaults to all.
+                           snapshotFile : string,   Each shard snapshots its session and guilds to
+                                                    this path with its shard id appended, eg.
+                                                    bot.snapshot.0, see discord_bot_connection.
+                           anything else is passed on to every discord_bot_connection.
+                            }
+
+        Every shard is a discord_bot_connection. The dispatch and message registries and the
+        guild_cache are shared by all connections, so handlers registered on any shard (or on
+        manager.connection, eg. for discord_chat_handler) receive events from every shard.
+        manager.connection stays the same for the manager's lifetime: it makes REST calls on
+        its own session and its user is set by whichever shard is ready first. IDENTIFYs are
+        spaced out according to the session_start_limit's max_concurrency and every shard
+        heartbeats and reconnects on its own.
+
+        Function Definitions:
+
+            start()             params: None
+
+                                Look up the gateway, then start every shard in this process.
+                                Run with asyncio.run(manager.start())
+
+            start_processes()   params: processes,  Number of worker processes.
+
+                                Spread the shards over several worker processes instead. Worker
+                                processes inherit handlers registered before this is called and
+                                ask this process for permission before every IDENTIFY.
+
+            close()             params: None
+
+                                Close every shard in this process.
+
+            shard_for_guild()   params: guild_id
+
+                                Return the shard id which receives events for a guild.
+
+            connection_for_guild()
+                                params: guild_id
+
+                                Return the connection for a guild's shard, if it runs in this process.
+    """
+
+    def __init__(self, botToken, **kwargs):
+        self.botToken = botToken
+        self.shardCount = kwargs.pop('shardCount') if 'shardCount' in kwargs else None
+        self.shardIds = kwargs.pop('shardIds') if 'shardIds' in kwargs else None
+        self.gatewayUrl = kwargs.pop('gatewayUrl') if 'gatewayUrl' in kwargs else None
+        self.identifyLimiter = kwargs.pop('identifyLimiter') if 'identifyLimiter' in kwargs else None
+        if 'guildCache' not in kwargs:
+            kwargs['guildCache'] = guild_cache(
+                    cacheMembers=kwargs['cacheMembers'] if 'cacheMembers' in kwargs else 'on_demand',
+                    cachePresences=kwargs['cachePresences'] if 'cachePresences' in kwargs else False)
+        self.guilds = kwargs['guildCache']
+        self.kwargs = kwargs
+
+        self.shards = {}        # shard_id: discord_bot_connection
+        self.processes = []
+
+        # A connection to use for registering handlers and REST calls. Shards keep its user up to date.
+        self.connection = kwargs.pop('connection') if 'connection' in kwargs else discord_bot_connection(botToken, **kwargs)
+
+    # Look up the gateway url, recommended shard count and identify concurrency.
+    async def get_gateway(self):
+        if self.gatewayUrl and self.shardCount and self.identifyLimiter:
+            return
+        try:
+            response = await self.connection.api_get_call("/gateway/bot", headers={"Authorization":"Bot " + self.botToken})
+        finally:
+            await self.connection.close_session()
+
+        self.gatewayUrl = self.gatewayUrl or response['url']
+        self.shardCount = self.shardCount or response['shards']
+        if not self.identifyLimiter:
+            limit = response['session_start_limit'] if 'session_start_limit' in response else {}
+            self.identifyLimiter = identify_limiter(limit['max_concurrency'] if 'max_concurrency' in limit else 1)
+
+    async def start(self):
+        await self.get_gateway()
+
+        shardIds = self.shardIds if self.shardIds is not None else range(self.shardCount)
+        for shard_id in shardIds:
+            kwargs = dict(self.kwargs)
+            if 'snapshotFile' in kwargs and kwargs['snapshotFile']:
+                kwargs['snapshotFile'] = f"{kwargs['snapshotFile']}.{shard_id}"
+            self.shards[shard_id] = discord_bot_connection(self.botToken,
+                    shard=[shard_id, self.shardCount], gatewayUrl=self.gatewayUrl,
+                    identifyLimiter=self.identifyLimiter, mainConnection=self.connection, **kwargs)
+
+        print(f"Starting shards {list(self.shards)} of {self.shardCount}")
+        try:
+            await asyncio.gather(*[shard.start() for shard in self.shards.values()])
+        finally:
+            if self.connection.coalescer is not None:
+                self.connection.coalescer.flush_all()
+            if self.connection.messageTasks:
+                await asyncio.wait(self.connection.messageTasks, timeout=10)
+            await self.connection.close_session()
+
+    async def start_processes(self, processes):
+        await self.get_gateway()
+
+        shardIds = list(self.shardIds if self.shardIds is not None else range(self.shardCount))
+        pipes = []
+        context = multiprocessing.get_context("fork")  # Workers inherit registered handlers and self.connection.
+        for i in range(processes):
+            parent, child = context.Pipe()
+            process = context.Process(target=run_shard_worker,
+                    args=(self.botToken, shardIds[i::processes], self.shardCount, self.gatewayUrl, child,
+                          self.connection, self.kwargs),
+                    daemon=True)
+            process.start()
+            child.close()               # So recv() raises EOFError once the worker exits.
+            self.processes.append(process)
+            pipes.append(parent)
+
+        await asyncio.gather(*[self.serve_worker(pipe) for pipe in pipes])
+
+    # Answer IDENTIFY requests from a worker process until it exits.
+    async def serve_worker(self, pipe):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                request, shard_id = await loop.run_in_executor(None, pipe.recv)
+            except EOFError:            # Worker process has exited.
+                return
+            if request == "identify":
+                await self.identifyLimiter.acquire(shard_id)
+                pipe.send(("ok", shard_id))
+
+    async def close(self):
+        await asyncio.gather(*[shard.close() for shard in self.shards.values()])
+        for process in self.processes:
+            process.terminate()
+
+    def shard_for_guild(self, guild_id):
+        return (int(guild_id) >> 22) % self.shardCount
+
+    def connection_for_guild(self, guild_id):
+        shard_id = self.shard_for_guild(guild_id)
+        return self.shards[shard_id] if shard_id in self.shards else None
+
+# Main program
+async def main():
+    bot = discordBot(botToken)
+    ws = await bot.start()
+
+if __name__ == "__main__":
+    asyncio.run(main())
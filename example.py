@@ -32,12 +32,12 @@ async def heartbeat_ack_received(message):
     print(f"HEARTBEAT ACK Received at {time.time()}")
 
 # A simple Hello, World! example.
-@ch.matchContent(lambda x: 'hello falsebot' in x.lower())
+@ch.matchKeyword("hello falsebot")
 def helloWorld(message):
     bot.say_in_channel(message['channel_id'], "Hello, World!")
 
 # Match all messages which contain 'siege' (case insensitive).
-@ch.matchContent(lambda x: "siege" in x.lower())
+@ch.matchKeyword("siege")
 def siege(message):
     bot.say_in_channel(message['channel_id'], "seej")
 
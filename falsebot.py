@@ -14,8 +14,8 @@
 #    You should have received a copy of the GNU General Public License
 #    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
 
-from discordBot import discord_bot_connection,discord_chat_handler,opcodes
-import asyncio,time,json,re,argparse
+from discordBot import discord_bot_connection,discord_chat_handler,opcodes,bounded_cache,result_cache
+import asyncio,time,json,hashlib
 
 # Initialise our bot with an API token read from file 'botToken'
 # See https://discordapp.com/developers/applications/ to get your own
@@ -26,39 +26,13 @@ bot = discord_bot_connection(**tokens)
 # Initialise a chat handler object.
 ch = discord_chat_handler(bot)
 
-from contextlib import redirect_stdout
-# A function decorator useful for creating a command with keyword arguments. Not yet completely polished, does the job for now,
-def commandWithArgs(description, **kwargs):
-    def makeWrapper(func):
-
-        prog = kwargs.pop('name') if 'name' in kwargs else func.__name__
-        parser = argparse.ArgumentParser(description=description, conflict_handler='resolve', prog=prog)
-        for k,v in kwargs.items():
-            parser.add_argument('--' + k, **v)
-
-        def wrapper(message):
-            args = message['content'].split(" ")[1:]
-            with io.StringIO() as buf, redirect_stdout(buf):
-                try:
-                    args = vars(parser.parse_args(args))
-                    output = buf.getvalue()
-                    if len(output):
-                        bot.say_in_channel(message['channel_id'], f"```{output}```") # for some reason this doesn't work? still goes to stdout...
-                except SystemExit:
-                    output = buf.getvalue()
-                    if len(output):
-                        bot.say_in_channel(message['channel_id'], f"```{output}```") # this does though??
-                    return
-            func(message, **args)
-
-        return wrapper
-            
-    return makeWrapper
-
 # Print when we receive a HEARTBEAT ACK opcode, mostly as an easy way to monitor that the bot is still active.
 @bot.message(opcodes.HEARTBEAT_ACK)
 async def heartbeat_ack_received(message):
-    print(f"HEARTBEAT ACK Received at {time.time()}")
+    if bot.latency is not None:
+        print(f"HEARTBEAT ACK Received at {time.time()}, latency {bot.latency*1000:.0f}ms (p50 {bot.latency_p50*1000:.0f}ms, p99 {bot.latency_p99*1000:.0f}ms)")
+    else:
+        print(f"HEARTBEAT ACK Received at {time.time()}")
 
 # Detect when people start playing 'Fortnite' and tell them it's illegal.
 #@bot.dispatch('PRESENCE_UPDATE')
@@ -67,18 +41,19 @@ async def heartbeat_ack_received(message):
 #        bot.say_in_channel('370195763894157312', f"<@{event['user']['id']}> FORTNITE IS ILLEGAL.")
 
 # Match all messages which contain 'siege' (case insensitive).
-@ch.matchContent(lambda x: "siege" in x.lower())
+@ch.matchKeyword("siege")
 def siege(message):
     bot.say_in_channel(message['channel_id'], "seej")
 
 # A simple Hello, World! example.
-@ch.matchContent(lambda x: 'hello falsebot' in x.lower())
+@ch.matchKeyword("hello falsebot")
 def helloWorld(message):
     bot.say_in_channel(message['channel_id'], "Hello, World!")
 
 ## Bunch of image processing commands
 
-import urllib.request,io
+import io
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 # Just an easy way to take a PIL image and convert it to a file-like object.
@@ -88,55 +63,97 @@ def fileFromImage(Image, format="jpeg"):
     newfile.seek(0)
     return newfile
 
+# Downloaded images by attachment ID, so running several commands on the same picture only downloads it once.
+# Images are kept encoded, as they were uploaded, and decoded in the worker process.
+maxImageSize = 8*1024*1024
+imageCache = bounded_cache(maxBytes=256*1024*1024, ttl=600)
+
+# Encoded output of image commands by (image hash, command, arguments), so repeats of a command are
+# sent straight back without decoding or rendering anything. Set resultSpillDir to keep results
+# evicted from memory on disk.
+resultSpillDir = None
+resultCache = result_cache(maxBytes=64*1024*1024, spillDir=resultSpillDir)
+
 # Looks through the channel buffer for a given channel for any images.
-def findRecentImageInChannel(channel_id):
-    url = None
-    for m in reversed(ch.channelBuffer[channel_id]):
-        if m and m['attachments'] and len(m['attachments']) > 0:# Dump the entire channel buffer (3 messages by default)
-            url = m['attachments'][0]['url']
-    if not url:
-        return None
-
-    req = urllib.request.Request(url,data=None,
-        headers={
-            'User-Agent': 'Mozilla/5.0'
-        })
-    img = Image.open(urllib.request.urlopen(req))
-
-    return img
+# Returns (sha256 hex digest, encoded image bytes) or (None, None).
+async def findRecentImageInChannel(channel_id):
+    m = ch.channelBuffer.last_attachment(channel_id)
+    if not m:
+        return None, None
+
+    key, url = m.attachments[0]
+    entry = imageCache.get(key)
+    if entry is None:
+        data = await bot.fetch_attachment(url, maxSize=maxImageSize)
+        entry = (hashlib.sha256(data).hexdigest(), data)
+        imageCache.put(key, entry, len(data))
+
+    return entry
+
+# Image functions by name. Worker processes look functions up here, as decorated functions can't be pickled.
+imageFunctions = {}
+
+# Runs inside a worker process: decode an image, apply an image function and return the encoded PNG bytes.
+def processImage(name, data, kwargs):
+    img = Image.open(io.BytesIO(data))
+    out = imageFunctions[name](img, **kwargs)
+    return fileFromImage(out, format="png").getvalue()
 
 # A function decorator to turn a function which takes an Image as an argument and returns a processed one into a command.
 # kwargs are preserved through to the decorated function.
+# The image function is run in the chat handler's process pool so it doesn't block the event loop.
 def imageCommand(func):
-    def wrapper(message, **kwargs):
-        img = findRecentImageInChannel(message['channel_id'])
-        if not img:
+    imageFunctions[func.__name__] = func
+    async def wrapper(message, **kwargs):
+        try:
+            digest, data = await findRecentImageInChannel(message['channel_id'])
+        except ValueError:
+            return bot.say_in_channel(message['channel_id'], "Sorry, that image is too large for me to process.")
+        if not data:
             return bot.say_in_channel(message['channel_id'], "Sorry, I could not find a recent image to process.")
-        out = func(img, **kwargs)
-        return bot.send_file(message['channel_id'], fileFromImage(out, format="png"), filename="out.png")
+
+        key = result_cache.key(digest, func.__name__, kwargs)
+        out = resultCache.get(key)
+        if out is None:
+            try:
+                out = await ch.run_in_executor(processImage, func.__name__, data, kwargs)
+            except asyncio.QueueFull:
+                return bot.say_in_channel(message['channel_id'], "Sorry, I'm busy processing other images. Try again in a moment.")
+            except asyncio.TimeoutError:
+                return bot.say_in_channel(message['channel_id'], "Sorry, that image took too long to process.")
+            resultCache.put(key, out)
+        return bot.send_file(message['channel_id'], memoryview(out), filename="out.png")
+    wrapper.__name__ = func.__name__
     return wrapper
 
+# Report how well the downloaded image and image result caches are doing.
+@ch.matchCommand("^cachestats")
+def cacheStats(message):
+    images = imageCache.stats()
+    stats = resultCache.stats()
+    bot.say_in_channel(message['channel_id'],
+            f"Downloaded images: {images['hit_ratio']:.0%} hit ratio ({images['hits']} hits, {images['misses']} misses), "
+            f"{images['entries']} cached ({images['bytes']/1024/1024:.1f}MB), {images['evictions']} evicted.\n"
+            f"Image results: {stats['hit_ratio']:.0%} hit ratio ({stats['hits']} hits, {stats['misses']} misses), "
+            f"{stats['bytes_saved']/1024/1024:.1f}MB served from cache, "
+            f"{stats['entries']} cached in memory, {stats['spilled']} on disk.")
+
 ## All the image stuff above should probably be moved to a new class or discord_chat_handler at the very least
 
 
-def averageOfThree(p):
-    return (p[0]+p[1]+p[2])/3
-def perceivedBrightness(p):
-    return 0.2126*p[0] + 0.7152*p[1] + 0.0722*p[2]
+# R,G,B weights for converting a pixel to a brightness value.
+averageOfThree = np.array([1/3, 1/3, 1/3])
+perceivedBrightness = np.array([0.2126, 0.7152, 0.0722])
 brightness = perceivedBrightness
 
 def bandw(img):
-    size = img.size
-    img=img.getdata()
-
-    bandw = list(map(brightness, img))
-    
-    out = Image.new('L', size)
-    out.putdata(bandw)
+    # Brightness of every pixel as a single (height, width, 3) x (3,) matrix product.
+    pixels = np.asarray(img.convert('RGB'), dtype=np.float64)
+    bandw = np.clip(pixels @ brightness, 0, 255).astype(np.uint8) # Truncate, as Image.putdata() did.
 
-    return out
+    return Image.fromarray(bandw, mode='L')
 # I want to re-use this algorithm in another function, so avoid decorating it...
-ch.matchContent(re.compile("^\^bandw").search)(imageCommand(bandw))
+ch.matchCommand("^bandw")(imageCommand(bandw))
 
 # ASCII Characters corresponding to brightness values (lookup table)
 # I generated this with an external script which drew each character and averaged
@@ -160,10 +177,37 @@ brightchars = [
  'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', 'W', '@', 
  '@', '@', '@', '@', '@', '@', '@', '@', '@', '@', '@', '@', '@', '@', '@', '@']
 
-from functools import reduce
-
-@ch.matchContent(re.compile("^\^ascii").search)
-@commandWithArgs("Convert an image to ASCII art.", name="^ascii",
+# Glyph atlas: every character in brightchars rasterized once into a 10x10 cell mask, so
+# ascii() can composite whole images with array indexing instead of one draw.text() per
+# pixel. Glyphs are drawn into the centre of a 3x3 cell canvas at the same (-2.5, 0) offset
+# ascii() has always used, keeping any part which spills into neighbouring cells.
+asciiCell = 10
+glyphs = sorted(set(brightchars))
+brightlut = np.array([glyphs.index(c) for c in brightchars], dtype=np.intp)
+
+def makeGlyphAtlas():
+    atlas = np.zeros((len(glyphs), asciiCell*3, asciiCell*3), dtype=np.uint8)
+    for i,c in enumerate(glyphs):
+        canvas = Image.new('L', (asciiCell*3, asciiCell*3))
+        ImageDraw.Draw(canvas).text((asciiCell - 2.5, asciiCell), c, fill=255)
+        atlas[i] = np.asarray(canvas)
+    return atlas
+glyphAtlas = makeGlyphAtlas()
+
+# Build a text mask for an array of glyph indices, one cell per index.
+def compositeGlyphs(indices):
+    h,w = indices.shape
+    c = asciiCell
+    mask = np.zeros(((h+2)*c, (w+2)*c), dtype=np.uint8) # One cell of padding for spill on each side.
+    for dy in range(3):
+        for dx in range(3):
+            tiles = glyphAtlas[:, dy*c:(dy+1)*c, dx*c:(dx+1)*c][indices]  # (h, w, c, c)
+            tiles = tiles.transpose(0, 2, 1, 3).reshape(h*c, w*c)
+            region = mask[dy*c:(dy+h)*c, dx*c:(dx+w)*c]
+            np.maximum(region, tiles, out=region)
+    return mask[c:-c, c:-c]
+
+@ch.commandWithArgs("^ascii", "Convert an image to ASCII art.",
             foreground={"help":"R,G,B value to use as foreground (Default 255,255,255)",
                         "default":(255,255,255), "type":lambda x: tuple(map(int, x.split(',') ) )},
             background={"help":"R,G,B value to use as background (Default 0,0,0)",
@@ -177,22 +221,21 @@ def ascii(img, **kwargs):
 
     img = img.resize((int(size[0]/kwargs['downscaling']), int(size[1]/kwargs['downscaling'])))
     size = img.size
-    img = list(img.getdata())
     
-    # Assign an ascii character to each pixel.
-    characters = list(map(lambda b: brightchars[b], img))
+    # Assign an ascii character (glyph atlas index) to each pixel.
+    characters = brightlut[np.asarray(img)]
 
-    asciised = Image.new('RGB', (size[0]*10,size[1]*10), color=kwargs['background'])
-    draw = ImageDraw.Draw(asciised)
-    
     # Draw an image with all these ascii chars.
-    for y in range(size[1]):
-        for x in range(size[0]):
-            index = y*size[0]+x
-            draw.text((x*10 - 2.5, y*10), characters[index], fill=kwargs['foreground'])
+    mask = Image.fromarray(compositeGlyphs(characters), mode='L')
+    foreground = Image.new('RGB', mask.size, color=kwargs['foreground'])
+    asciised = Image.new('RGB', mask.size, color=kwargs['background'])
+    asciised.paste(foreground, (0, 0), mask)
     
     return asciised
 
 
 if __name__ == "__main__":
-    asyncio.run(bot.start())
+    try:
+        asyncio.run(bot.start())
+    finally:
+        ch.shutdown_executor()
@@ -0,0 +1,538 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+# Offline benchmark harness. Replays recorded gateway messages through a bot with
+# falsebot.py style handlers attached, against a local stand-in for Discord, and reports
+# throughput, handler latency, memory and REST call counts.
+#
+#   Record:     discord_bot_connection(token, recordFile="session.jsonl")
+#   Synthesize: python replay.py synthesize session.jsonl --guilds 100 --messages 10000 [--skew 0.5]
+#   Replay:     python replay.py run session.jsonl [--speed 1.0] [--gateway] [--coalesce 0.5] [--eager-decode]
+#                   [--workers 8] [--processes 2] [--handler-delay 0.01] [--no-instrument]
+#   Restart:    python replay.py restart session.jsonl     Time to ready with and without a snapshot.
+
+from discordBot import discord_bot_connection,discord_chat_handler,channel_buffer,opcodes
+import asyncio,time,json,re,argparse,random,resource,os,zlib
+from aiohttp import web
+
+class stand_in_server:
+    """
+        A local stand-in for the Discord RESTful API and gateway.
+
+            server = stand_in_server(recording, speed=None)
+            await server.start()
+
+        REST:       Every request under /api/ is answered with an empty JSON object and counted
+                    per route in server.rest_calls. GET /api/gateway/bot returns this server's
+                    gateway url. With a rateLimit of (requests, seconds) every route is limited
+                    like Discord's buckets: responses carry X-RateLimit-* headers, and requests
+                    over the limit are answered with a 429 and counted in server.rate_limited.
+                    Request bodies are read and dropped as they arrive, and counted in
+                    server.rest_bytes, so large uploads aren't held in memory.
+        Attachments: server.attachments maps names to bytes, served from /attachments/{name} with
+                    a Content-Length, or streamed in chunks without one with ?chunked. Every
+                    download is counted in server.attachment_fetches by name.
+        Gateway:    /gateway sends HELLO, acknowledges heartbeats, and after IDENTIFY plays back the
+                    recorded DISPATCH messages. After RESUME it sends RESUMED and plays back those
+                    after the resumed sequence number, if any. Messages are played at 'speed' times the recorded pace (or as fast
+                    as possible when speed is None). server.done is set once playback finishes,
+                    and server.last_sequence is the sequence number of the last message sent.
+
+                    A RESUME of a session this server never started is answered with a
+                    non-resumable INVALID_SESSION.
+
+                    A shard which IDENTIFYs with [shard_id, num_shards] only receives the guilds
+                    (and their events) with (guild_id >> 22) % num_shards == shard_id, and a session
+                    id of its own. Every IDENTIFY, RESUME and heartbeat is recorded in
+                    server.identifies, server.resumes and server.heartbeats as the shard id (None
+                    when unsharded), the latter with its time.monotonic().
+
+                    Heartbeats are acknowledged after ackDelay seconds, or never for shards in
+                    withholdAcks.
+
+                    Every payload received is kept in server.received as (time.monotonic(), payload).
+
+                    REQUEST_GUILD_MEMBERS is answered with GUILD_MEMBERS_CHUNKs of up to chunkSize
+                    members from the recorded GUILD_CREATEs.
+
+                    With reconnectAfter the first connection is sent a RECONNECT after that many
+                    events, and with closeAfter of (events, code) it is closed with that code.
+
+                    Connections with compress=zlib-stream are sent zlib-stream compressed binary
+                    frames of up to frameSize bytes, so large messages span several frames. The
+                    compressed frames are kept in server.frames if keepFrames is set.
+                    server.bytes_sent and server.raw_bytes count the bytes sent with and without
+                    compression.
+    """
+
+    def __init__(self, recording=None, speed=None, host="127.0.0.1", port=0, rateLimit=None,
+                 heartbeatInterval=41250, ackDelay=0, withholdAcks=(), chunkSize=1000,
+                 reconnectAfter=None, closeAfter=None, frameSize=4096, keepFrames=False):
+        self.recording = recording
+        self.speed = speed
+        self.host = host
+        self.port = port
+        self.rateLimit = rateLimit
+        self.buckets = {}           # route: [remaining, reset_at]
+        self.rate_limited = 0
+        self.heartbeatInterval = heartbeatInterval
+        self.ackDelay = ackDelay
+        self.withholdAcks = set(withholdAcks)
+        self.chunkSize = chunkSize
+        self.reconnectAfter = reconnectAfter
+        self.closeAfter = closeAfter
+        self.frameSize = frameSize
+        self.keepFrames = keepFrames
+        self.sessions = {}          # session_id: shard id
+        self.members = None         # guild_id: recorded members, read on the first member request.
+        self.identifies = []
+        self.resumes = []
+        self.heartbeats = []
+        self.received = []
+        self.frames = []
+        self.bytes_sent = 0
+        self.raw_bytes = 0
+        self.rest_calls = {}
+        self.rest_bytes = 0
+        self.attachments = {}       # name: bytes
+        self.attachment_fetches = {}
+        self.events_sent = 0
+        self.last_sequence = None
+        self.started = None
+        self.done = asyncio.Event()
+        self.runner = None
+
+    async def start(self):
+        app = web.Application(client_max_size=64*1024*1024)
+        app.router.add_get("/gateway", self.gateway)
+        app.router.add_route("*", "/api/{path:.*}", self.rest)
+        app.router.add_get("/attachments/{name}", self.attachment)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.apiUrl = f"http://{self.host}:{self.port}/api/"
+        self.gatewayUrl = f"ws://{self.host}:{self.port}/gateway"
+        self.attachmentUrl = f"http://{self.host}:{self.port}/attachments/"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def rest(self, request):
+        route = f"{request.method} /{re.sub(r'/[0-9]+', '/:id', request.match_info['path'].lstrip('/'))}"
+        self.rest_calls[route] = self.rest_calls.get(route, 0) + 1
+        async for chunk in request.content.iter_any():
+            self.rest_bytes += len(chunk)
+
+        headers = {}
+        if self.rateLimit:
+            limit, per = self.rateLimit
+            now = time.monotonic()
+            bucket = self.buckets.setdefault(route, [limit, now + per])
+            if now >= bucket[1]:
+                bucket[:] = [limit, now + per]
+            if bucket[0] <= 0:
+                self.rate_limited += 1
+                return web.json_response({ "message": "You are being rate limited.", "retry_after": int((bucket[1] - now) * 1000) + 1,
+                        "global": False }, status=429)
+            bucket[0] -= 1
+            headers = { "X-RateLimit-Bucket": route, "X-RateLimit-Limit": str(limit),
+                        "X-RateLimit-Remaining": str(bucket[0]), "X-RateLimit-Reset-After": f"{bucket[1] - now:.3f}" }
+
+        if route == "GET /gateway/bot":
+            return web.json_response({ "url": self.gatewayUrl, "shards": 1,
+                "session_start_limit": { "total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1 } },
+                headers=headers)
+        return web.json_response({}, headers=headers)
+
+    async def attachment(self, request):
+        name = request.match_info['name']
+        if name not in self.attachments:
+            raise web.HTTPNotFound()
+        self.attachment_fetches[name] = self.attachment_fetches.get(name, 0) + 1
+        data = self.attachments[name]
+        if 'chunked' not in request.query:
+            return web.Response(body=data, content_type="application/octet-stream")
+
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for i in range(0, len(data), 64*1024):
+            await response.write(data[i:i+64*1024])
+        await response.write_eof()
+        return response
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        compressor = zlib.compressobj() if request.query.get('compress') == 'zlib-stream' else None
+        lock = asyncio.Lock()       # Frames of one compressed message must not interleave with another's.
+
+        async def send(frame):
+            data = json.dumps(frame)
+            self.raw_bytes += len(data)
+            if compressor is None:
+                self.bytes_sent += len(data)
+                return await ws.send_str(data)
+            data = compressor.compress(data.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.bytes_sent += len(data)
+            if self.keepFrames:
+                self.frames.append(data)
+            async with lock:
+                for i in range(0, len(data), self.frameSize):
+                    await ws.send_bytes(data[i:i + self.frameSize])
+
+        async def ack():
+            await asyncio.sleep(self.ackDelay)
+            if not ws.closed:
+                await send({ "op": opcodes.HEARTBEAT_ACK, "d": None, "s": None, "t": None })
+
+        await send({ "op": opcodes.HELLO, "d": { "heartbeat_interval": self.heartbeatInterval }, "s": None, "t": None })
+
+        playback = None
+        shard = None
+        async for msg in ws:
+            payload = json.loads(msg.data)
+            self.received.append((time.monotonic(), payload))
+            if payload['op'] == opcodes.HEARTBEAT:
+                self.heartbeats.append((shard[0] if shard else None, time.monotonic()))
+                if (shard[0] if shard else None) not in self.withholdAcks:
+                    asyncio.ensure_future(ack())
+            elif payload['op'] == opcodes.IDENTIFY and playback is None:
+                shard = payload['d']['shard'] if 'shard' in payload['d'] else None
+                self.identifies.append(shard[0] if shard else None)
+                playback = asyncio.ensure_future(self.play(send, ws, shard=shard))
+            elif payload['op'] == opcodes.RESUME and playback is None:
+                shard = self.sessions.get(payload['d']['session_id'])
+                self.resumes.append(shard[0] if shard else None)
+                if payload['d']['session_id'] not in self.sessions:
+                    await send({ "op": opcodes.INVALID_SESSION, "d": False, "s": None, "t": None })
+                    continue
+                seq = payload['d']['seq']
+                await send({ "t": "RESUMED", "s": seq, "op": opcodes.DISPATCH, "d": {} })
+                playback = asyncio.ensure_future(self.play(send, ws, seq, shard))
+            elif payload['op'] == opcodes.REQUEST_GUILD_MEMBERS:
+                await self.send_members(send, payload['d'])
+        if playback:
+            playback.cancel()
+        return ws
+
+    # Answer a REQUEST_GUILD_MEMBERS with the recorded members of each guild asked for.
+    async def send_members(self, send, request):
+        if self.members is None:
+            self.members = {}
+            with open(self.recording) as f:
+                for line in f:
+                    frame = json.loads(line)['frame']
+                    if frame['t'] == 'GUILD_CREATE':
+                        self.members[frame['d']['id']] = frame['d'].get('members', [])
+
+        guild_ids = request['guild_id'] if isinstance(request['guild_id'], list) else [request['guild_id']]
+        for guild_id in guild_ids:
+            members = self.members.get(str(guild_id), [])
+            if request.get('user_ids'):
+                members = [m for m in members if m['user']['id'] in request['user_ids']]
+            else:
+                members = [m for m in members if m['user']['username'].startswith(request.get('query', ''))]
+            if request.get('limit'):
+                members = members[:request['limit']]
+            chunks = [members[i:i + self.chunkSize] for i in range(0, len(members), self.chunkSize)] or [[]]
+            for index, chunk in enumerate(chunks):
+                await send({ "t": "GUILD_MEMBERS_CHUNK", "s": self.last_sequence, "op": opcodes.DISPATCH,
+                        "d": { "guild_id": str(guild_id), "members": chunk, "chunk_index": index,
+                               "chunk_count": len(chunks), "nonce": request.get('nonce') } })
+
+    async def play(self, send, ws, after=None, shard=None):
+        started = self.started = time.monotonic()
+        sent = 0
+        with open(self.recording) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['frame']['op'] != opcodes.DISPATCH:
+                    continue
+                if after is not None and record['frame']['s'] <= after:
+                    continue
+                frame = self.for_shard(record['frame'], shard) if shard else record['frame']
+                if frame is None:
+                    continue
+                if frame['t'] == 'READY':
+                    self.sessions.setdefault(frame['d']['session_id'], shard)
+                if self.speed:
+                    delay = started + record['time'] / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await send(frame)
+                self.events_sent += 1
+                self.last_sequence = record['frame']['s']
+
+                sent += 1
+                if self.reconnectAfter and sent >= self.reconnectAfter:
+                    self.reconnectAfter = None
+                    return await send({ "op": opcodes.RECONNECT, "d": None, "s": None, "t": None })
+                if self.closeAfter and sent >= self.closeAfter[0]:
+                    code, self.closeAfter = self.closeAfter[1], None
+                    return await ws.close(code=code)
+        self.done.set()
+
+    # The frame as sent to a shard, or None if it belongs to another shard. Events outside
+    # any guild go to shard 0, like direct messages do.
+    def for_shard(self, frame, shard):
+        event = frame['d']
+        if frame['t'] == 'READY':
+            session_id = f"{event['session_id']}-{shard[0]}"
+            self.sessions[session_id] = shard
+            guilds = [g for g in event['guilds'] if (int(g['id']) >> 22) % shard[1] == shard[0]]
+            return dict(frame, d=dict(event, session_id=session_id, guilds=guilds))
+
+        guild_id = event.get('guild_id') if isinstance(event, dict) else None
+        if frame['t'] in ('GUILD_CREATE', 'GUILD_UPDATE', 'GUILD_DELETE'):
+            guild_id = event['id']
+        if guild_id is None:
+            return frame if shard[0] == 0 else None
+        return frame if (int(guild_id) >> 22) % shard[1] == shard[0] else None
+
+# Id of the g-th synthetic guild. The shard bits (guild_id >> 22) differ for every guild, like real
+# snowflakes created at different times, so guilds are spread over shards.
+def guild_id(g):
+    return str((g << 22) + 1000)
+
+# Write a synthetic recording: READY, GUILD_CREATEs, then a mix of chat messages and presence updates.
+# A 'skew' fraction of events all go to the first guild, the rest are spread over every guild.
+def synthesize(path, guilds=100, messages=10000, presences=0.5, skew=0.0):
+    user = { "id": "1", "username": "FalseBot", "discriminator": "0001", "bot": True }
+    contents = ["hello falsebot", "anyone up for siege tonight?", "just a normal message", "^help", "lol"]
+    now = 0.0
+    with open(path, 'w') as f:
+        def write(frame):   # Keys in the order Discord sends them: t, s, op, d.
+            frame = { "t": frame['t'], "s": frame['s'], "op": frame['op'], "d": frame['d'] }
+            f.write(json.dumps({ "time": now, "frame": frame }) + "\n")
+
+        write({ "op": opcodes.HELLO, "d": { "heartbeat_interval": 41250 }, "s": None, "t": None })
+        seq = 1
+        write({ "op": opcodes.DISPATCH, "s": seq, "t": "READY", "d": { "v": 6, "user": user, "session_id": "replay",
+                "private_channels": [], "guilds": [{ "id": guild_id(g), "unavailable": True } for g in range(guilds)] } })
+        for g in range(guilds):
+            seq += 1
+            gid = guild_id(g)
+            write({ "op": opcodes.DISPATCH, "s": seq, "t": "GUILD_CREATE", "d": { "id": gid, "name": f"Guild {g}",
+                    "owner_id": "2", "member_count": 50, "unavailable": False,
+                    "roles": [{ "id": gid, "name": "@everyone", "permissions": 0, "position": 0, "color": 0 }],
+                    "channels": [{ "id": str(int(gid) * 10 + c), "type": 0, "name": f"channel-{c}", "position": c } for c in range(5)],
+                    "members": [{ "user": { "id": str(10000 + m), "username": f"user{m}", "discriminator": "0001" },
+                                  "roles": [], "joined_at": "2018-01-01T00:00:00" } for m in range(50)],
+                    "presences": [] } })
+
+        for i in range(messages):
+            now += 0.001
+            seq += 1
+            g = 0 if random.random() < skew else random.randrange(guilds)
+            author = { "id": str(10000 + random.randrange(50)), "username": "someone", "discriminator": "0001" }
+            if random.random() < presences:
+                write({ "op": opcodes.DISPATCH, "s": seq, "t": "PRESENCE_UPDATE", "d": { "guild_id": guild_id(g),
+                        "user": { "id": author['id'] }, "status": random.choice(["online", "idle", "dnd"]), "game": None, "roles": [] } })
+            else:
+                write({ "op": opcodes.DISPATCH, "s": seq, "t": "MESSAGE_CREATE", "d": { "id": str(10**6 + i),
+                        "channel_id": str(int(guild_id(g)) * 10 + random.randrange(5)), "guild_id": guild_id(g), "author": author,
+                        "content": random.choice(contents), "attachments": [], "embeds": [], "timestamp": "2018-01-01T00:00:00" } })
+
+# falsebot.py style handlers. With a handlerDelay every message also waits that long, like a
+# handler making a slow API call, and (guild_id, message id, time.monotonic()) is appended to
+# 'handled' once it is done.
+def attach_handlers(bot, ch, handlerDelay=None, handled=None):
+    @bot.message(opcodes.HEARTBEAT_ACK)
+    async def heartbeat_ack_received(message):
+        pass
+
+    @ch.matchKeyword("hello falsebot")
+    def helloWorld(message):
+        bot.say_in_channel(message['channel_id'], "Hello, World!")
+
+    @ch.matchKeyword("siege")
+    def siege(message):
+        bot.say_in_channel(message['channel_id'], "seej")
+
+    if handlerDelay:
+        @ch.match(lambda message: True)
+        async def slowHandler(message):
+            await asyncio.sleep(handlerDelay)
+            handled.append((message.get('guild_id'), message['id'], time.monotonic()))
+
+# Latency of each handled message from when it was due to arrive at the recorded pace, split
+# between the first guild (the busiest one with --skew) and the rest.
+def message_latencies(path, handled, started, speed):
+    due = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['frame']['t'] == 'MESSAGE_CREATE':
+                due[record['frame']['d']['id']] = started + record['time'] / speed
+    latencies = {}
+    for guild_id, message_id, done in handled:
+        group = "first guild" if guild_id == "1000" else "other guilds"
+        latencies.setdefault(group, []).append(done - due[message_id])
+    return latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def report(results, bot, server, latencies=None):
+    print(f"Events:           {results['events']}")
+    print(f"Time:             {results['seconds']:.3f}s")
+    print(f"Events/sec:       {results['events_per_second']:.0f}")
+    print(f"CPU/event:        {results['cpu_seconds'] / results['events'] * 1e6 if results['events'] else 0:.1f}us (bot and stand-in server)")
+    for name in ("dispatch_event", "handler", "queue_wait") if bot.metrics is not None else ():
+        for label, h in (bot.metrics.histograms[name].items() if name in bot.metrics.histograms else ()):
+            print(f"{name:<18}{label:<20} n={h.count:<8} p50<={h.percentile(50)}s p99<={h.percentile(99)}s")
+    print(f"Max RSS:          {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB")
+    for group, values in sorted((latencies or {}).items()):
+        print(f"Latency {group:<13}n={len(values):<8} p50={percentile(values, 50)*1000:.1f}ms p99={percentile(values, 99)*1000:.1f}ms")
+    if bot.skippedEvents:
+        print(f"Skipped events:   {bot.skippedEvents} (not decoded, nothing subscribes to them)")
+    if bot.coalescer is not None:
+        stats = bot.coalescer.stats()
+        print(f"Replies:          {stats['messages']} queued, {stats['sent']} sent, {stats['deduplicated']} deduplicated")
+    print(f"REST calls:       {sum(server.rest_calls.values())}")
+    for route, count in sorted(server.rest_calls.items()):
+        print(f"    {route:<40}{count}")
+
+async def run(path, speed=None, gateway=False, coalesce=None, lazyDecode=True, workers=None, processes=None, handlerDelay=None,
+        instrument=True):
+    server = stand_in_server(path, speed)
+    await server.start()
+
+    bot = discord_bot_connection("replay", apiUrl=server.apiUrl, instrument=instrument, coalesceWindow=coalesce,
+            lazyDecode=lazyDecode, workers=workers, processes=processes)
+    ch = discord_chat_handler(bot)
+    handled = []
+    attach_handlers(bot, ch, handlerDelay, handled)
+
+    started = time.monotonic()
+    cpu = time.process_time()
+    if gateway:     # Full pipeline: websocket, decoding and the outbound queue.
+        task = asyncio.ensure_future(bot.start())
+        await asyncio.wait([task, asyncio.ensure_future(server.done.wait())], return_when=asyncio.FIRST_COMPLETED)
+        if task.done():             # The bot stopped before playback finished.
+            await server.stop()
+            return task.result()
+        while bot.sequence != server.last_sequence and not task.done():    # Let the last frames be handled.
+            await asyncio.sleep(0.01)
+        elapsed = time.monotonic() - started
+        cpu = time.process_time() - cpu
+        await bot.close()
+        await task
+        results = { "events": server.events_sent, "seconds": elapsed,
+                    "events_per_second": server.events_sent / elapsed if elapsed else 0.0 }
+    else:
+        bot.open_session()
+        results = await bot.replay(path, speed)
+        cpu = time.process_time() - cpu
+        if bot.scheduler is not None:
+            await bot.scheduler.close()
+    results['cpu_seconds'] = cpu
+
+    # Wait for outstanding REST calls to reach the stand-in server.
+    if bot.coalescer is not None:
+        bot.coalescer.flush_all()
+    if bot.messageTasks:
+        await asyncio.wait(bot.messageTasks, timeout=10)
+    await bot.close_session()
+
+    latencies = None
+    if handled and speed:
+        latencies = message_latencies(path, handled, server.started if gateway else started, speed)
+    report(results, bot, server, latencies)
+    await server.stop()
+    return results
+
+# Whether a bot has a session and every guild it is in is available.
+def is_ready(bot):
+    return bool(bot.session_id) and bot.reconnects == 0 and len(bot.guilds) and all(not g.unavailable for g in bot.guilds)
+
+# Start a bot against the stand-in gateway and return the seconds until it is ready, leaving it running.
+async def time_to_ready(bot):
+    started = time.monotonic()
+    task = asyncio.ensure_future(bot.start())
+    while not is_ready(bot):
+        if task.done():
+            return task.result()
+        await asyncio.sleep(0.001)
+    return time.monotonic() - started, task
+
+# Compare time to ready from scratch with a warm restart from a snapshot.
+async def restart(path, snapshot="replay.snapshot"):
+    server = stand_in_server(path)
+    await server.start()
+    ch = None
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
+
+    results = {}
+    for name, snapshotFile in (("cold", None), ("cold, saving a snapshot", snapshot), ("warm, from the snapshot", snapshot)):
+        bot = discord_bot_connection("replay", apiUrl=server.apiUrl, snapshotFile=snapshotFile)
+        if ch is None:
+            ch = discord_chat_handler(bot)     # Registries are shared, one chat handler serves every bot.
+        ch.bot_connection = bot
+        ch.channelBuffer = channel_buffer(ch.bufferSize)
+
+        seconds, task = await time_to_ready(bot)
+        while bot.sequence != server.last_sequence:
+            await asyncio.sleep(0.01)
+        await bot.close(keepSession=True)
+        await task
+        results[name] = seconds
+        print(f"Time to ready, {name + ':':<26}{seconds*1000:.1f}ms "
+              f"({len(bot.guilds)} guilds, {ch.channelBuffer.stats()['messages']} buffered messages)")
+
+    print(f"Snapshot size:    {os.path.getsize(snapshot) / 1024:.0f}KB")
+    await server.stop()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline replay benchmark for FalseBot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("synthesize", help="Write a synthetic recording.")
+    p.add_argument("path")
+    p.add_argument("--guilds", type=int, default=100)
+    p.add_argument("--messages", type=int, default=10000)
+    p.add_argument("--presences", type=float, default=0.5, help="Fraction of events which are PRESENCE_UPDATEs.")
+    p.add_argument("--skew", type=float, default=0.0, help="Fraction of events which all go to the first guild.")
+
+    p = commands.add_parser("run", help="Replay a recording.")
+    p.add_argument("path")
+    p.add_argument("--speed", type=float, default=None, help="Multiple of the recorded pace. Default as fast as possible.")
+    p.add_argument("--gateway", action="store_true", help="Replay over a websocket through the stand-in gateway.")
+    p.add_argument("--eager-decode", action="store_true", help="Decode every gateway message, see lazyDecode.")
+    p.add_argument("--workers", type=int, default=None, help="Handle events on this many worker tasks.")
+    p.add_argument("--processes", type=int, default=None, help="Fan events out to this many worker processes.")
+    p.add_argument("--handler-delay", type=float, default=None, help="Seconds every message handler waits, like a slow API call.")
+    p.add_argument("--coalesce", type=float, default=None, help="Coalesce replies per channel over this many seconds.")
+    p.add_argument("--no-instrument", action="store_true", help="Run without latency histograms, see instrument.")
+
+    p = commands.add_parser("restart", help="Measure time to ready with and without a snapshot.")
+    p.add_argument("path")
+    p.add_argument("--snapshot", default="replay.snapshot", help="Snapshot file to use, replaced if it exists.")
+
+    args = parser.parse_args()
+    if args.command == "synthesize":
+        synthesize(args.path, args.guilds, args.messages, args.presences, args.skew)
+    elif args.command == "restart":
+        asyncio.run(restart(args.path, args.snapshot))
+    else:
+        asyncio.run(run(args.path, args.speed, args.gateway, args.coalesce, not args.eager_decode,
+                args.workers, args.processes, args.handler_delay, not args.no_instrument))
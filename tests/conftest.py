@@ -0,0 +1,45 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+# Checks against the stand-in server from replay.py. Run from the repository root with:
+#
+#   python -m pytest tests
+
+import os,sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discordBot import discord_bot_connection,discord_chat_handler
+
+# Handlers are registered on the classes and shared by every instance, so put the registries
+# back the way they were after each test.
+@pytest.fixture(autouse=True)
+def registries():
+    saved = { (cls, name): getattr(cls, name) for cls, names in (
+            (discord_bot_connection, ("dispatch_registry", "message_registry", "snapshot_registry")),
+            (discord_chat_handler, ("command_registry", "command_parsers", "keyword_registry",
+                                    "keyword_pattern", "keyword_contains"))) for name in names }
+    copies = { key: value.copy() for key, value in saved.items() if isinstance(value, dict) }
+    matches = tuple(list(l) for l in discord_chat_handler.match_registry)
+    yield
+    for (cls, name), value in saved.items():
+        if (cls, name) in copies:
+            value.clear()
+            value.update(copies[(cls, name)])
+        setattr(cls, name, value)
+    for registry, saved in zip(discord_chat_handler.match_registry, matches):
+        registry[:] = saved
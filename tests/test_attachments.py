@@ -0,0 +1,101 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection,bounded_cache
+from replay import stand_in_server
+import asyncio,importlib,json,sys
+import pytest
+
+# falsebot.py reads its token from a file named 'tokens' in the working directory when imported.
+@pytest.fixture
+def falsebot(tmp_path, monkeypatch):
+    if 'falsebot' not in sys.modules:
+        (tmp_path / "tokens").write_text(json.dumps({"botToken": "test"}))
+        monkeypatch.chdir(tmp_path)
+    return importlib.import_module('falsebot')
+
+def serve(check, attachments):
+    async def run():
+        server = stand_in_server()
+        server.attachments.update(attachments)
+        await server.start()
+        try:
+            return await check(server)
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+# Attachments over maxSize are refused from their Content-Length, or once that many bytes have
+# been read when they are streamed without one.
+@pytest.mark.parametrize("chunked", [False, True])
+def test_fetch_attachment_max_size(chunked):
+    query = "?chunked" if chunked else ""
+    async def check(server):
+        bot = discord_bot_connection("test")
+        try:
+            small = await bot.fetch_attachment(server.attachmentUrl + "small" + query, maxSize=1000)
+            with pytest.raises(ValueError) as error:
+                await bot.fetch_attachment(server.attachmentUrl + "large" + query, maxSize=1000)
+            return small, str(error.value)
+        finally:
+            await bot.close_session()
+    small, error = serve(check, { "small": bytes(range(256)) * 3, "large": bytes(300*1024) })
+    assert small == bytes(range(256)) * 3
+    if chunked:
+        assert error == "Attachment is larger than 1000 bytes"
+    else:
+        assert error == f"Attachment is {300*1024} bytes, larger than 1000"
+
+# The most recent image in a channel is downloaded once and served from imageCache after that.
+# Images over maxImageSize are never cached, and ^cachestats reports the cache's counters.
+@pytest.mark.parametrize("chunked", [False, True])
+def test_image_cache(falsebot, monkeypatch, chunked):
+    monkeypatch.setattr(falsebot, "imageCache", bounded_cache(maxBytes=64*1024))
+    monkeypatch.setattr(falsebot, "maxImageSize", 32*1024)
+    replies = []
+    monkeypatch.setattr(falsebot.bot, "say_in_channel", lambda channel_id, content: replies.append(content))
+    query = "?chunked" if chunked else ""
+
+    def post(server, channel_id, name):
+        falsebot.ch.channelBuffer.append({ "id": name, "channel_id": channel_id, "author": { "id": "1" }, "content": "",
+                "attachments": [{ "id": name, "url": server.attachmentUrl + name + query }] })
+
+    async def check(server):
+        results = []
+        try:
+            post(server, "10", "first")
+            for i in range(3):
+                results.append(await falsebot.findRecentImageInChannel("10"))
+            post(server, "10", "second")
+            results.append(await falsebot.findRecentImageInChannel("10"))
+            post(server, "20", "large")
+            for i in range(2):
+                with pytest.raises(ValueError):
+                    await falsebot.findRecentImageInChannel("20")
+            falsebot.cacheStats({ "channel_id": "10" })
+        finally:
+            await falsebot.bot.close_session()
+        return results, server.attachment_fetches
+
+    first, second = b"first image" * 100, b"second image" * 100
+    results, fetches = serve(check, { "first": first, "second": second, "large": bytes(40*1024) })
+
+    assert [data for digest, data in results] == [first, first, first, second]
+    assert results[0][0] == results[2][0] != results[3][0]
+    assert fetches == { "first": 1, "second": 1, "large": 2 }
+    stats = falsebot.imageCache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (2, 4, 2, len(first) + len(second))
+    assert replies[-1].startswith("Downloaded images: 33% hit ratio (2 hits, 4 misses), 2 cached")
@@ -0,0 +1,65 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection,zlib_stream_decoder,opcodes
+from replay import stand_in_server,synthesize
+import asyncio,json
+
+def run_bot(path, **kwargs):
+    async def check():
+        server = stand_in_server(path, **kwargs)
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl, compress=True)
+        task = asyncio.ensure_future(bot.start())
+        while not (server.done.is_set() and bot.sequence == server.last_sequence) and not task.done():
+            await asyncio.sleep(0.01)
+        await bot.close()
+        await task
+        await server.stop()
+        return server, bot
+    return asyncio.run(check())
+
+# The bot reassembles compressed messages split over several frames and sees every event.
+def test_compressed_gateway(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=20, messages=1000)
+    server, bot = run_bot(path, frameSize=512)
+
+    assert bot.sequence == server.last_sequence and len(bot.guilds) == 20
+    assert bot.decoder.compressedBytes == server.bytes_sent
+    assert bot.decoder.decompressedBytes == server.raw_bytes
+    assert server.bytes_sent * 3 < server.raw_bytes
+
+# Frames recorded from a compressed connection decode to the messages sent, whatever the frame size.
+def test_replay_recorded_frames(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=5, messages=200)
+    server, bot = run_bot(path, keepFrames=True)
+
+    with open(path) as f:
+        expected = [json.loads(line)['frame'] for line in f]
+    expected = [frame for frame in expected if frame['op'] == opcodes.DISPATCH]
+
+    for size in (1, 7, 4096, 1 << 20):
+        decoder = zlib_stream_decoder()
+        messages = []
+        for data in server.frames:
+            for i in range(0, len(data), size):
+                message = decoder.feed(data[i:i + size])
+                if message is not None:
+                    messages.append(json.loads(message))
+        assert messages[0]['op'] == opcodes.HELLO
+        assert [m for m in messages if m['op'] == opcodes.DISPATCH] == expected
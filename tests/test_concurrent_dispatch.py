@@ -0,0 +1,96 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection,discord_chat_handler
+from replay import stand_in_server,synthesize
+import asyncio,json
+
+def count_messages(path, word=""):
+    with open(path) as f:
+        frames = [json.loads(line)['frame'] for line in f]
+    return sum(1 for frame in frames if frame['t'] == 'MESSAGE_CREATE' and word in frame['d']['content'])
+
+# Slow handlers run as tasks: the read loop keeps up with the gateway, no channel runs more than
+# maxChannelConcurrency handlers at once, and handlers past their timeout are cancelled.
+def test_channel_cap_and_timeouts(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=2, messages=200, presences=0)
+    active = {}
+    most = {}
+
+    async def check():
+        server = stand_in_server(path)
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl)
+        ch = discord_chat_handler(bot, concurrent=True, maxChannelConcurrency=2, handlerTimeout=1)
+
+        @ch.match(lambda message: True)
+        async def slow(message):
+            channel_id = message['channel_id']
+            active[channel_id] = active.get(channel_id, 0) + 1
+            most[channel_id] = max(most.get(channel_id, 0), active[channel_id])
+            try:
+                await asyncio.sleep(0.01)
+            finally:
+                active[channel_id] -= 1
+
+        @ch.matchKeyword("siege", timeout=0.05)
+        async def hangs(message):
+            await asyncio.sleep(10)
+
+        task = asyncio.ensure_future(bot.start())
+        while not (server.done.is_set() and bot.sequence == server.last_sequence) and not task.done():
+            await asyncio.sleep(0.001)
+        behind = ch.stats()['pending']
+        while ch.stats()['pending'] and not task.done():
+            await asyncio.sleep(0.01)
+        await bot.close()
+        await task
+        await server.stop()
+        return ch.stats(), behind
+
+    stats, behind = asyncio.run(check())
+    messages = count_messages(path)
+    sieges = count_messages(path, "siege")
+    assert behind > 0                   # Every event was read while handlers were still running.
+    assert max(most.values()) == 2
+    assert stats['timed_out'] == sieges and stats['completed'] == messages
+    assert stats['dropped'] == 0 and stats['failed'] == 0 and stats['channels'] == 0
+
+# Past maxPending, matches are dropped rather than queued.
+def test_max_pending_drops():
+    async def check():
+        bot = discord_bot_connection("test")
+        bot.user = { "id": "1" }
+        ch = discord_chat_handler(bot, concurrent=True, maxPending=5)
+        release = asyncio.Event()
+
+        @ch.match(lambda message: True)
+        async def waits(message):
+            await release.wait()
+
+        for i in range(8):
+            await ch.handle_message_create({ "id": str(i), "channel_id": "10", "author": { "id": "2" },
+                    "content": "hello", "attachments": [] })
+        stats = ch.stats()
+        release.set()
+        while ch.stats()['pending']:
+            await asyncio.sleep(0.001)
+        return stats, ch.stats()
+
+    waiting, done = asyncio.run(check())
+    assert waiting['pending'] == 5 and waiting['dropped'] == 3
+    assert done['completed'] == 5
@@ -0,0 +1,56 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection,discord_chat_handler
+import asyncio,time
+import pytest
+
+def run_jobs(jobs, **kwargs):
+    async def check():
+        ch = discord_chat_handler(discord_bot_connection("test"), **kwargs)
+        try:
+            return await jobs(ch), ch.stats()
+        finally:
+            ch.shutdown_executor()
+    return asyncio.run(check())
+
+# Work runs in the pool and its result comes back to the event loop.
+def test_result():
+    async def jobs(ch):
+        return await asyncio.gather(*[ch.run_in_executor(pow, 2, n) for n in range(4)])
+    results, stats = run_jobs(jobs)
+    assert results == [1, 2, 4, 8] and stats['executor_jobs'] == 0
+
+# Once executorQueue jobs are outstanding, more are refused rather than queued.
+def test_queue_full():
+    async def jobs(ch):
+        first = asyncio.ensure_future(ch.run_in_executor(time.sleep, 0.3))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.QueueFull):
+            await ch.run_in_executor(time.sleep, 0)
+        await first
+    results, stats = run_jobs(jobs, executorQueue=1, executorWorkers=1)
+    assert stats['executor_jobs'] == 0
+
+# A job past executorTimeout raises TimeoutError and no longer counts against the queue.
+def test_timeout():
+    async def jobs(ch):
+        started = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await ch.run_in_executor(time.sleep, 2)
+        return time.monotonic() - started
+    seconds, stats = run_jobs(jobs, executorTimeout=0.1, executorWorkers=1)
+    assert seconds < 1 and stats['executor_jobs'] == 0
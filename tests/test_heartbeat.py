@@ -0,0 +1,55 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection
+from replay import stand_in_server,synthesize,is_ready
+import asyncio
+
+def run_bot(path, seconds, **kwargs):
+    async def check():
+        server = stand_in_server(path, heartbeatInterval=50, **kwargs)
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl)
+        task = asyncio.ensure_future(bot.start())
+        while not is_ready(bot) and not task.done():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(seconds)
+        await bot.close()
+        await task
+        await server.stop()
+        return server, bot
+    return asyncio.run(check())
+
+# Latency is the round trip to the ACK, and beats keep to their deadlines however long the ACKs take.
+def test_latency_follows_ack_delay(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=1, messages=0)
+    server, bot = run_bot(path, 1.0, ackDelay=0.02)
+
+    assert 0.02 <= bot.latency_p50 < 0.04
+    assert bot.latency_p99 < 0.05
+    beats = [t for shard, t in server.heartbeats]
+    gaps = [b - a for a, b in zip(beats, beats[1:])]
+    assert len(beats) >= 18
+    assert sum(gaps) / len(gaps) < 0.052       # No drift from send time or the ACK delay.
+    assert server.resumes == []
+
+# An ACK which doesn't arrive before the next beat marks the connection as a zombie.
+def test_late_ack_reconnects(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=1, messages=0)
+    server, bot = run_bot(path, 0.5, ackDelay=0.2)
+    assert server.resumes
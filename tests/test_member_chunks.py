@@ -0,0 +1,62 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection
+from replay import stand_in_server,synthesize,guild_id,is_ready
+import asyncio
+
+def request_members(path, guild_ids, **kwargs):
+    async def check():
+        server = stand_in_server(path, chunkSize=20)
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl)
+        task = asyncio.ensure_future(bot.start())
+        while not (is_ready(bot) and server.done.is_set()) and not task.done():
+            await asyncio.sleep(0.01)
+
+        chunks = []
+        async for chunk in bot.request_guild_members(guild_ids, **kwargs):
+            chunks.append(chunk)
+        await bot.close()
+        await task
+        await server.stop()
+        return chunks
+    return asyncio.run(check())
+
+# Members of many guilds are requested in batches and every chunk of every guild is yielded.
+def test_chunks_for_every_guild(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=120, messages=0)
+    guild_ids = [guild_id(g) for g in range(120)]
+    chunks = request_members(path, guild_ids, batchSize=50)
+
+    assert len({ chunk['nonce'] for chunk in chunks }) == 3
+    assert sorted({ chunk['guild_id'] for chunk in chunks }) == sorted(guild_ids)
+    for g in guild_ids:
+        indexes = sorted(chunk['chunk_index'] for chunk in chunks if chunk['guild_id'] == g)
+        assert indexes == [0, 1, 2]
+    assert sum(len(chunk['members']) for chunk in chunks) == 120 * 50
+
+# A query or user ids narrow the members returned, and guilds with no matches still finish.
+def test_query_and_user_ids(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=2, messages=0)
+    chunks = request_members(path, [guild_id(0), guild_id(1)], query="user1")
+    assert sorted(m['user']['username'] for c in chunks if c['guild_id'] == guild_id(0) for m in c['members']) == \
+            sorted(["user1"] + [f"user{i}" for i in range(10, 20)])
+
+    chunks = request_members(path, guild_id(1), user_ids=["10003", "99999"])
+    assert [m['user']['id'] for c in chunks for m in c['members']] == ["10003"]
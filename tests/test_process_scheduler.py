@@ -0,0 +1,97 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection
+from replay import stand_in_server
+import asyncio,time,multiprocessing
+
+# Submitting to a worker process which can't keep up waits for room without stalling the event loop.
+def test_slow_worker_does_not_block_loop():
+    async def check():
+        server = stand_in_server()
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, processes=1, workers=1, maxPending=20)
+
+        @bot.dispatch('MESSAGE_CREATE')
+        async def slow(event):
+            time.sleep(0.3 if event['id'] == "0" else 0.001)     # Falls behind once, with the pipe full.
+            bot.create_message(event['channel_id'], json={ "content": event['id'] })
+
+        gaps = []
+        async def ticker():
+            while True:
+                last = time.monotonic()
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - last)
+        ticking = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.02)
+
+        pending = 0
+        padding = "x" * 64*1024         # A few events fill the pipe's buffer.
+        for i in range(200):
+            await bot.scheduler.submit("1", 'MESSAGE_CREATE', { "id": str(i), "channel_id": "10", "padding": padding })
+            pending = max(pending, bot.scheduler.stats()['pending'])
+        await bot.scheduler.drain()
+        await bot.scheduler.close()
+        ticking.cancel()
+        await server.stop()
+        return server, gaps, pending
+
+    server, gaps, pending = asyncio.run(check())
+    assert server.rest_calls["POST /channels/:id/messages"] == 200
+    assert pending <= 20
+    assert max(gaps) < 0.1
+
+# Worker processes keep their copy of the guild cache and user up to date after they are forked.
+def test_workers_see_cache_updates():
+    results = multiprocessing.get_context("fork").Queue()
+
+    def guild(guild_id, name):
+        return { "id": guild_id, "name": name, "unavailable": False, "roles": [], "members": [],
+                 "channels": [{ "id": guild_id + "0", "type": 0, "name": "general", "position": 0 }] }
+
+    def message(message_id, guild_id, author_id):
+        return { "id": message_id, "channel_id": guild_id + "0", "guild_id": guild_id, "content": "",
+                 "author": { "id": author_id, "username": "user" }, "member": { "roles": [] } }
+
+    async def check():
+        bot = discord_bot_connection("test", processes=2, workers=1)
+
+        @bot.dispatch('MESSAGE_CREATE')
+        async def report(event):
+            guild = bot.guilds.get(event['guild_id'])
+            results.put((event['id'], bot.user['username'] if bot.user else None,
+                         guild.name, sorted(guild.channels), sorted(guild.members)))
+
+        for eventType, event in [
+                ('GUILD_CREATE',    guild("1000", "First")),
+                ('MESSAGE_CREATE',  message("1", "1000", "2")),     # Forks the worker processes.
+                ('READY',           { "user": { "id": "1", "username": "FalseBot" }, "session_id": "s", "guilds": [] }),
+                ('GUILD_UPDATE',    { "id": "1000", "name": "Renamed" }),
+                ('CHANNEL_CREATE',  { "id": "10001", "guild_id": "1000", "type": 0, "name": "new", "position": 1 }),
+                ('GUILD_CREATE',    guild("2000", "Second")),
+                ('MESSAGE_CREATE',  message("2", "1000", "3")),
+                ('MESSAGE_CREATE',  message("3", "2000", "4"))]:
+            await bot.handle_dispatch({ "t": eventType, "d": event })
+        await bot.scheduler.drain()
+        await bot.scheduler.close()
+
+    asyncio.run(check())
+    reports = sorted(results.get(timeout=5) for i in range(3))
+    assert reports == [
+            ("1", None, "First", [10000], [2]),
+            ("2", "FalseBot", "Renamed", [10000, 10001], [2, 3]),
+            ("3", "FalseBot", "Second", [20000], [4])]
@@ -0,0 +1,74 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection
+from replay import stand_in_server
+import asyncio,time
+
+# A burst of messages to one channel waits for the bucket to reset instead of hitting 429s.
+def test_burst_stays_within_bucket():
+    async def check():
+        server = stand_in_server(rateLimit=(5, 0.5))
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl)
+        started = time.monotonic()
+        await asyncio.gather(*[bot.create_message("10", json={ "content": str(i) }) for i in range(20)])
+        elapsed = time.monotonic() - started
+        await bot.close_session()
+        await server.stop()
+        return server, bot, elapsed
+
+    server, bot, elapsed = asyncio.run(check())
+    assert server.rate_limited == 0
+    assert server.rest_calls["POST /channels/:id/messages"] == 20
+    assert elapsed >= 1.5               # Four windows of five requests.
+    stats = bot.ratelimiter.stats()
+    assert all(bucket["inflight"] == 0 and bucket["queued"] == 0 for bucket in stats["buckets"].values())
+
+# A 429 holds the request until the bucket resets, and it is then sent again.
+def test_retry_after_429():
+    async def check():
+        server = stand_in_server(rateLimit=(2, 0.5))
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl)
+        server.buckets["POST /channels/:id/messages"] = [0, time.monotonic() + 0.3]    # Used up by someone else.
+        await asyncio.gather(*[bot.create_message("10", json={ "content": str(i) }) for i in range(3)])
+        await bot.close_session()
+        await server.stop()
+        return server
+
+    server = asyncio.run(check())
+    assert server.rate_limited == 1
+    assert server.rest_calls["POST /channels/:id/messages"] == 4
+
+# Routes without rate limit headers aren't serialized.
+def test_unlimited_route_is_concurrent():
+    async def check():
+        server = stand_in_server()
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl)
+        await bot.create_message("10", json={ "content": "first" })
+        tasks = [bot.create_message("10", json={ "content": str(i) }) for i in range(10)]
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        bucket = next(iter(bot.ratelimiter.buckets.values()))
+        inflight = bucket.inflight
+        await asyncio.gather(*tasks)
+        await bot.close_session()
+        await server.stop()
+        return inflight
+
+    assert asyncio.run(check()) == 10
@@ -0,0 +1,68 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection
+from replay import stand_in_server,synthesize
+import asyncio,json
+
+def messages_in(path):
+    with open(path) as f:
+        return [json.loads(line)['frame']['d']['id'] for line in f if '"MESSAGE_CREATE"' in line]
+
+def run_bot(path, **kwargs):
+    handled = []
+    async def check():
+        server = stand_in_server(path, **kwargs)
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl)
+
+        @bot.dispatch('MESSAGE_CREATE')
+        async def message_create(event):
+            handled.append(event['id'])
+
+        task = asyncio.ensure_future(bot.start())
+        async def finished():
+            while not (server.done.is_set() and bot.sequence == server.last_sequence) and not task.done():
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(finished(), 10)
+        await bot.close()
+        await task
+        await server.stop()
+        return server
+    return asyncio.run(check()), handled
+
+# A RECONNECT resumes the session, and every event arrives exactly once.
+def test_reconnect_resumes(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=5, messages=300, presences=0)
+    server, handled = run_bot(path, reconnectAfter=100)
+    assert server.identifies == [None] and server.resumes == [None]
+    assert handled == messages_in(path)
+
+# So does a dropped connection with a resumable close code.
+def test_close_resumes(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=5, messages=300, presences=0)
+    server, handled = run_bot(path, closeAfter=(100, 4000))
+    assert server.identifies == [None] and server.resumes == [None]
+    assert handled == messages_in(path)
+
+# A close code which ends the session IDENTIFYs again instead.
+def test_session_timeout_identifies(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=5, messages=300, presences=0)
+    server, handled = run_bot(path, closeAfter=(100, 4009))
+    assert server.identifies == [None, None] and server.resumes == []
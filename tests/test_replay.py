@@ -0,0 +1,39 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+import replay
+from replay import synthesize
+import asyncio
+
+# The benchmark harness runs end to end, directly and over the stand-in gateway, with the
+# options the benchmarks in the README use.
+def test_run(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=5, messages=300)
+    with open(path) as f:
+        frames = sum(1 for line in f)
+
+    results = asyncio.run(replay.run(path))
+    assert results['events'] == frames
+    results = asyncio.run(replay.run(path, gateway=True, coalesce=0.05, lazyDecode=False, workers=4, instrument=False))
+    assert results['events'] == frames - 1      # The gateway sends its own HELLO.
+
+def test_restart(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=5, messages=100)
+
+    results = asyncio.run(replay.restart(path, str(tmp_path / "replay.snapshot")))
+    assert len(results) == 3
@@ -0,0 +1,101 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection,gateway_send_queue,opcodes
+from replay import stand_in_server,synthesize,is_ready
+import asyncio,time
+
+class fake_websocket:
+    """ Records (time.monotonic(), payload) for everything sent through it. """
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, payload):
+        self.sent.append((time.monotonic(), payload))
+
+def most_in_window(times, window):
+    return max(sum(1 for u in times if t <= u < t + window) for t in times)
+
+# Sends stay within the token bucket, and a heartbeat goes straight past a backlog.
+def test_rate_and_priority():
+    async def check():
+        ws = fake_websocket()
+        queue = gateway_send_queue(ws.send, rate=20, per=0.5, reserved=2)
+        queue.start()
+        futures = [queue.put({ "op": opcodes.REQUEST_GUILD_MEMBERS, "d": i, "s": None, "t": None }) for i in range(40)]
+        await asyncio.sleep(0.1)
+        queued = time.monotonic()
+        await queue.put({ "op": opcodes.HEARTBEAT, "d": 1, "s": None, "t": None })
+        heartbeat = time.monotonic() - queued
+        stats = queue.stats()
+        await asyncio.gather(*futures)
+        queue.stop()
+        return ws, heartbeat, stats
+
+    ws, heartbeat, stats = asyncio.run(check())
+    times = [t for t, payload in ws.sent]
+    assert most_in_window(times, 0.5) <= 20
+    normal = [t for t, payload in ws.sent if payload['op'] == opcodes.REQUEST_GUILD_MEMBERS]
+    assert [payload['d'] for t, payload in ws.sent if payload['op'] == opcodes.REQUEST_GUILD_MEMBERS] == list(range(40))
+    assert sum(1 for t in normal if t < normal[0] + 0.01) == 20 - 2       # The reserve is kept back.
+    assert heartbeat < 0.02 and stats['normal_queued'] > 0
+
+# Only the latest of several waiting STATUS_UPDATEs is sent.
+def test_status_updates_coalesce():
+    async def check():
+        ws = fake_websocket()
+        queue = gateway_send_queue(ws.send, rate=3, per=1, reserved=0)
+        queue.start()
+        futures = [queue.put({ "op": opcodes.REQUEST_GUILD_MEMBERS, "d": i, "s": None, "t": None }) for i in range(3)]
+        futures += [queue.put({ "op": opcodes.STATUS_UPDATE, "d": { "status": status }, "s": None, "t": None })
+                    for status in ("idle", "dnd", "online")]
+        await asyncio.gather(*futures)
+        queue.stop()
+        return ws, queue.stats()
+
+    ws, stats = asyncio.run(check())
+    assert [payload['d'] for t, payload in ws.sent if payload['op'] == opcodes.STATUS_UPDATE] == [{ "status": "online" }]
+    assert stats['coalesced'] == 2
+
+# Over a real connection heartbeats keep their schedule while other commands wait for tokens.
+def test_heartbeats_during_backlog(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=1, messages=0)
+
+    async def check():
+        server = stand_in_server(path, heartbeatInterval=100)
+        await server.start()
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl)
+        task = asyncio.ensure_future(bot.start())
+        while not is_ready(bot) and not task.done():
+            await asyncio.sleep(0.01)
+        flooded = time.monotonic()
+        sends = [asyncio.ensure_future(bot.send_payload(opcodes.REQUEST_GUILD_MEMBERS, { "guild_id": "1", "nonce": str(i) }))
+                 for i in range(200)]
+        await asyncio.sleep(0.6)
+        stats = bot.sendQueue.stats()
+        await bot.close()
+        await task
+        await asyncio.gather(*sends, return_exceptions=True)
+        await server.stop()
+        return server, flooded, stats
+
+    server, flooded, stats = asyncio.run(check())
+    requests = [t for t, payload in server.received if payload['op'] == opcodes.REQUEST_GUILD_MEMBERS]
+    beats = [t for t, payload in server.received if payload['op'] == opcodes.HEARTBEAT and t > flooded]
+    assert len(requests) <= 120 - 5
+    assert stats['normal_queued'] > 0
+    assert len(beats) >= 4 and max(b - a for a, b in zip(beats, beats[1:])) < 0.15
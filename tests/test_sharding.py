@@ -0,0 +1,116 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection,discord_chat_handler,shard_manager,identify_limiter,opcodes
+from replay import stand_in_server,synthesize,attach_handlers
+import asyncio,json,random
+
+def replies_expected(path):
+    count = 0
+    with open(path) as f:
+        for line in f:
+            frame = json.loads(line)['frame']
+            if frame['t'] == 'MESSAGE_CREATE' and ("hello falsebot" in frame['d']['content'] or "siege" in frame['d']['content']):
+                count += 1
+    return count
+
+def start_manager(server, **kwargs):
+    manager = shard_manager("test", shardCount=2, gatewayUrl=server.gatewayUrl, identifyLimiter=identify_limiter(2),
+            apiUrl=server.apiUrl, **kwargs)
+    return manager, asyncio.ensure_future(manager.start())
+
+# Each shard gets its own guilds, and a chat handler on manager.connection answers messages from every shard.
+def test_guilds_are_split_over_shards(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=8, messages=200, presences=0.2)
+    expected = replies_expected(path)
+
+    async def check():
+        server = stand_in_server(path)
+        await server.start()
+        manager, task = start_manager(server)
+        ch = discord_chat_handler(manager.connection)
+        attach_handlers(manager.connection, ch)
+
+        async def replied():
+            while server.rest_calls.get("POST /channels/:id/messages", 0) < expected and not task.done():
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(replied(), 10)
+        await manager.close()
+        await task
+        await server.stop()
+        return server, manager
+
+    server, manager = asyncio.run(check())
+    assert sorted(server.identifies) == [0, 1]
+    assert server.rest_calls["POST /channels/:id/messages"] == expected
+    assert manager.connection.user['username'] == "FalseBot"
+    assert len(manager.guilds) == 8 and all(not g.unavailable for g in manager.guilds)
+    assert sorted(manager.shard_for_guild(g.id) for g in manager.guilds) == [0, 0, 0, 0, 1, 1, 1, 1]
+    assert sorted(set(session for session in server.sessions)) == ["replay-0", "replay-1"]
+
+# A shard whose heartbeats aren't acknowledged reconnects on its own, without holding up the other shard.
+def test_heartbeats_are_per_shard(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=4, messages=0)
+
+    async def check():
+        server = stand_in_server(path, heartbeatInterval=100, withholdAcks=[1])
+        await server.start()
+        manager, task = start_manager(server)
+        await asyncio.sleep(1.0)
+        await manager.close()
+        await task
+        await server.stop()
+        return server, manager
+
+    server, manager = asyncio.run(check())
+    assert server.identifies.count(0) == 1 and 0 not in server.resumes
+    assert 1 in server.resumes
+    beats = [t for shard, t in server.heartbeats if shard == 0]
+    assert len(beats) >= 7
+    assert max(b - a for a, b in zip(beats, beats[1:])) < 0.15
+    assert manager.shards[0].latency_p50 is not None
+
+# Shards whose sessions can't be resumed still take turns to IDENTIFY.
+def test_invalid_sessions_wait_to_identify(tmp_path, monkeypatch):
+    path = str(tmp_path / "session.jsonl")
+    synthesize(path, guilds=4, messages=0)
+    monkeypatch.setattr(random, "uniform", lambda a, b: 0)     # Skip the INVALID_SESSION back-off.
+    monkeypatch.setattr(identify_limiter, "interval", 0.5)
+
+    async def check():
+        server = stand_in_server(path)
+        await server.start()
+        limiter = identify_limiter(1)
+        bots = [discord_bot_connection("test", apiUrl=server.apiUrl, gatewayUrl=server.gatewayUrl,
+                    shard=[i, 2], identifyLimiter=limiter) for i in range(2)]
+        for bot in bots:                # As if restored from a stale snapshot.
+            bot.session_id = "expired"
+            bot.sequence = 10
+        tasks = [asyncio.ensure_future(bot.start()) for bot in bots]
+        while len(server.identifies) < 2 and not any(task.done() for task in tasks):
+            await asyncio.sleep(0.01)
+        for bot in bots:
+            await bot.close()
+        await asyncio.gather(*tasks)
+        await server.stop()
+        return server
+
+    server = asyncio.run(check())
+    assert server.resumes == [None, None] and sorted(server.identifies) == [0, 1]
+    times = [t for t, payload in server.received if payload['op'] == opcodes.IDENTIFY]
+    assert times[1] - times[0] >= 0.45
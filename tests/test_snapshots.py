@@ -0,0 +1,113 @@
+#    This file is part of FalseBot
+#    Project Home: https://github.com/FalseAscension/FalseBot
+#
+#    FalseBot is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    FalseBot is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with FalseBot.  If not, see <https://www.gnu.org/licenses/>.
+
+from discordBot import discord_bot_connection,discord_chat_handler,shard_manager,identify_limiter
+from replay import stand_in_server,synthesize,is_ready
+import asyncio,os,pickle,shutil
+
+# Snapshots saved while events arrive let a restarted bot RESUME with its caches and message history.
+def test_warm_restart(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    snapshot = str(tmp_path / "bot.snapshot")
+    synthesize(path, guilds=10, messages=500, presences=0.5)
+
+    async def run_bot(server):
+        bot = discord_bot_connection("test", apiUrl=server.apiUrl, snapshotFile=snapshot, snapshotInterval=0.01)
+        ch = discord_chat_handler(bot)
+        task = asyncio.ensure_future(bot.start())
+        while not (is_ready(bot) and server.done.is_set() and bot.sequence == server.last_sequence) and not task.done():
+            await asyncio.sleep(0.01)
+        await bot.close(keepSession=True)
+        await task
+        return bot, ch
+
+    async def check():
+        server = stand_in_server(path, speed=5)
+        await server.start()
+        first, ch = await run_bot(server)
+        messages = ch.channelBuffer.stats()['messages']
+        second, ch = await run_bot(server)
+        await server.stop()
+        return server, first, second, messages, ch
+
+    server, first, second, messages, ch = asyncio.run(check())
+    assert os.path.exists(snapshot)
+    assert server.identifies == [None] and server.resumes == [None]
+    assert second.session_id == first.session_id
+    assert len(second.guilds) == 10
+    assert messages > 0 and ch.channelBuffer.stats()['messages'] == messages
+
+# The state handed to the executor doesn't change as events keep updating the caches.
+def test_snapshot_state_is_a_copy():
+    bot = discord_bot_connection("test", snapshotFile="unused")
+    ch = discord_chat_handler(bot)
+    bot.guilds.handle('GUILD_CREATE', { "id": "1000", "name": "Guild", "unavailable": False, "roles": [],
+            "channels": [{ "id": "10", "type": 0, "name": "general", "position": 0 }], "members": [] })
+    message = { "id": "1", "channel_id": "10", "author": { "id": "2" }, "content": "hello", "attachments": [] }
+    ch.channelBuffer.append(message)
+
+    state = bot.snapshot_state()
+    bot.guilds.handle('GUILD_CREATE', { "id": "1001", "name": "Other", "unavailable": False, "roles": [], "channels": [], "members": [] })
+    bot.guilds.handle('CHANNEL_CREATE', { "id": "11", "guild_id": "1000", "type": 0, "name": "new", "position": 1 })
+    ch.channelBuffer.append(dict(message, id="2"))
+
+    assert list(state['guilds']['guilds']) == [1000]
+    assert list(state['guilds']['guilds'][1000].channels) == [10]
+    assert [record.id for record in state['registry']['channelBuffer']["10"]] == ["1"]
+
+# Every shard snapshots its own session and guilds to its own file, and a restarted manager
+# RESUMEs every shard with all of the guilds. A shard never loads another shard's session or guilds.
+def test_sharded_warm_restart(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    snapshot = str(tmp_path / "bot.snapshot")
+    synthesize(path, guilds=8, messages=200, presences=0.2)
+
+    async def run_manager(server):
+        manager = shard_manager("test", shardCount=2, gatewayUrl=server.gatewayUrl, identifyLimiter=identify_limiter(2),
+                apiUrl=server.apiUrl, snapshotFile=snapshot, snapshotInterval=0.01)
+        task = asyncio.ensure_future(manager.start())
+        while not (server.done.is_set() and len(manager.guilds) == 8 and all(not g.unavailable for g in manager.guilds)) \
+                and not task.done():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        await asyncio.gather(*[shard.close(keepSession=True) for shard in manager.shards.values()])
+        await task
+        return manager
+
+    async def check():
+        server = stand_in_server(path)
+        await server.start()
+        first = await run_manager(server)
+        second = await run_manager(server)
+        await server.stop()
+        return server, first, second
+
+    server, first, second = asyncio.run(check())
+    assert sorted(server.identifies) == [0, 1] and sorted(server.resumes) == [0, 1]
+    assert not os.path.exists(snapshot)
+    for shard_id in (0, 1):
+        with open(f"{snapshot}.{shard_id}", 'rb') as f:
+            state = pickle.load(f)
+        assert state['shard'] == [shard_id, 2] and state['session_id'] == first.shards[shard_id].session_id
+        assert len(state['guilds']['guilds']) == 4
+        assert all(first.shard_for_guild(guild_id) == shard_id for guild_id in state['guilds']['guilds'])
+        assert second.shards[shard_id].session_id == first.shards[shard_id].session_id
+    assert len(second.guilds) == 8
+
+    shutil.copy(f"{snapshot}.0", str(tmp_path / "other.snapshot"))
+    other = discord_bot_connection("test", shard=[1, 2], snapshotFile=str(tmp_path / "other.snapshot"))
+    assert other.load_snapshot()
+    assert other.session_id is None and len(other.guilds) == 0